@@ -0,0 +1,3 @@
+# coding=utf-8
+# Development tools for OctoPrint-PolarCloud, see README-DEV.md.  Nothing in
+# here is installed with the plugin.
@@ -0,0 +1,231 @@
+# coding=utf-8
+# Microbenchmarks for the paths the plugin runs on every status tick and on
+# every gcode line.  Run from the repository root:
+#
+#     python -m devtools.bench             # run and compare to the baseline
+#     python -m devtools.bench --save      # run and store a new baseline
+#
+# For each case it reports calls per second, the peak memory a single call
+# allocates and how much memory a call leaves behind.  See README-DEV.md.
+from __future__ import absolute_import, print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from octoprint.events import Events
+
+import octoprint_polarcloud
+from devtools.fakes import FakePrinter, make_plugin
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# calls used to measure retained memory
+_RETAINED_CALLS = 200
+
+
+# a plugin printing a cloud print, the state the status tick is in most of
+# the time it matters
+def _printing_plugin(folder):
+	printer = FakePrinter("PRINTING")
+	plugin = make_plugin(folder, overrides={"serial": "BENCH"}, printer=printer)
+	plugin._state.start_job("4242", {"file": "https://example.com/model.stl",
+		"config": "https://example.com/config.ini", "sliceDetails": ""})
+	plugin.on_event(Events.PRINT_STARTED, {})
+	printer.register_callback(plugin._temperatures)
+	printer.push_temperatures()
+	return plugin
+
+
+def _idle_plugin(folder):
+	plugin = make_plugin(folder, overrides={"serial": "BENCH"})
+	plugin._printer.register_callback(plugin._temperatures)
+	plugin._printer.push_temperatures()
+	return plugin
+
+
+# (name, setup) pairs, setup(folder) returns the function to time
+def _cases():
+	job_data = FakePrinter().get_current_data()
+
+	def current_status_printing(folder):
+		return _printing_plugin(folder)._current_status
+
+	def current_status_idle(folder):
+		return _idle_plugin(folder)._current_status
+
+	def polar_status_from_state(folder):
+		return _printing_plugin(folder)._polar_status_from_state
+
+	def filament_length(folder):
+		return lambda: octoprint_polarcloud.filament_length_from_job_data(job_data)
+
+	def str_safe_get(folder):
+		return lambda: octoprint_polarcloud.str_safe_get(job_data, "job", "file", "size")
+
+	def float_safe_get(folder):
+		return lambda: octoprint_polarcloud.float_safe_get(job_data, "progress", "completion")
+
+	def strip_ignore_passthrough(folder):
+		strip_ignore = _idle_plugin(folder).strip_ignore
+		return lambda: strip_ignore(None, "queuing", "G1 X10.5 Y20.25 E0.41", None, "G1")
+
+	def strip_ignore_ignored(folder):
+		strip_ignore = _idle_plugin(folder).strip_ignore
+		return lambda: strip_ignore(None, "queuing", "(@ignore {print_temperature})", None, None)
+
+	return [
+		("status.current_status.printing", current_status_printing),
+		("status.current_status.idle", current_status_idle),
+		("status.polar_status_from_state", polar_status_from_state),
+		("data.filament_length_from_job_data", filament_length),
+		("data.str_safe_get", str_safe_get),
+		("data.float_safe_get", float_safe_get),
+		("gcode.strip_ignore.passthrough", strip_ignore_passthrough),
+		("gcode.strip_ignore.ignored", strip_ignore_ignored),
+	]
+
+
+def _measure(func, repeat):
+	timer = timeit.Timer(func)
+	number = timer.autorange()[0]
+	seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+
+	gc.collect()
+	tracemalloc.start()
+	try:
+		# peak working memory of one call
+		peak = 0
+		for i in range(repeat):
+			tracemalloc.reset_peak()
+			before = tracemalloc.get_traced_memory()[0]
+			func()
+			peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+
+		# memory still held after many calls, per call
+		gc.collect()
+		before = tracemalloc.get_traced_memory()[0]
+		for i in range(_RETAINED_CALLS):
+			func()
+		gc.collect()
+		retained = max(0, tracemalloc.get_traced_memory()[0] - before) // _RETAINED_CALLS
+	finally:
+		tracemalloc.stop()
+
+	return {
+		"ops_per_sec": round(1.0 / seconds, 1),
+		"peak_bytes": peak,
+		"retained_bytes": retained
+	}
+
+
+def run(selected=None, repeat=5):
+	results = {}
+	folder = tempfile.mkdtemp(prefix="polarcloud-bench-")
+	try:
+		for name, setup in _cases():
+			if selected and not any(s in name for s in selected):
+				continue
+			case_folder = os.path.join(folder, name)
+			os.makedirs(case_folder)
+			results[name] = _measure(setup(case_folder), repeat)
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+	return results
+
+
+def load_baseline(path):
+	try:
+		with open(path) as f:
+			return json.load(f).get("results", {})
+	except (IOError, OSError, ValueError):
+		return {}
+
+
+def save_baseline(path, results):
+	with open(path, "w") as f:
+		json.dump({
+			"python": platform.python_version(),
+			"machine": platform.machine(),
+			"results": results
+		}, f, indent=2, sort_keys=True)
+		f.write("\n")
+
+
+# (name, reason) for the cases that got slower, or allocate more, than
+# tolerance allows
+def regressions(results, baseline, tolerance):
+	found = []
+	for name, result in sorted(results.items()):
+		base = baseline.get(name)
+		if not base:
+			continue
+		if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+			found.append((name, "ops/sec {:,.0f} -> {:,.0f}".format(base["ops_per_sec"], result["ops_per_sec"])))
+		if result["peak_bytes"] > base["peak_bytes"] * (1 + tolerance) + 64:
+			found.append((name, "peak bytes {:,d} -> {:,d}".format(base["peak_bytes"], result["peak_bytes"])))
+		if result["retained_bytes"] > base["retained_bytes"] + 64:
+			found.append((name, "retained bytes {:,d} -> {:,d}".format(base["retained_bytes"], result["retained_bytes"])))
+	return found
+
+
+def _change(value, base):
+	if not base:
+		return ""
+	return "{:+.0f}%".format((value - base) * 100.0 / base)
+
+
+def report(results, baseline, out=sys.stdout):
+	header = "{:<38} {:>12} {:>7} {:>10} {:>7} {:>10}".format(
+		"case", "ops/sec", "", "peak B", "", "retained B")
+	print(header, file=out)
+	print("-" * len(header), file=out)
+	for name, result in sorted(results.items()):
+		base = baseline.get(name, {})
+		print("{:<38} {:>12,.0f} {:>7} {:>10,d} {:>7} {:>10,d}".format(name,
+			result["ops_per_sec"], _change(result["ops_per_sec"], base.get("ops_per_sec")),
+			result["peak_bytes"], _change(result["peak_bytes"], base.get("peak_bytes")),
+			result["retained_bytes"]), file=out)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the PolarCloud status and gcode hot paths.")
+	parser.add_argument("cases", nargs="*", help="only run cases whose name contains one of these")
+	parser.add_argument("--baseline", default=BASELINE, help="baseline file (default: %(default)s)")
+	parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+	parser.add_argument("--repeat", type=int, default=5, help="timing repeats per case, best is kept")
+	parser.add_argument("--tolerance", type=float, default=0.25,
+		help="allowed slowdown or peak memory growth before a case counts as a regression")
+	args = parser.parse_args(argv)
+
+	results = run(args.cases, args.repeat)
+	baseline = load_baseline(args.baseline)
+	report(results, baseline)
+
+	if args.save:
+		if args.cases:
+			# keep the cases that weren't run this time
+			baseline.update(results)
+			results = baseline
+		save_baseline(args.baseline, results)
+		print("\nsaved baseline to {}".format(args.baseline))
+		return 0
+
+	found = regressions(results, baseline, args.tolerance)
+	if found:
+		print("\nregressions against {}:".format(args.baseline))
+		for name, reason in found:
+			print("  {}: {}".format(name, reason))
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
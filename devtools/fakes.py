@@ -0,0 +1,247 @@
+# coding=utf-8
+# Stand-ins for the parts of OctoPrint the plugin talks to, good enough to run
+# a PolarcloudPlugin outside of OctoPrint for benchmarks and load tests.
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+
+from octoprint.events import Events
+
+import octoprint_polarcloud
+
+
+class FakeSettings(object):
+	def __init__(self, defaults, overrides=None, global_settings=None):
+		self._values = dict(defaults)
+		self._values.update(overrides or {})
+		self._global = dict(global_settings or {})
+
+	def get(self, path, **kwargs):
+		return self._values.get(path[0])
+
+	def get_int(self, path, **kwargs):
+		value = self._values.get(path[0])
+		return None if value is None else int(value)
+
+	def get_float(self, path, **kwargs):
+		value = self._values.get(path[0])
+		return None if value is None else float(value)
+
+	def get_boolean(self, path, **kwargs):
+		return bool(self._values.get(path[0]))
+
+	def set(self, path, value, **kwargs):
+		self._values[path[0]] = value
+
+	def global_get(self, path, **kwargs):
+		return self._global.get(tuple(path))
+
+	def save(self, *args, **kwargs):
+		pass
+
+
+# Prints started with select_file(..., printAfterSelect=True) run for
+# print_seconds (None keeps printing until cancelled) and report the usual
+# print events to on_event on a thread of their own, like OctoPrint's event
+# bus does.
+class FakePrinter(object):
+	def __init__(self, state_id="OPERATIONAL", print_seconds=None):
+		self.state_id = state_id
+		self.print_seconds = print_seconds
+		self.on_event = None
+		self.temperatures = {
+			'tool0': {'actual': 210.2, 'target': 210.0},
+			'bed': {'actual': 59.8, 'target': 60.0}
+		}
+		self.current_data = {
+			'state': {'text': 'Printing'},
+			'job': {
+				'file': {'name': 'current-print.gcode', 'size': 2817431},
+				'estimatedPrintTime': 5400.0,
+				'filament': {'tool0': {'length': 4310.5, 'volume': 10.4}}
+			},
+			'progress': {'completion': 42.42, 'filepos': 1195152,
+				'printTime': 2290, 'printTimeLeft': 3110},
+			'file': {'name': 'current-print.gcode'}
+		}
+		self.selected = None
+		self._callbacks = []
+		self._print_started = None
+		self._print_timer = None
+
+	def get_state_id(self):
+		return self.state_id
+
+	def is_printing(self):
+		return self.state_id == "PRINTING"
+
+	def is_paused(self):
+		return self.state_id == "PAUSED"
+
+	def is_error(self):
+		return self.state_id in ("ERROR", "CLOSED_WITH_ERROR")
+
+	def is_closed_or_error(self):
+		return self.state_id in ("CLOSED", "ERROR", "CLOSED_WITH_ERROR", "OFFLINE")
+
+	def get_current_temperatures(self):
+		return self.temperatures
+
+	def get_current_data(self):
+		return self.current_data
+
+	def register_callback(self, callback):
+		self._callbacks.append(callback)
+
+	def unregister_callback(self, callback):
+		if callback in self._callbacks:
+			self._callbacks.remove(callback)
+
+	# push the current temperatures like OctoPrint's printer does on every
+	# temperature report
+	def push_temperatures(self):
+		data = dict((heater, dict(values)) for heater, values in self.temperatures.items())
+		for callback in self._callbacks:
+			callback.on_printer_add_temperature(data)
+
+	def _fire(self, event, payload=None):
+		if self.on_event:
+			thread = threading.Thread(target=self.on_event, args=(event, payload or {}))
+			thread.daemon = True
+			thread.start()
+
+	def _stop_timer(self):
+		if self._print_timer:
+			self._print_timer.cancel()
+			self._print_timer = None
+
+	def _print_done(self):
+		if self.state_id not in ("PRINTING", "PAUSED"):
+			return
+		self.state_id = "OPERATIONAL"
+		self._fire(Events.PRINT_DONE, {"time": time.time() - self._print_started})
+
+	def select_file(self, path, sd, printAfterSelect=False, **kwargs):
+		self.selected = path
+		if not printAfterSelect:
+			return
+		self._stop_timer()
+		self.state_id = "PRINTING"
+		self._print_started = time.time()
+		self._fire(Events.PRINT_STARTED, {"path": path})
+		if self.print_seconds is not None:
+			self._print_timer = threading.Timer(self.print_seconds, self._print_done)
+			self._print_timer.daemon = True
+			self._print_timer.start()
+
+	def connect(self, *args, **kwargs):
+		self.state_id = "OPERATIONAL"
+
+	def disconnect(self, *args, **kwargs):
+		self.state_id = "CLOSED"
+
+	def commands(self, *args, **kwargs):
+		pass
+
+	def set_temperature(self, heater, value, **kwargs):
+		self.temperatures.setdefault(heater, {'actual': 21.0, 'target': 0.0})['target'] = value
+		self.push_temperatures()
+
+	def cancel_print(self, *args, **kwargs):
+		if self.state_id not in ("PRINTING", "PAUSED"):
+			return
+		self._stop_timer()
+		self.state_id = "OPERATIONAL"
+		self._fire(Events.PRINT_CANCELLED, {"time": time.time() - self._print_started})
+
+	def pause_print(self, *args, **kwargs):
+		if self.state_id == "PRINTING":
+			self.state_id = "PAUSED"
+			self._fire(Events.PRINT_PAUSED)
+
+	def resume_print(self, *args, **kwargs):
+		if self.state_id == "PAUSED":
+			self.state_id = "PRINTING"
+			self._fire(Events.PRINT_RESUMED)
+
+
+class FakeFileManager(object):
+	def __init__(self, root):
+		self._root = root
+
+	def add_folder(self, destination, path, **kwargs):
+		folder = os.path.join(self._root, path)
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		return path
+
+	def join_path(self, destination, *paths):
+		return "/".join(paths)
+
+	def path_on_disk(self, destination, path):
+		return os.path.join(self._root, *path.split("/"))
+
+	def add_file(self, destination, path, file_object, **kwargs):
+		target = self.path_on_disk(destination, path)
+		if not os.path.isdir(os.path.dirname(target)):
+			os.makedirs(os.path.dirname(target))
+		file_object.save(target)
+		return path
+
+
+class FakePrinterProfileManager(object):
+	def __init__(self):
+		self.profile = {
+			'id': '_default',
+			'extruder': {'nozzleDiameter': 0.4, 'count': 1, 'offsets': [(0, 0)]},
+			'volume': {'width': 200.0, 'depth': 200.0, 'height': 200.0,
+				'formFactor': 'rectangular', 'origin': 'lowerleft'}
+		}
+
+	def get_current_or_default(self):
+		return self.profile
+
+
+class FakePluginManager(object):
+	def __init__(self):
+		self.messages = []
+
+	def send_plugin_message(self, identifier, data):
+		self.messages.append((identifier, data))
+
+	def get_plugin_info(self, *args, **kwargs):
+		return None
+
+
+# A PolarcloudPlugin wired up the way OctoPrint's plugin core would,
+# keeping its data folder under folder.  Settings in overrides replace the
+# plugin defaults, global_settings maps paths like ("webcam", "snapshot") to
+# values.  key is the PEM of the plugin's private key, without it one is
+# generated the first time the keys are needed.
+def make_plugin(folder, overrides=None, printer=None, logger=None,
+		global_settings=None, key=None):
+	plugin = octoprint_polarcloud.PolarcloudPlugin()
+	plugin._identifier = "polarcloud"
+	plugin._plugin_version = "dev"
+	plugin._logger = logger or logging.getLogger("octoprint.plugins.polarcloud")
+	global_values = {("api", "key"): "devtools"}
+	global_values.update(global_settings or {})
+	plugin._settings = FakeSettings(plugin.get_settings_defaults(), overrides, global_values)
+	plugin._printer = printer or FakePrinter()
+	plugin._printer.on_event = plugin.on_event
+	plugin._printer_profile_manager = FakePrinterProfileManager()
+	plugin._plugin_manager = FakePluginManager()
+	plugin._file_manager = FakeFileManager(os.path.join(folder, "uploads"))
+	data_folder = os.path.join(folder, "data")
+	if not os.path.isdir(data_folder):
+		os.makedirs(data_folder)
+	plugin.get_plugin_data_folder = lambda: data_folder
+	if key:
+		with open(os.path.join(data_folder, "p3d_key"), "wb") as f:
+			f.write(key)
+	plugin.initialize()
+	plugin._update_local_settings()
+	return plugin
@@ -0,0 +1,372 @@
+# coding=utf-8
+# Runs a fleet of plugin instances, each with its own fake printer, in one
+# process against the local Polar Cloud stand-in, then knocks them all off
+# the server at once to see how they come back.  Run from the repository
+# root:
+#
+#     python -m devtools.fleet --instances 50 --printing 0.5 --outage 5
+#
+# Reports how long the fleet takes to connect, status throughput and CPU and
+# memory per instance while steady, and for the reconnect storm after the
+# blip: when reconnect attempts hit the server, how long each instance took
+# to come back, and which never did.  The stand-in runs in a child process so
+# the CPU and memory figures are the plugins' own.  See README-DEV.md.
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+try:
+	from Cryptodome.PublicKey import RSA
+except ImportError:
+	from Crypto.PublicKey import RSA
+
+from devtools.fakes import FakePrinter, make_plugin
+from devtools.standin import PolarStandIn
+
+# OctoPrint reports temperatures about every two seconds
+TEMPERATURE_INTERVAL = 2.0
+
+# width of the buckets the reconnect storm is counted in
+BUCKET_SECONDS = 0.5
+
+
+##~~ stand-in process
+
+def _serve(conn, options):
+	logging.getLogger("werkzeug").setLevel(logging.CRITICAL)
+	server = PolarStandIn(**options).start()
+	conn.send(server.url)
+	while True:
+		command, args = conn.recv()
+		if command == "events":
+			# just what the report needs, the payloads stay here
+			conn.send([(e.time, e.serial, e.name, len(json.dumps(e.data)) if e.name == "status" else 0)
+				for e in server.events[args:]])
+		elif command == "register_key":
+			server.register_key(*args)
+			conn.send(None)
+		elif command == "disconnect_all":
+			server.disconnect_all()
+			conn.send(time.time())
+		elif command == "stop":
+			server.stop()
+			conn.send(time.time())
+		elif command == "start":
+			server.start()
+			conn.send(time.time())
+		elif command == "exit":
+			server.stop()
+			conn.send(None)
+			return
+
+
+class StandInProcess(object):
+	def __init__(self, **options):
+		self._conn, child = multiprocessing.Pipe()
+		self._process = multiprocessing.Process(target=_serve, args=(child, options))
+		self._process.daemon = True
+		self._process.start()
+		self.url = self._conn.recv()
+		self._lock = threading.Lock()
+
+	def call(self, command, args=None):
+		with self._lock:
+			self._conn.send((command, args))
+			return self._conn.recv()
+
+	def close(self):
+		try:
+			self.call("exit")
+		except (EOFError, IOError, OSError):
+			pass
+		self._process.join(5)
+
+
+##~~ fleet
+
+class FleetInstance(object):
+	def __init__(self, serial, folder, server_url, key, printing, logger):
+		self.serial = serial
+		self.printer = FakePrinter("PRINTING" if printing else "OPERATIONAL")
+		if not printing:
+			self.printer.temperatures = {
+				'tool0': {'actual': 21.0, 'target': 0.0},
+				'bed': {'actual': 20.0, 'target': 0.0}
+			}
+		# a logger of its own, the plugin resets its level from settings
+		self.plugin = make_plugin(folder, printer=self.printer, logger=logger.getChild(serial), key=key,
+			# no OctoPrint API to list system commands from
+			overrides={"service": server_url, "serial": serial, "enable_system_commands": False})
+		self.plugin._get_keys()
+		self.plugin._printer.register_callback(self.plugin._temperatures)
+		self.attempts = []
+
+		# count every connection attempt, including the ones that never reach
+		# the server
+		create_socket = self.plugin._create_socket
+		def counted_create_socket():
+			self.attempts.append(time.time())
+			return create_socket()
+		self.plugin._create_socket = counted_create_socket
+
+	def start(self):
+		self.plugin._start_polar_status()
+
+	# the heartbeat thread gives up for good in some cases, eg. when it was
+	# disconnected before it sent a few statuses
+	@property
+	def alive(self):
+		worker = self.plugin._polar_status_worker
+		return bool(worker and worker.is_alive())
+
+	@property
+	def thread_id(self):
+		worker = self.plugin._polar_status_worker
+		return getattr(worker, "native_id", None) if worker else None
+
+	def stop(self):
+		self.plugin._stop_polar_status()
+		try:
+			if self.plugin._socket:
+				self.plugin._socket.disconnect()
+		except Exception:
+			pass
+
+
+# push slightly noisy temperatures from every printer, like OctoPrint's
+# temperature reports
+def _report_temperatures(instances, stop):
+	while not stop.wait(TEMPERATURE_INTERVAL):
+		for instance in instances:
+			for values in instance.printer.temperatures.values():
+				values['actual'] = round(values['actual'] + random.uniform(-0.3, 0.3), 2)
+			instance.printer.push_temperatures()
+
+
+def _cpu_seconds():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+
+def _rss_bytes():
+	if psutil:
+		return psutil.Process().memory_info().rss
+	# peak rather than current without psutil, kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# CPU seconds used so far by each instance's heartbeat thread
+def _heartbeat_cpu(instances):
+	if not psutil:
+		return {}
+	times = dict((t.id, t.user_time + t.system_time) for t in psutil.Process().threads())
+	return dict((i.serial, times[i.thread_id]) for i in instances if i.thread_id in times)
+
+
+def _first_after(events, name, since):
+	first = {}
+	for when, serial, event_name, size in events:
+		if event_name == name and when >= since and serial not in first:
+			first[serial] = when
+	return first
+
+
+def _spread(values):
+	values = sorted(values)
+	if not values:
+		return "-"
+	pick = lambda f: values[min(len(values) - 1, int(round(f * (len(values) - 1))))]
+	return "min {:.3f}  median {:.3f}  p90 {:.3f}  max {:.3f}".format(
+		values[0], pick(0.5), pick(0.9), values[-1])
+
+
+def _histogram(times, since, out):
+	if not times:
+		return
+	buckets = {}
+	for when in times:
+		bucket = int((when - since) // BUCKET_SECONDS)
+		buckets[bucket] = buckets.get(bucket, 0) + 1
+	peak = max(buckets.values())
+	for bucket in range(min(buckets), max(buckets) + 1):
+		count = buckets.get(bucket, 0)
+		print("    {:>6.1f}s {:>4} {}".format(bucket * BUCKET_SECONDS, count,
+			"#" * int(round(40.0 * count / peak))), file=out)
+
+
+class Fleet(object):
+	def __init__(self, count, printing, folder, logger, out=sys.stdout):
+		self.out = out
+		self.server = StandInProcess()
+		key = RSA.generate(2048)
+		pem = key.export_key("PEM")
+		public_key = key.public_key().export_key().decode("utf-8")
+		self.instances = []
+		rss = _rss_bytes()
+		for i in range(count):
+			serial = "FLEET{:04d}".format(i + 1)
+			self.server.call("register_key", (serial, public_key))
+			self.instances.append(FleetInstance(serial, os.path.join(folder, serial),
+				self.server.url, pem, i < int(round(count * printing)), logger))
+		self.instance_rss = max(0, _rss_bytes() - rss) // max(1, count)
+		self._stop = threading.Event()
+		self._temperatures = threading.Thread(target=_report_temperatures, args=(self.instances, self._stop))
+		self._temperatures.daemon = True
+
+	def _events(self, since=0):
+		return self.server.call("events", since)
+
+	# wait until every instance that's still trying has sent a status since
+	# since, or timeout
+	def _wait_for_statuses(self, since, timeout):
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			statuses = _first_after(self._events(), "status", since)
+			if not any(i.alive and i.serial not in statuses for i in self.instances):
+				return True
+			time.sleep(0.25)
+		return False
+
+	def startup(self, ramp, timeout):
+		rss = _rss_bytes()
+		started = time.time()
+		for instance in self.instances:
+			instance.start()
+			if ramp:
+				time.sleep(ramp / len(self.instances))
+		self._temperatures.start()
+		self._wait_for_statuses(started, timeout)
+		events = self._events()
+		statuses = _first_after(events, "status", started)
+		print("startup", file=self.out)
+		print("  connected {} of {}, last first status after {:.1f}s".format(len(statuses),
+			len(self.instances), max(statuses.values()) - started if statuses else 0), file=self.out)
+		print("  first status (s): " + _spread([t - started for t in statuses.values()]), file=self.out)
+		print("  connects per {}s:".format(BUCKET_SECONDS), file=self.out)
+		_histogram([e[0] for e in events if e[2] == "connect"], started, self.out)
+		rss = max(0, _rss_bytes() - rss) // max(1, len(self.instances))
+		print("  memory per instance: {:,} KiB created, {:,} KiB more once connected{}".format(
+			self.instance_rss // 1024, rss // 1024, "" if psutil else " (peak RSS, psutil not installed)"),
+			file=self.out)
+
+	def steady(self, seconds):
+		since = len(self._events())
+		cpu = _cpu_seconds()
+		heartbeat = _heartbeat_cpu(self.instances)
+		started = time.time()
+		time.sleep(seconds)
+		elapsed = time.time() - started
+		cpu = _cpu_seconds() - cpu
+		heartbeat_now = _heartbeat_cpu(self.instances)
+		events = self._events(since)
+		statuses = [e for e in events if e[2] == "status"]
+		count = len(self.instances)
+		print("\nsteady state ({:.0f}s)".format(elapsed), file=self.out)
+		print("  statuses received: {} ({:.2f}/s, {:.1f} KiB/s), {} uploads".format(len(statuses),
+			len(statuses) / elapsed, sum(e[3] for e in statuses) / 1024.0 / elapsed,
+			sum(1 for e in events if e[2] == "upload")), file=self.out)
+		print("  CPU per instance: {:.3f}% of a core".format(100.0 * cpu / elapsed / count), file=self.out)
+		if heartbeat_now:
+			print("  heartbeat thread CPU (ms per s): " + _spread([1000.0 * (heartbeat_now[s] - heartbeat.get(s, 0)) / elapsed
+				for s in heartbeat_now]), file=self.out)
+
+	def blip(self, outage, timeout):
+		since = len(self._events())
+		dropped = self.server.call("disconnect_all")
+		back = dropped
+		if outage:
+			self.server.call("stop")
+			time.sleep(outage)
+			back = self.server.call("start")
+		self._wait_for_statuses(back, timeout)
+		events = self._events(since)
+		hellos = _first_after(events, "hello", dropped)
+		statuses = _first_after(events, "status", dropped)
+		attempts = [t for i in self.instances for t in i.attempts if t >= dropped]
+		print("\nreconnect after {}".format("a {:.0f}s outage".format(outage) if outage else "the server dropped every printer"),
+			file=self.out)
+		print("  reconnect attempts: {} ({:.1f} per instance)".format(len(attempts),
+			len(attempts) / float(len(self.instances))), file=self.out)
+		print("  reconnected {} of {}".format(len(statuses), len(self.instances)), file=self.out)
+		print("  hello after the server was back (s): " + _spread([t - back for t in hellos.values()]), file=self.out)
+		print("  first status after the server was back (s): " + _spread([t - back for t in statuses.values()]),
+			file=self.out)
+		print("  reconnect attempts per {}s, from the drop:".format(BUCKET_SECONDS), file=self.out)
+		_histogram(attempts, dropped, self.out)
+		print("  connects reaching the server per {}s, from the drop:".format(BUCKET_SECONDS), file=self.out)
+		_histogram([e[0] for e in events if e[2] == "connect"], dropped, self.out)
+		missing = [i for i in self.instances if i.serial not in statuses]
+		if missing:
+			print("  never came back ({}): {}".format(len(missing), ", ".join(i.serial for i in missing)), file=self.out)
+			stopped = [i.serial for i in missing if not i.alive]
+			if stopped:
+				print("  heartbeat thread gave up: {}".format(", ".join(stopped)), file=self.out)
+
+	def close(self):
+		self._stop.set()
+		# a socket.io client takes a few seconds to disconnect, do them together
+		threads = [threading.Thread(target=instance.stop) for instance in self.instances]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(10)
+		self.server.close()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Run many plugin instances against the local Polar Cloud stand-in.")
+	parser.add_argument("--instances", type=int, default=20, help="number of plugin instances")
+	parser.add_argument("--printing", type=float, default=0.5, help="fraction of the printers that are printing")
+	parser.add_argument("--ramp", type=float, default=0,
+		help="seconds to spread starting the instances over, 0 starts them all at once")
+	parser.add_argument("--steady", type=float, default=30, help="seconds of steady state to measure")
+	parser.add_argument("--outage", type=float, default=0,
+		help="seconds the server stays away after dropping everyone, 0 to only drop the connections")
+	parser.add_argument("--timeout", type=float, default=120,
+		help="seconds to wait for the fleet to (re)connect")
+	parser.add_argument("--verbose", action="store_true", help="show the plugins' log")
+	args = parser.parse_args(argv)
+
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+	logger = logging.getLogger("fleet")
+	if not args.verbose:
+		# with dozens of instances failing to connect at once the log drowns
+		# out the report
+		logger.setLevel(logging.CRITICAL)
+		for name in ("socketio", "engineio", "werkzeug"):
+			logging.getLogger(name).setLevel(logging.CRITICAL)
+
+	folder = tempfile.mkdtemp(prefix="polarcloud-fleet-")
+	fleet = None
+	try:
+		fleet = Fleet(args.instances, args.printing, folder, logger)
+		print("fleet of {} instances, {} printing\n".format(args.instances,
+			int(round(args.instances * args.printing))))
+		fleet.startup(args.ramp, args.timeout)
+		fleet.steady(args.steady)
+		fleet.blip(args.outage, args.timeout)
+	finally:
+		if fleet:
+			fleet.close()
+		shutil.rmtree(folder, ignore_errors=True)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
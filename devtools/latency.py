@@ -0,0 +1,176 @@
+# coding=utf-8
+# End to end latencies of one plugin talking to the local Polar Cloud
+# stand-in.  Run from the repository root:
+#
+#     python -m devtools.latency --rounds 5 --uplink-kbps 512
+#
+# Measures, as seen from the server:
+#   connect            plugin start to the first status
+#   print -> printing  print command to a status reporting PSTATE_PRINTING
+#   command -> status  pause/resume command to the status reporting it
+#   cancel -> job      cancel command to the "canceled" job message
+#   snapshot upload    getUrlResponse to the uploaded snapshot, and the
+#                      throughput of the upload itself over the uplink
+# See README-DEV.md.
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from octoprint_polarcloud import PolarStateMachine
+from devtools.fakes import FakePrinter, make_plugin
+from devtools.standin import PolarStandIn
+
+SERIAL = "LATENCY1"
+
+# a small but not trivial gcode file to download for each print
+GCODE = b"G28\nG1 Z0.3 F3000\n" + b"".join(
+	"G1 X{:.2f} Y{:.2f} E{:.4f}\n".format(10 + i % 180, 10 + (i * 7) % 180, i * 0.0421).encode("ascii")
+	for i in range(20000))
+
+
+def _is_status(pstate, job_id=None):
+	def match(event):
+		return (event.name == "status" and event.data.get("status") == pstate and
+			(job_id is None or event.data.get("jobId") == job_id))
+	return match
+
+
+def _is_event(name, **fields):
+	def match(event):
+		return event.name == name and all(event.data.get(k) == v for k, v in fields.items())
+	return match
+
+
+class LatencyHarness(object):
+	def __init__(self, folder, uplink_bps=None, snapshot_bytes=64 * 1024, timeout=60):
+		self.timeout = timeout
+		self.results = {}
+		self.server = PolarStandIn(uplink_bps=uplink_bps, snapshot_bytes=snapshot_bytes).start()
+		self.server.add_file("print.gcode", GCODE)
+		self.printer = FakePrinter()
+		self.plugin = make_plugin(folder, printer=self.printer,
+			# no OctoPrint API to list system commands from
+			overrides={"service": self.server.url, "serial": SERIAL, "enable_system_commands": False},
+			global_settings={("webcam", "snapshot"): self.server.snapshot_url})
+
+	def _add(self, name, seconds):
+		self.results.setdefault(name, []).append(seconds)
+
+	# send a command and wait for the event it should cause, returns seconds
+	def _round_trip(self, name, command, data, match):
+		since = self.server.mark()
+		started = time.time()
+		self.server.send(SERIAL, command, data)
+		event = self.server.wait_for(match, since, self.timeout)
+		if event is None:
+			raise RuntimeError("no answer to {} within {} seconds".format(command, self.timeout))
+		self._add(name, event.time - started)
+		return event
+
+	def connect(self):
+		plugin = self.plugin
+		plugin._get_keys()
+		self.server.register_key(SERIAL, plugin._public_key)
+		plugin._printer.register_callback(plugin._temperatures)
+		started = time.time()
+		plugin._start_polar_status()
+		for name, match in (("connect: socket", _is_event("connect")),
+				("connect: hello", _is_event("hello", serialNumber=SERIAL)),
+				("connect: first status", _is_event("status"))):
+			event = self.server.wait_for(match, 0, self.timeout)
+			if event is None:
+				raise RuntimeError("plugin didn't get to {} within {} seconds".format(name, self.timeout))
+			self._add(name, event.time - started)
+		hello = self.server.wait_for(_is_event("hello"), 0, 0)
+		if hello.data.get("verified") is not True:
+			raise RuntimeError("hello signature didn't verify")
+
+	def print_round(self, job_id):
+		self._round_trip("print -> printing", "print",
+			{"gcodeFile": self.server.file_url("print.gcode"), "jobId": job_id},
+			_is_status(PolarStateMachine.PSTATE_PRINTING, job_id))
+		self._round_trip("command -> status (pause)", "pause", {},
+			_is_status(PolarStateMachine.PSTATE_PAUSED))
+		self._round_trip("command -> status (resume)", "resume", {},
+			_is_status(PolarStateMachine.PSTATE_PRINTING))
+		self._round_trip("cancel -> job canceled", "cancel", {},
+			_is_event("job", jobId=job_id, state="canceled"))
+
+	def snapshot_round(self):
+		event = self._round_trip("getUrl -> snapshot uploaded", "getUrlResponse",
+			self.server.upload_location(SERIAL, "idle"), _is_event("upload", type="idle"))
+		self.results.setdefault("_uploads", []).append(event.data)
+
+	def close(self):
+		self.plugin._stop_polar_status()
+		since = self.server.mark()
+		try:
+			if self.plugin._socket:
+				self.plugin._socket.disconnect()
+				self.server.wait_for(_is_event("disconnect"), since, 5)
+		except Exception:
+			pass
+		self.server.stop()
+
+
+def _percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def report(results, out=sys.stdout):
+	header = "{:<32} {:>5} {:>9} {:>9} {:>9}".format("latency (ms)", "n", "min", "median", "max")
+	print(header, file=out)
+	print("-" * len(header), file=out)
+	for name, values in results.items():
+		if name.startswith("_"):
+			continue
+		print("{:<32} {:>5} {:>9.1f} {:>9.1f} {:>9.1f}".format(name, len(values),
+			min(values) * 1000, _percentile(values, 0.5) * 1000, max(values) * 1000), file=out)
+	uploads = results.get("_uploads")
+	if uploads:
+		total = sum(u["bytes"] for u in uploads)
+		seconds = sum(u["seconds"] for u in uploads)
+		print("\nsnapshot uploads: {} of {:,} bytes, {:.1f} kbit/s over the uplink".format(
+			len(uploads), total // len(uploads), total * 8 / 1000.0 / seconds if seconds else 0), file=out)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Measure end to end latencies against the local Polar Cloud stand-in.")
+	parser.add_argument("--rounds", type=int, default=3, help="print and snapshot rounds")
+	parser.add_argument("--uplink-kbps", type=float, default=0,
+		help="simulated uplink for uploads in kbit/s, 0 for unlimited")
+	parser.add_argument("--snapshot-kb", type=int, default=64, help="webcam snapshot size in KiB")
+	parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each answer")
+	parser.add_argument("--verbose", action="store_true", help="log the plugin at debug level")
+	args = parser.parse_args(argv)
+
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+	if not args.verbose:
+		# a line per request, and complaints about websocket frames that
+		# arrive after the server closed the socket
+		logging.getLogger("werkzeug").setLevel(logging.CRITICAL)
+	folder = tempfile.mkdtemp(prefix="polarcloud-latency-")
+	harness = LatencyHarness(folder,
+		uplink_bps=args.uplink_kbps * 1000 / 8 if args.uplink_kbps else None,
+		snapshot_bytes=args.snapshot_kb * 1024, timeout=args.timeout)
+	try:
+		harness.connect()
+		for i in range(args.rounds):
+			harness.print_round("LT{}".format(i + 1))
+		for i in range(args.rounds):
+			harness.snapshot_round()
+	finally:
+		harness.close()
+		shutil.rmtree(folder, ignore_errors=True)
+	report(harness.results)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,316 @@
+# coding=utf-8
+# A local stand-in for the Polar Cloud service: a socket.io server speaking
+# enough of the printer protocol (welcome/hello, status, getUrl, print, job,
+# ...) for the plugin to run against it, plus the HTTP side the plugin
+# downloads print files from and posts S3 style form uploads to.
+#
+#     server = PolarStandIn(uplink_bps=256 * 1024 / 8)
+#     server.start()
+#     plugin = make_plugin(folder, overrides={"service": server.url, ...})
+#     ...
+#     server.send(serial, "print", {"gcodeFile": server.file_url("cube.gcode")})
+#     server.wait_for(lambda e: e.name == "status" and e.data["status"] == "3")
+#
+# Every message from a printer, every connect and disconnect and every upload
+# is recorded as a StandInEvent, see events and wait_for.  See README-DEV.md.
+from __future__ import absolute_import
+
+import base64
+import collections
+import os
+import threading
+import time
+import uuid
+
+import socketio
+from werkzeug.serving import make_server
+
+try:
+	from Cryptodome.Hash import SHA256
+	from Cryptodome.PublicKey import RSA
+	from Cryptodome.Signature import pkcs1_15
+except ImportError:
+	from Crypto.Hash import SHA256
+	from Crypto.PublicKey import RSA
+	from Crypto.Signature import pkcs1_15
+
+StandInEvent = collections.namedtuple("StandInEvent", "time serial name data")
+
+_CHUNK_SIZE = 16 * 1024
+
+
+class PolarStandIn(object):
+	# uplink_bps - bytes per second each upload is read at, None for as fast
+	#	as possible, to simulate a slow printer uplink
+	# capabilities - sent in capabilitiesResponse
+	# snapshot_bytes - size of the frames served as the webcam snapshot, each
+	#	one is different so none are skipped as unchanged
+	def __init__(self, host="127.0.0.1", port=0, uplink_bps=None,
+			capabilities=None, url_expires=3600, max_size=10 * 1024 * 1024,
+			snapshot_bytes=64 * 1024, logger=False):
+		self.uplink_bps = uplink_bps
+		self.capabilities = capabilities if capabilities is not None else {"statusDelta": True}
+		self.url_expires = url_expires
+		self.max_size = max_size
+		self.snapshot_bytes = snapshot_bytes
+		self.events = []
+		self._files = {}
+		self._public_keys = {}
+		self._sids = {}
+		self._serials = {}
+		self._challenges = {}
+		self._condition = threading.Condition()
+		self._host = host
+		self._port = port
+		self._server = None
+		self._thread = None
+
+		self.sio = socketio.Server(async_mode="threading", logger=logger, engineio_logger=logger)
+		self.sio.on("connect", self._on_connect)
+		self.sio.on("disconnect", self._on_disconnect)
+		for name in ("hello", "status", "getUrl", "job", "register", "unregister",
+				"capabilities", "setVersion", "customCommandList", "sendNextPrint"):
+			self.sio.on(name, getattr(self, "_on_" + name))
+		self.app = socketio.WSGIApp(self.sio, self._http)
+
+	@property
+	def url(self):
+		return "http://{}:{}".format(self._host, self._port)
+
+	def start(self):
+		self._server = make_server(self._host, self._port, self.app, threaded=True)
+		self._port = self._server.server_port
+		self._thread = threading.Thread(target=self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		if self._server:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+
+	##~~ recording
+
+	def _record(self, serial, name, data=None):
+		event = StandInEvent(time.time(), serial, name, data)
+		with self._condition:
+			self.events.append(event)
+			self._condition.notify_all()
+		return event
+
+	# index to pass to wait_for to only look at events after now
+	def mark(self):
+		with self._condition:
+			return len(self.events)
+
+	# the first event from index since on for which match(event) is true,
+	# waiting up to timeout seconds for it, None if it never came
+	def wait_for(self, match, since=0, timeout=30):
+		deadline = time.time() + timeout
+		with self._condition:
+			while True:
+				for event in self.events[since:]:
+					if match(event):
+						return event
+				since = len(self.events)
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return None
+				self._condition.wait(remaining)
+
+	def connected_serials(self):
+		with self._condition:
+			return list(self._sids)
+
+	##~~ talking to printers
+
+	# send a command to the printer with serial, serialNumber is filled in
+	def send(self, serial, name, data=None):
+		data = dict(data or {})
+		data.setdefault("serialNumber", serial)
+		sid = self._sids.get(serial)
+		if sid is None:
+			raise KeyError("printer {} isn't connected".format(serial))
+		self.sio.emit(name, data, to=sid)
+
+	# the upload location answering getUrl for serial
+	def upload_location(self, serial, upload_type, job_id="123"):
+		key = "{}/{}/{}.{}".format(serial, upload_type, uuid.uuid4().hex,
+			"mp4" if upload_type == "timelapse" else "jpg")
+		return {
+			"serialNumber": serial,
+			"status": "SUCCESS",
+			"type": upload_type,
+			"jobID": job_id,
+			"url": "{}/upload/{}/{}".format(self.url, serial, upload_type),
+			"fields": {"key": key, "acl": "private", "policy": "stand-in"},
+			"maxSize": self.max_size,
+			"expires": self.url_expires
+		}
+
+	# check hello signatures from serial against public_key (PEM)
+	def register_key(self, serial, public_key):
+		self._public_keys[serial] = RSA.import_key(public_key)
+
+	def disconnect(self, serial):
+		sid = self._sids.get(serial)
+		if sid is not None:
+			self.sio.disconnect(sid)
+
+	# drop every printer at once, like a network blip would
+	def disconnect_all(self):
+		for sid in list(self._serials):
+			self.sio.disconnect(sid)
+
+	##~~ socket.io handlers
+
+	def _on_connect(self, sid, environ, auth=None):
+		challenge = base64.b64encode(os.urandom(24)).decode("ascii")
+		self._challenges[sid] = challenge
+		self._record(None, "connect", {"sid": sid})
+		self.sio.emit("welcome", {"challenge": challenge}, to=sid)
+
+	def _on_disconnect(self, sid, *args):
+		serial = self._serials.pop(sid, None)
+		if serial and self._sids.get(serial) == sid:
+			del self._sids[serial]
+		self._challenges.pop(sid, None)
+		self._record(serial, "disconnect", {"sid": sid})
+
+	def _serial_for(self, sid, data):
+		return self._serials.get(sid) or (data or {}).get("serialNumber")
+
+	def _on_hello(self, sid, data):
+		serial = data.get("serialNumber")
+		verified = self._verify(serial, self._challenges.pop(sid, None), data.get("signature"))
+		if verified is False:
+			self._record(serial, "hello", dict(data, verified=False))
+			self.sio.disconnect(sid)
+			return
+		self._sids[serial] = sid
+		self._serials[sid] = serial
+		self._record(serial, "hello", dict(data, verified=verified))
+
+	# True if the signature checks out against the key the printer registered
+	# with, None if we haven't seen its key, False if it doesn't match
+	def _verify(self, serial, challenge, signature):
+		key = self._public_keys.get(serial)
+		if key is None:
+			return None
+		try:
+			pkcs1_15.new(key).verify(SHA256.new(challenge.encode("utf-8")), base64.b64decode(signature))
+			return True
+		except (ValueError, TypeError, AttributeError):
+			return False
+
+	def _on_status(self, sid, data):
+		self._record(self._serial_for(sid, data), "status", data)
+		# the plugin waits for this ack before sending deltas
+		return True
+
+	def _on_getUrl(self, sid, data):
+		serial = self._serial_for(sid, data)
+		self._record(serial, "getUrl", data)
+		self.sio.emit("getUrlResponse", self.upload_location(serial,
+			data.get("type", "idle"), data.get("jobId", "123")), to=sid)
+
+	def _on_register(self, sid, data):
+		serial = "SI" + uuid.uuid4().hex[:10].upper()
+		try:
+			self._public_keys[serial] = RSA.import_key(data.get("publicKey", ""))
+		except (ValueError, TypeError, IndexError):
+			pass
+		self._record(serial, "register", data)
+		self.sio.emit("registerResponse", {"serialNumber": serial, "status": "SUCCESS"}, to=sid)
+
+	def _on_unregister(self, sid, data):
+		serial = self._serial_for(sid, data)
+		self._public_keys.pop(serial, None)
+		self._record(serial, "unregister", data)
+		self.sio.emit("unregisterResponse", {"serialNumber": serial, "status": "SUCCESS"}, to=sid)
+
+	def _on_capabilities(self, sid, data):
+		self._record(self._serial_for(sid, data), "capabilities", data)
+		self.sio.emit("capabilitiesResponse", {"serialNumber": data.get("serialNumber"),
+			"capabilities": self.capabilities}, to=sid)
+
+	def _on_job(self, sid, data):
+		self._record(self._serial_for(sid, data), "job", data)
+
+	def _on_setVersion(self, sid, data):
+		self._record(self._serial_for(sid, data), "setVersion", data)
+
+	def _on_customCommandList(self, sid, data):
+		self._record(self._serial_for(sid, data), "customCommandList", data)
+
+	def _on_sendNextPrint(self, sid, data):
+		self._record(self._serial_for(sid, data), "sendNextPrint", data)
+
+	##~~ HTTP
+
+	# serve content (bytes) at file_url(name)
+	def add_file(self, name, content):
+		self._files[name] = content
+
+	def file_url(self, name):
+		return "{}/files/{}".format(self.url, name)
+
+	@property
+	def snapshot_url(self):
+		return "{}/webcam/snapshot.jpg".format(self.url)
+
+	def _http(self, environ, start_response):
+		method = environ["REQUEST_METHOD"]
+		path = environ.get("PATH_INFO", "")
+		parts = path.strip("/").split("/")
+		if method == "GET" and parts[0] == "files" and len(parts) == 2 and parts[1] in self._files:
+			return self._respond(start_response, "200 OK", self._files[parts[1]], "application/octet-stream")
+		if method == "GET" and path == "/webcam/snapshot.jpg":
+			# a JPEG marker and noise, PIL can't decode it so the plugin uploads it as is
+			frame = b"\xff\xd8\xff\xe0" + os.urandom(max(0, self.snapshot_bytes - 4))
+			return self._respond(start_response, "200 OK", frame, "image/jpeg")
+		if method == "POST" and parts[0] == "upload" and len(parts) == 3:
+			return self._upload(environ, start_response, parts[1], parts[2])
+		return self._respond(start_response, "404 Not Found", b"not found", "text/plain")
+
+	def _respond(self, start_response, status, body, content_type):
+		start_response(status, [("Content-Type", content_type), ("Content-Length", str(len(body)))])
+		return [body]
+
+	# read the form post at uplink_bps, recording its size and how long it took
+	def _upload(self, environ, start_response, serial, upload_type):
+		if not environ.get("CONTENT_TYPE", "").startswith("multipart/form-data"):
+			return self._respond(start_response, "400 Bad Request", b"expected a form post", "text/plain")
+		length = environ.get("CONTENT_LENGTH")
+		remaining = int(length) if length else None
+		stream = environ["wsgi.input"]
+		started = time.time()
+		received = 0
+		head = b""
+		while remaining is None or remaining > 0:
+			chunk = stream.read(_CHUNK_SIZE if remaining is None else min(_CHUNK_SIZE, remaining))
+			if not chunk:
+				break
+			received += len(chunk)
+			if remaining is not None:
+				remaining -= len(chunk)
+			if len(head) < 4096:
+				head += chunk[:4096 - len(head)]
+			if self.uplink_bps:
+				delay = started + float(received) / self.uplink_bps - time.time()
+				if delay > 0:
+					time.sleep(delay)
+		seconds = time.time() - started
+		self._record(serial, "upload", {
+			"type": upload_type,
+			"bytes": received,
+			"seconds": seconds,
+			"chunked": length is None,
+			"has_key": b'name="key"' in head
+		})
+		if received > self.max_size + 64 * 1024:
+			return self._respond(start_response, "400 Bad Request", b"EntityTooLarge", "text/plain")
+		start_response("204 No Content", [])
+		return []
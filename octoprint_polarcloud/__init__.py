@@ -25,20 +25,25 @@ __copyright__ = "Copyright (C) 2017 Mark Walker"
 
 import os
 import sys
+import shutil
+import collections
+import heapq
 import stat
 import threading
 import logging
 import uuid
-from functools import reduce
+from functools import reduce, partial
 try:
 	import queue
 except ImportError:
 	import Queue as queue
 import base64
 import datetime
+import hashlib
+import time
 from time import sleep
 import io
-from io import StringIO, BytesIO
+from io import BytesIO
 try:
 	from urllib.parse import urlparse, urlunparse
 except ImportError:
@@ -46,6 +51,8 @@ except ImportError:
 import random
 import re
 import json
+import math
+import struct
 
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Signature import pkcs1_15
@@ -56,118 +63,490 @@ import sarge
 import flask
 from flask_babel import gettext, _
 import requests
+from requests.adapters import HTTPAdapter
+try:
+	from urllib3.util.retry import Retry
+except ImportError:
+	from requests.packages.urllib3.util.retry import Retry
 try:
 	from PIL import Image
 	_pillow_available = True
 except ImportError:
 	_pillow_available = False
+try:
+	import numpy
+	_numpy_available = True
+except ImportError:
+	_numpy_available = False
 
 import subprocess
 import tempfile
 
-def _find_ffmpeg():
-	"""Find ffmpeg in common paths, returns path or None if not found."""
-	common_paths = [
-		"/ac_lib/lib/third_bin/ffmpeg",  # Anycubic Kobra
-		"/usr/bin/ffmpeg",
-		"/usr/local/bin/ffmpeg",
-		"/opt/bin/ffmpeg",
-		"/opt/local/bin/ffmpeg",
-	]
+_monotonic = getattr(time, 'monotonic', time.time)
+
+def _find_tool(name, extra_paths=()):
+	"""Find an executable in common paths or on PATH, returns path or None if not found."""
+	common_paths = list(extra_paths) + [os.path.join(folder, name) for folder in
+			["/usr/bin", "/usr/local/bin", "/opt/bin", "/opt/local/bin"] +
+			os.environ.get("PATH", "").split(os.pathsep) if folder]
 	for path in common_paths:
 		if os.path.isfile(path) and os.access(path, os.X_OK):
 			return path
 	return None
 
+def _find_ffmpeg():
+	"""Find ffmpeg in common paths, returns path or None if not found."""
+	return _find_tool("ffmpeg", ["/ac_lib/lib/third_bin/ffmpeg"])  # Anycubic Kobra
+
 _ffmpeg_path = _find_ffmpeg()
+_ffprobe_path = _find_tool("ffprobe",
+		[os.path.join(os.path.dirname(_ffmpeg_path), "ffprobe")] if _ffmpeg_path else [])
+_gst_launch_path = _find_tool("gst-launch-1.0")
+
+# find the best rung of a quality ladder (ordered from best quality/largest
+# output to smallest) whose encoded result fits, starting from rung start.
+# Assumes output size shrinks going down the ladder, so it gallops away from
+# start and then bisects, which takes a couple of encodes when start was
+# right last time and O(log n) encodes otherwise. Returns (index, result) of
+# the best rung that fits, or of the last rung if none do.
+def search_ladder(count, encode, fits, start=0):
+	results = {}
+	def _fits(i):
+		if not i in results:
+			results[i] = encode(i)
+		return fits(results[i])
+
+	start = min(max(start, 0), count - 1)
+	step = 1
+	if _fits(start):
+		good, bad = start, -1
+		while good - step > bad:
+			if _fits(good - step):
+				good -= step
+				step *= 2
+			else:
+				bad = good - step
+	else:
+		good, bad = count, start
+		while good == count and bad < count - 1:
+			i = min(bad + step, count - 1)
+			if _fits(i):
+				good = i
+			else:
+				bad = i
+				step *= 2
+	while good - bad > 1:
+		mid = (good + bad) // 2
+		if _fits(mid):
+			good = mid
+		else:
+			bad = mid
+	if good == count:
+		good = count - 1
+		_fits(good)
+	return good, results[good]
 
-def _resize_image_ffmpeg(image_bytes, max_size, logger):
+class PolarFfmpegCompressor(object):
 	"""
-	Resize/compress image using ffmpeg when PIL is not available.
-	Tries lowering JPEG quality first, then scales down if needed.
-	Returns compressed image bytes or original if ffmpeg unavailable/fails.
+	Compress JPEG snapshots with ffmpeg when PIL is not available. Each encode
+	is a single ffmpeg process fed through stdin/stdout, no temp files, and the
+	rung that worked last time is where the next search starts.
 	"""
-	if not _ffmpeg_path:
-		return image_bytes
-
-	# Quality levels to try (lower = better quality, higher = more compression)
-	quality_levels = [5, 10, 15, 20, 25, 31]
-	# Scale widths to try if quality adjustment isn't enough
-	scale_widths = [640, 480, 320]
+	# (scale width, -q:v) from best quality to smallest, lowering the quality
+	# before scaling down
+	LADDER = [(width, quality) for width in [None, 640, 480, 320]
+			for quality in [5, 10, 15, 20, 25, 31]]
 
-	with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as infile:
-		infile.write(image_bytes)
-		infile_path = infile.name
+	def __init__(self, ffmpeg_path, logger):
+		self._ffmpeg_path = ffmpeg_path
+		self._logger = logger
+		self._last_index = {}
+
+	def compress(self, image_bytes, max_size, key=None):
+		"""
+		Returns compressed image bytes or image_bytes if ffmpeg fails. The
+		search remembers where it ended separately for each key (upload type).
+		"""
+		index, compressed = search_ladder(len(self.LADDER),
+				lambda i: self._encode(image_bytes, *self.LADDER[i]),
+				lambda result: result is not None and len(result) <= max_size,
+				self._last_index.get(key, 0))
+		if compressed is None:
+			self._logger.warning("ffmpeg could not compress image")
+			return image_bytes
+		self._last_index[key] = index
+		width, quality = self.LADDER[index]
+		if len(compressed) > max_size:
+			self._logger.warning("ffmpeg could not compress image below max size {}".format(max_size))
+		else:
+			self._logger.debug("ffmpeg compressed image to {} bytes with quality {} and width {}".format(
+				len(compressed), quality, width))
+		return compressed
+
+	def _encode(self, image_bytes, width, quality):
+		cmd = [self._ffmpeg_path, '-hide_banner', '-loglevel', 'error',
+				'-i', 'pipe:0']
+		if width:
+			cmd += ['-vf', 'scale={}:-1'.format(width)]
+		cmd += ['-q:v', str(quality), '-frames:v', '1',
+				'-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1']
+		try:
+			result = subprocess.run(cmd, input=image_bytes, capture_output=True, timeout=30)
+			if result.returncode == 0 and result.stdout:
+				return result.stdout
+			self._logger.warning("ffmpeg compression failed ({}): {}".format(
+				result.returncode, result.stderr.decode('utf-8', 'replace').strip()))
+		except subprocess.TimeoutExpired:
+			self._logger.warning("ffmpeg timed out during compression")
+		except Exception as e:
+			self._logger.warning("ffmpeg compression failed: {}".format(e))
+		return None
 
-	try:
-		# First try quality reduction without scaling
-		for quality in quality_levels:
-			with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as outfile:
-				outfile_path = outfile.name
+class PolarJpegEncoder(object):
+	"""
+	Scale, transform and re-encode JPEG snapshots with PIL to fit under a
+	maximum size, starting from the size and quality that worked last time
+	for the same upload type.
+	"""
+	# (bounding box, JPEG quality) from best quality to smallest
+	LADDER = [(size, quality) for size in [(640, 480), (480, 360), (320, 240)]
+			for quality in [85, 70, 55, 40, 25]]
 
+	def __init__(self, logger):
+		self._logger = logger
+		self._last_index = {}
+
+	def compress(self, image_bytes, max_size, key=None, transforms=()):
+		image = Image.open(BytesIO(image_bytes))
+		# let the JPEG decoder scale down in the DCT domain (1/2, 1/4, 1/8) to
+		# no smaller than the largest size we'd send, rather than decoding the
+		# full resolution frame only to throw most of it away
+		image.draft('RGB', self.LADDER[0][0])
+		if image.mode not in ('RGB', 'L'):
+			image = image.convert('RGB')
+
+		scaled = {}
+		def _encode(i):
+			size, quality = self.LADDER[i]
+			if not size in scaled:
+				scaled_image = image.copy()
+				scaled_image.thumbnail(size)
+				for transform in transforms:
+					scaled_image = scaled_image.transpose(transform)
+				scaled[size] = scaled_image
+			output = BytesIO()
+			scaled[size].save(output, format="jpeg", quality=quality)
+			return output.getvalue()
+
+		index, compressed = search_ladder(len(self.LADDER), _encode,
+				lambda result: len(result) <= max_size,
+				self._last_index.get(key, 0))
+		self._last_index[key] = index
+		size, quality = self.LADDER[index]
+		self._logger.debug("PIL encoded {} at {} quality {}".format(key, size, quality))
+		return compressed
+
+class PolarSnapshotChangeDetector(object):
+	"""
+	Decides whether an idle webcam frame is different enough from the last one
+	sent to be worth encoding and uploading. With PIL a 64 bit difference hash
+	of a tiny grayscale copy is compared, so sensor noise and JPEG artifacts
+	don't count as change; without PIL only byte-identical frames are
+	considered unchanged.
+	"""
+	def __init__(self, threshold=4, max_staleness=600):
+		self._last = {}
+		self.configure(threshold, max_staleness)
+		self.sent = 0
+		self.skipped = 0
+
+	# threshold - number of differing hash bits (out of 64) still considered
+	#	the same frame
+	# max_staleness - seconds after which a frame is sent even if unchanged,
+	#	0 to send every frame
+	def configure(self, threshold, max_staleness):
+		self._threshold = threshold
+		self._max_staleness = max_staleness
+
+	def fingerprint(self, image_bytes):
+		if _pillow_available:
 			try:
-				cmd = [
-					_ffmpeg_path, '-y', '-i', infile_path,
-					'-q:v', str(quality),
-					outfile_path
-				]
-				result = subprocess.run(cmd, capture_output=True, timeout=30)
-				if result.returncode == 0 and os.path.exists(outfile_path):
-					with open(outfile_path, 'rb') as f:
-						compressed = f.read()
-					if len(compressed) <= max_size:
-						logger.debug("ffmpeg compressed image to {} bytes with quality {}".format(
-							len(compressed), quality))
-						return compressed
-			except subprocess.TimeoutExpired:
-				logger.warning("ffmpeg timed out during quality compression")
-			except Exception as e:
-				logger.warning("ffmpeg quality compression failed: {}".format(e))
-			finally:
-				try:
-					os.unlink(outfile_path)
-				except:
-					pass
+				image = Image.open(BytesIO(image_bytes))
+				image.draft('L', (72, 64))
+				pixels = list(image.convert('L').resize((9, 8)).getdata())
+				bits = 0
+				for row in range(8):
+					for col in range(8):
+						bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+				return bits
+			except Exception:
+				pass
+		return hashlib.sha1(image_bytes).hexdigest()
+
+	def is_changed(self, key, fingerprint):
+		last = self._last.get(key)
+		if last is None or not self._max_staleness or _monotonic() - last[1] >= self._max_staleness:
+			return True
+		if not isinstance(fingerprint, str) and not isinstance(last[0], str):
+			return bin(fingerprint ^ last[0]).count('1') > self._threshold
+		return fingerprint != last[0]
+
+	def skip(self):
+		self.skipped += 1
+
+	def mark_sent(self, key, fingerprint):
+		self.sent += 1
+		self._last[key] = (fingerprint, _monotonic())
+
+	def stats(self):
+		return {'sent': self.sent, 'skipped': self.skipped}
+
+# parse the INI style slicing profile Polar Cloud sends in one pass. Option
+# names are lowercased, a value opening with """ continues to the line
+# holding the closing """ (comment lines in between are dropped, as
+# ConfigParser did), and values are converted to int, float, float from a
+# percentage or left as str in that order of preference
+def parse_polar_profile(text):
+	options = collections.OrderedDict()
+	lines = iter(text.splitlines())
+	for line in lines:
+		stripped = line.strip()
+		if not stripped or stripped[0] in '#;[':
+			continue
+		separators = [i for i in (stripped.find('='), stripped.find(':')) if i > 0]
+		if not separators:
+			continue
+		key = stripped[:min(separators)].strip().lower()
+		value = stripped[min(separators) + 1:].strip()
+		if value.count('"""') == 1:
+			parts = [value]
+			for line in lines:
+				part = line.strip()
+				if not part[:1] in ('#', ';'):
+					parts.append(part)
+				if '"""' in line:
+					break
+			value = '\n'.join(parts)
+		options[key] = _parse_profile_value(value)
+	return options
 
-		# If quality reduction wasn't enough, try scaling down
-		for width in scale_widths:
-			for quality in quality_levels:
-				with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as outfile:
-					outfile_path = outfile.name
+def _parse_profile_value(value):
+	for convert in (int, float):
+		try:
+			return convert(value)
+		except ValueError:
+			pass
+	if value.endswith('%'):
+		try:
+			return float(value[:-1])
+		except ValueError:
+			pass
+	return value
 
-				try:
-					cmd = [
-						_ffmpeg_path, '-y', '-i', infile_path,
-						'-vf', 'scale={}:-1'.format(width),
-						'-q:v', str(quality),
-						outfile_path
-					]
-					result = subprocess.run(cmd, capture_output=True, timeout=30)
-					if result.returncode == 0 and os.path.exists(outfile_path):
-						with open(outfile_path, 'rb') as f:
-							compressed = f.read()
-						if len(compressed) <= max_size:
-							logger.debug("ffmpeg compressed image to {} bytes with quality {} and width {}".format(
-								len(compressed), quality, width))
-							return compressed
-				except subprocess.TimeoutExpired:
-					logger.warning("ffmpeg timed out during scale compression")
-				except Exception as e:
-					logger.warning("ffmpeg scale compression failed: {}".format(e))
-				finally:
-					try:
-						os.unlink(outfile_path)
-					except:
-						pass
+_START_GCODE_PREFIX = "(@ignore {print_temperature})\n(@ignore {print_bed_temperature})\n"
+
+class PolarSlicingProfileTranslator(object):
+	"""
+	Translates a Polar Cloud slicing profile into a CuraEngine Legacy
+	slicing profile for OctoPrint. OPTIONS maps each Polar option to the
+	OctoPrint profile key it sets and a translation taking the value and the
+	_ProfileBasis the other options are relative to, a key of None drops the
+	option. Options with side effects on several keys are handled in
+	translate().
+	"""
 
-		logger.warning("ffmpeg could not compress image below max size {}".format(max_size))
-		return image_bytes
+	# values a few translations depend on, worked out before the rest
+	class _ProfileBasis(object):
+		__slots__ = ('extrusion_width', 'layer_height', 'init_layer_height', 'support')
+
+		def __init__(self, options, nozzle_diameter):
+			self.extrusion_width = nozzle_diameter
+			if 'extrusionwidth' in options:
+				self.extrusion_width = options['extrusionwidth'] / 1000.0
+			elif 'extrusion_width' in options:
+				self.extrusion_width = float(options['extrusion_width'])
+			self.layer_height = 0.2
+			if 'layerthickness' in options:
+				self.layer_height = options['layerthickness'] / 1000.0
+			elif 'layer_height' in options:
+				self.layer_height = float(options['layer_height'])
+			self.init_layer_height = self.layer_height
+			if 'initiallayerthickness' in options:
+				self.init_layer_height = options['initiallayerthickness'] / 1000.0
+			elif 'first_layer_height' in options:
+				self.init_layer_height = float(options['first_layer_height'])
+			self.support = "None"
+			if options.get('support_material'):
+				self.support = "Touching Buildplate"
+
+	# plain functions rather than staticmethods so OPTIONS can call them,
+	# they're removed from the class once it's built
+	mm_from_um = lambda x, basis: x / 1000.0
+	no_translation = lambda x, basis: x
+	width_from_line_count = lambda x, basis: x * basis.extrusion_width
+	height_from_layer_count = lambda x, basis: x * basis.layer_height
+	bool_from_int = lambda x, basis: not not x
+	fill_from_line_distance = lambda x, basis: 100.0 * basis.extrusion_width / (x / 1000.0)
+	OPTIONS = {
+		"layerthickness":       ("layer_height",       mm_from_um),
+		"layer_height":         ("layer_height",       no_translation),
+		"printspeed":           ("print_speed",        no_translation),
+		"print_speed":          ("print_speed",        no_translation),
+		"perimeter_speed":      ("print_speed",        no_translation),
+		"supporttype":          ("support_type",       lambda x, basis: "lines" if x == 0 else "grid"),
+		"support_material":     ("support",            lambda x, basis: "None" if x == 0 else "Touching Buildplate"),
+		"fill_pattern":         (None, None),          # octoprint and legacy cura only support lines and grid
+		"infillspeed":          ("infill_speed",       no_translation),
+		"infill_speed":         ("infill_speed",       no_translation),
+		"solid_infill_speed":   (None, None),          # not sure where to send this one
+		"solidtopinfillspeed":  (None, None),          # not sure where to send this one
+		"infilloverlap":        ("fill_overlap",       no_translation),
+		"infill_overlap":       ("fill_overlap",       no_translation),
+		"filamentdiameter":     ("filament_diameter",  lambda x, basis: [x / 1000.0] * 4),
+		"filament_diameter":    ("filament_diameter",  lambda x, basis: [x] * 4),
+		"filamentflow":         ("filament_flow",      no_translation),
+		"extrusion_multiplyer": ("filament_flow",      no_translation),
+		"retractionamountextruderswitch": ("retraction_dual_amount", mm_from_um),
+		"retract_length_toolchange": ("retraction_dual_amount", no_translation),
+		"retractionamount":     ("retraction_amount",  mm_from_um),
+		"retract_length":       ("retraction_amount",  no_translation),
+		"retractionspeed":      ("retraction_speed",   no_translation),
+		"retract_speed":        ("retraction_speed",   no_translation),
+		"initiallayerthickness":("bottom_thickness",   mm_from_um),
+		"first_layer_height":   ("bottom_thickness",   no_translation),
+		"extrusionwidth":       ("edge_width",         mm_from_um),
+		"extrusion_width":      ("edge_width",         no_translation),
+		"perimeters":           ("wall_thickness",     width_from_line_count),
+		"downskincount":        ("solid_layer_thickness", height_from_layer_count),
+		"bottom_solid_layers":  ("solid_layer_thickness", height_from_layer_count),
+		"upskincount":          ("solid_layer_thickness", height_from_layer_count),
+		"top_solid_layers":     ("solid_layer_thickness", height_from_layer_count),
+		"initialspeeduplayers": (None, None),          # octoprint always uses 4
+		"initiallayerspeed":    ("bottom_layer_speed", no_translation),
+		"first_layer_speed":    ("bottom_layer_speed", no_translation),
+		"inset0speed":          ("outer_shell_speed",  no_translation),
+		"insetxspeed":          ("inner_shell_speed",  no_translation),
+		"movespeed":            ("travel_speed",       no_translation),
+		"travel_speed":         ("travel_speed",       no_translation),
+		"minimallayertime":     ("cool_min_layer_time",no_translation),
+		"infillpattern":        (None, None),          # octoprint doesn't set
+		"layer0extrusionwidth": ("first_layer_width_factor", lambda x, basis: x / 1000.0 * 100.0 / basis.extrusion_width),
+		"first_layer_extrusion_width": ("first_layer_width_factor", lambda x, basis: x * 100.0 / basis.extrusion_width),
+		"spiralizemode":        ("spiralize",          bool_from_int),
+		"spiral_vase":          ("spiralize",          bool_from_int),
+		"sparseinfilllinedistance": ("fill_density",   fill_from_line_distance),
+		"fill_density":         ("fill_density",       no_translation),
+		"multivolumeoverlap":   ("overlap_dual",       mm_from_um),
+		"enableoozeshield":     ("ooze_shield",        bool_from_int),
+		"ooze_prevention":      ("ooze_shield",        bool_from_int),
+		"fanfullonlayernr":     ("fan_full_height",    lambda x, basis: (x - 1) * basis.layer_height + basis.init_layer_height),
+		"full_fan_speed_layer": ("fan_full_height",    lambda x, basis: (x - 1) * basis.layer_height + basis.init_layer_height),
+		"gcodeflavor":          ("gcode_flavor",       lambda x, basis: "reprap"),
+		"gcode_flavor":         ("gcode_flavor",       lambda x, basis: "reprap"),
+		"autocenter":           (None, None),          # octoprint doesn't set
+		"objectsink":           ("object_sink",        mm_from_um),
+		"nozzle_diameter":      (None, None),          # octoprint always overrides with printer profile
+		"bed_shape":            (None, None),          # octoprint always overrides with printer profile
+		"rect_origin":          (None, None),          # octoprint always overrides with printer profile
+		"extruderoffset[0].x":  (None, None),          # octoprint always overrides with printer profile
+		"extruderoffset[0].y":  (None, None),          # octoprint always overrides with printer profile
+		"retractionminimaldistance": ("retraction_min_travel", mm_from_um),
+		"retract_before_travel": ("retraction_min_travel", no_translation),
+		"retractionzhop":       ("retraction_hop",     mm_from_um),
+		"retract_lift":         ("retraction_hop",     no_translation),
+		"minimalextrusionbeforeretraction": ("retraction_minimal_extrusion", mm_from_um),
+		"enablecombing":        ("retraction_combing", lambda x, basis: "all" if x == 1 else ("no skin" if x == 2 else "off")),
+		"minimalfeedrate":      ("cool_min_feedrate",  no_translation),
+		"min_print_speed":      ("cool_min_feedrate",  no_translation),
+		"coolheadlift":         ("cool_head_lift",     bool_from_int),
+		"fanspeedmin":          ("fan_speed",          no_translation),
+		"min_fan_speed":        ("fan_speed",          no_translation),
+		"fanspeedmax":          ("fan_speed_max",      no_translation),
+		"max_fan_speed":        ("fan_speed_max",      no_translation),
+		"skirtdistance":        ("skirt_gap",          mm_from_um),
+		"skirt_distance":       ("skirt_gap",          no_translation),
+		"skirtminlength":       ("skirt_minimal_length", mm_from_um),
+		"min_skirt_length":     ("skirt_minimal_length", no_translation),
+		"skirtlinecount":       ("skirt_line_count",   no_translation),
+		"skirts":               ("skirt_line_count",   no_translation),
+		"supportangle":         ("support_angle",      no_translation),
+		"support_material_threshold": ("support_angle",no_translation),
+		"supportxydistance":    ("support_xy_distance", mm_from_um),
+		"support_material_spacing": ("support_xy_distance", no_translation),
+		"support_material_xy_spacing": ("support_xy_distance", no_translation),
+		"supportzdistance":     ("support_z_distance", mm_from_um),
+		"supportlinedistance":  ("support_fill_rate",  fill_from_line_distance),
+		"support_material_buildplate_only": ("support", lambda x, basis: "Touching Buildplate" if basis.support != "None" else "None"),
+		"startcode":            ("start_gcode",        lambda x, basis: [_START_GCODE_PREFIX + x[3:-3]]),
+		"start_gcode":          ("start_gcode",        lambda x, basis: [_START_GCODE_PREFIX + x.replace("\\n", "\n")]),
+		"endcode":              ("end_gcode",          lambda x, basis: [x[3:-3]]),
+		"end_gcode":            ("end_gcode",          lambda x, basis: [x.replace("\\n", "\n")]),
+		"raft_layers":          ("raft_thickness",     height_from_layer_count),
+		"raftmargin":           ("raft_margin",        mm_from_um),
+		"raftlinespacing":      ("raft_line_spacing",  mm_from_um),
+		"raftbasethickness":    ("raft_base_thickness",mm_from_um),
+		"raftbaselinewidth":    ("raft_base_linewidth",mm_from_um),
+		"raftinterfacethickness": ("raft_thickness",   mm_from_um),
+		"raftinterfacelinewidth": ("raft_margin",      mm_from_um),
+		"raftinterfacelinespacing": (None, None),      # octoprint computes from linewidth
+		"raftbasespeed":        (None, None),          # octoprint always uses bottom_layer_speed
+		"raftfanspeed":         (None, None),          # octoprint forces this to 0
+		"raftsurfacethickness": ("raft_surface_thickness", mm_from_um),
+		"raftsurfacelinewidth": ("raft_surface_linewidth", mm_from_um),
+		"raftsurfacelinespacing": (None, None),        # octoprint computes from linewidth
+		"raftsurfacelayers":    ("raft_surface_layers",no_translation),
+		"raftsurfacespeed":     (None, None),          # octoprint always uses bottom_layer_speed
+		"raftairgap":           ("raft_airgap_all",    mm_from_um),
+		"raftairgaplayer0":     (None, None),          # octoprint doesn't support a different airgap for layer0)
+		"filament_cost":        (None, None),          # octoprint doesn't use these filament infos
+		"filament_density":     (None, None),          # octoprint doesn't use these filament infos
+	}
+	del mm_from_um, no_translation, width_from_line_count, height_from_layer_count
+	del bool_from_int, fill_from_line_distance
 
-	finally:
-		try:
-			os.unlink(infile_path)
-		except:
-			pass
+	# returns (profile, (posx, posy)) for the profile text, positions in mm
+	def translate(self, text, nozzle_diameter, logger):
+		options = parse_polar_profile(text)
+		basis = self._ProfileBasis(options, nozzle_diameter)
+		logger.debug("layer_height={}; extrusion_width={}".format(basis.layer_height, basis.extrusion_width))
+
+		profile = dict()
+		profile["support"] = "none"
+		posx = 0
+		posy = 0
+		for option, value in options.items():
+			if option in self.OPTIONS:
+				key, translate = self.OPTIONS[option]
+				if key:
+					logger.debug("key={}; value={}, {}".format(key, value, type(value)))
+					profile[key] = translate(value, basis)
+					if "raft" in key:
+						profile["platform_adhesion"] = "raft"
+					elif "support" in key:
+						if profile["support"] != "everywhere":
+							profile["support"] = "buildplate"
+				else:
+					logger.debug("Eating PolarCloud setting {}={}".format(option, value))
+			elif option == "supporteverywhere":
+				if value:
+					profile["support"] = "everywhere"
+			elif option == "fixhorrible":
+				profile["fix_horrible_union_all_type_a"] = not not (value & 0x01)
+				profile["fix_horrible_union_all_type_b"] = not not (value & 0x02)
+				profile["fix_horrible_extensive_stitching"] = not not (value & 0x04)
+				profile["fix_horrible_use_open_bits"] = not not (value & 0x10)
+			elif option == "posx":
+				posx = value / 1000.0
+			elif option == "posy":
+				posy = value / 1000.0
+			else:
+				logger.warn("PolarCloud slicing profile contains unrecognized setting {}={}".format(option, value))
+
+		logger.debug("Profile looks like this: {}".format(repr(profile)))
+		profile["fan_enabled"] = "fan_speed_max" in profile and profile["fan_speed_max"] > 0
+		return profile, (posx, posy)
+
+_slicing_profile_translator = PolarSlicingProfileTranslator()
 
 import octoprint.plugin
 import octoprint.util
@@ -175,7 +554,8 @@ import octoprint_client
 from octoprint.util import get_exception_string
 from octoprint.events import Events
 from octoprint.filemanager import FileDestinations
-from octoprint.filemanager.util import StreamWrapper
+from octoprint.filemanager.util import DiskFileWrapper
+from octoprint.printer import PrinterCallback
 from octoprint.slicing.exceptions import UnknownSlicer, SlicerNotConfigured
 
 # logging.getLogger('socketIO-client').setLevel(logging.DEBUG)
@@ -209,6 +589,433 @@ def float_safe_get(dictionary, *keys):
 	s = str_safe_get(dictionary, *keys)
 	return 0.0 if not s else float(s)
 
+class PolarDownloadCancelled(Exception):
+	pass
+
+# stream url into file_obj chunk by chunk so memory use doesn't depend on the
+# size of the download, timeout is per read rather than for the whole request
+def download_to_file(url, file_obj, chunk_size=65536, timeout=(10, 30), cancel_event=None, session=None):
+	r = (session or requests).get(url, stream=True, timeout=timeout)
+	try:
+		r.raise_for_status()
+		return write_response(r, file_obj, chunk_size, cancel_event)
+	finally:
+		r.close()
+
+# copy the body of a streamed response into file_obj, updating digest (a
+# hashlib object) along the way if given, returns the number of bytes
+def write_response(r, file_obj, chunk_size=65536, cancel_event=None, digest=None):
+	size = 0
+	for chunk in r.iter_content(chunk_size=chunk_size):
+		if cancel_event and cancel_event.is_set():
+			raise PolarDownloadCancelled(r.url)
+		if chunk:
+			file_obj.write(chunk)
+			if digest:
+				digest.update(chunk)
+			size += len(chunk)
+	return size
+
+class PolarDownloadCache(object):
+	"""
+	Files downloaded for cloud prints, kept under folder with an index.json
+	recording each one's validators (ETag, Last-Modified) and sha256. Entries
+	are keyed by the url without its query string, which for presigned urls
+	changes on every request, and are always revalidated with a conditional
+	GET so the server decides whether the copy is current. When the server
+	sends no validators the download still happens but an unchanged sha256
+	counts as a hit. The least recently used files are evicted to keep the
+	total under max_bytes, 0 disables the cache. Files the index doesn't know
+	about, eg. left behind by a crash, are removed as well.
+	"""
+	# downloads in progress are kept this many seconds before they count as
+	# left behind
+	STALE_DOWNLOAD_AGE = 24 * 60 * 60
+
+	def __init__(self, folder, logger, max_bytes=0):
+		self._folder = folder
+		self._index_path = os.path.join(folder, 'index.json')
+		self._logger = logger
+		self._max_bytes = max_bytes
+		self._lock = threading.Lock()
+		self._index = None
+		self.hits = 0
+		self.misses = 0
+
+	def configure(self, max_bytes):
+		self._max_bytes = max_bytes
+		with self._lock:
+			self._load()
+			self._evict()
+
+	@property
+	def enabled(self):
+		return self._max_bytes > 0
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses}
+
+	# download url to dest_path (replacing it) through the cache, returns the
+	# size in bytes
+	def fetch(self, url, dest_path, session, chunk_size=65536, timeout=(10, 30), cancel_event=None):
+		urlp = urlparse(url)
+		key = urlp.scheme + "://" + urlp.netloc + urlp.path
+		with self._lock:
+			self._load()
+			entry = self._index.get(key)
+			if entry and not os.path.exists(self._path(entry)):
+				del self._index[key]
+				entry = None
+
+		headers = {}
+		if entry and entry.get('etag'):
+			headers['If-None-Match'] = entry['etag']
+		if entry and entry.get('last_modified'):
+			headers['If-Modified-Since'] = entry['last_modified']
+		r = session.get(url, stream=True, timeout=timeout, headers=headers)
+		try:
+			if entry and r.status_code == 304:
+				self._logger.debug("{} not modified, using the cached copy".format(url))
+				return self._use(key, entry, dest_path, hit=True)
+			r.raise_for_status()
+			if not os.path.isdir(self._folder):
+				os.makedirs(self._folder)
+			fd, temp_path = tempfile.mkstemp(prefix="download-", dir=self._folder)
+			try:
+				digest = hashlib.sha256()
+				with os.fdopen(fd, 'wb') as f:
+					size = write_response(r, f, chunk_size, cancel_event, digest)
+			except:
+				_remove_quietly(temp_path)
+				raise
+		finally:
+			r.close()
+
+		sha256 = digest.hexdigest()
+		hit = bool(entry and entry.get('sha256') == sha256)
+		entry = {
+			'file': hashlib.sha1(key.encode('utf-8')).hexdigest(),
+			'etag': r.headers.get('ETag'),
+			'last_modified': r.headers.get('Last-Modified'),
+			'sha256': sha256,
+			'size': size,
+		}
+		getattr(os, 'replace', os.rename)(temp_path, self._path(entry))
+		return self._use(key, entry, dest_path, hit=hit)
+
+	def _use(self, key, entry, dest_path, hit):
+		entry['last_used'] = time.time()
+		with self._lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+			self._index[key] = entry
+			# a copy rather than a link, dest_path ends up in the file manager
+			# where it can be changed
+			_remove_quietly(dest_path)
+			shutil.copyfile(self._path(entry), dest_path)
+			self._evict()
+			self._save()
+		return entry['size']
+
+	def _path(self, entry):
+		return os.path.join(self._folder, entry['file'])
+
+	def _load(self):
+		if self._index is not None:
+			return
+		try:
+			with open(self._index_path, 'r') as f:
+				self._index = json.load(f)
+		except (IOError, OSError, ValueError):
+			self._index = {}
+
+	def _save(self):
+		try:
+			with open(self._index_path + '.tmp', 'w') as f:
+				json.dump(self._index, f)
+			getattr(os, 'replace', os.rename)(self._index_path + '.tmp', self._index_path)
+		except (IOError, OSError):
+			self._logger.exception("Unable to save download cache index {}".format(self._index_path))
+
+	def _evict(self):
+		total = sum(entry['size'] for entry in self._index.values())
+		for key, entry in sorted(self._index.items(), key=lambda item: item[1].get('last_used', 0)):
+			if total <= self._max_bytes:
+				break
+			self._logger.debug("Evicting {} from the download cache".format(key))
+			_remove_quietly(self._path(entry))
+			del self._index[key]
+			total -= entry['size']
+		self._sweep()
+
+	def _sweep(self):
+		try:
+			names = os.listdir(self._folder)
+		except OSError:
+			return
+		known = set(entry['file'] for entry in self._index.values())
+		known.update((os.path.basename(self._index_path), os.path.basename(self._index_path) + '.tmp'))
+		for name in names:
+			if name in known:
+				continue
+			path = os.path.join(self._folder, name)
+			try:
+				if name.startswith('download-') and time.time() - os.path.getmtime(path) < self.STALE_DOWNLOAD_AGE:
+					continue
+			except OSError:
+				continue
+			self._logger.debug("Removing {} from the download cache, it isn't in the index".format(name))
+			_remove_quietly(path)
+
+# keep-alive connection pools owned by the plugin: one session for the local
+# webcam and one per cloud host, so a snapshot every few seconds doesn't pay
+# for a new TCP connection and TLS handshake each time. The retry settings
+# are for the cloud; the webcam is asked on the heartbeat and the next
+# snapshot comes round soon enough, so it isn't retried.
+class PolarHttpSessions(object):
+	def __init__(self, pool_size=2, retries=2, backoff=0.5):
+		self._mutex = threading.Lock()
+		self._sessions = {}
+		self._config = None
+		self.configure(pool_size, retries, backoff)
+
+	# apply new pool/retry settings, existing sessions are closed and will be
+	# recreated on next use if anything changed
+	def configure(self, pool_size, retries, backoff):
+		config = (max(1, int(pool_size)), max(0, int(retries)), float(backoff))
+		if config != self._config:
+			self._config = config
+			self.close()
+
+	def webcam(self):
+		return self._session('webcam')
+
+	def for_url(self, url):
+		urlp = urlparse(url)
+		return self._session(urlp.scheme + "://" + urlp.netloc)
+
+	def close(self):
+		with self._mutex:
+			sessions = list(self._sessions.values())
+			self._sessions = {}
+		for session in sessions:
+			session.close()
+
+	def _session(self, key):
+		with self._mutex:
+			session = self._sessions.get(key)
+			if session is None:
+				session = self._sessions[key] = self._create_session(retrying=key != 'webcam')
+			return session
+
+	def _create_session(self, retrying=True):
+		pool_size, retries, backoff = self._config
+		if not retrying:
+			retries = 0
+		# urllib3 only retries reads and error statuses for idempotent methods,
+		# so uploads (POST) are only retried when the connection couldn't be
+		# established and nothing was sent
+		retry = Retry(total=retries, connect=retries, read=retries,
+				status=retries, backoff_factor=backoff,
+				status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+		session = requests.Session()
+		session.mount("http://", adapter)
+		session.mount("https://", adapter)
+		return session
+
+# run each of funcs on its own thread, passing them a shared threading.Event
+# (cancel_event if given) if any of them raises, the event is set so the
+# others can give up early and the first exception is re-raised once they've
+# all finished
+def run_concurrently(funcs, cancel_event=None):
+	if cancel_event is None:
+		cancel_event = threading.Event()
+	errors = []
+
+	def _run(func):
+		try:
+			func(cancel_event)
+		except Exception as e:
+			errors.append(e)
+			cancel_event.set()
+
+	threads = [threading.Thread(target=_run, args=(func,)) for func in funcs]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0]
+
+def _remove_quietly(path):
+	try:
+		os.unlink(path)
+	except OSError:
+		pass
+
+# hex sha256 of the file at path, None if it can't be read
+def _file_sha256(path):
+	digest = hashlib.sha256()
+	try:
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(65536), b''):
+				digest.update(chunk)
+	except (IOError, OSError):
+		return None
+	return digest.hexdigest()
+
+# a multipart/form-data body as a generator, so a file part of unknown length
+# can be sent with chunked transfer encoding as chunks are produced
+def multipart_stream(fields, file_field, filename, content_type, chunks, boundary):
+	for name, value in fields.items():
+		yield '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+			boundary, name, value).encode('utf-8')
+	yield '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(
+		boundary, file_field, filename, content_type).encode('utf-8')
+	for chunk in chunks:
+		yield chunk
+	yield '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+
+#~~ STL inspection
+
+# triangles per block read from a binary STL, bounds memory use on big models
+_STL_BLOCK = 65536
+
+# returns a dict describing the STL model at path: 'triangles', 'min' and
+# 'max' corners of its bounding box and 'volume' (mm^3, only meaningful for
+# a closed mesh)
+def inspect_stl(path):
+	size = os.path.getsize(path)
+	with open(path, 'rb') as f:
+		header = f.read(84)
+	if len(header) == 84:
+		count = struct.unpack('<I', header[80:84])[0]
+		# an ASCII file can start with "solid" and still be binary, so go by
+		# whether the size matches the triangle count
+		if size == 84 + 50 * count:
+			if _numpy_available:
+				return _inspect_binary_stl_numpy(path, count)
+			return _inspect_binary_stl(path, count)
+	return _inspect_ascii_stl(path)
+
+def _stl_result(count, lo, hi, volume):
+	if not count:
+		lo = hi = (0.0, 0.0, 0.0)
+	return {'triangles': count, 'min': tuple(float(v) for v in lo),
+		'max': tuple(float(v) for v in hi), 'volume': abs(float(volume))}
+
+def _inspect_binary_stl_numpy(path, count):
+	if not count:
+		return _stl_result(0, None, None, 0.0)
+	record = numpy.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+	triangles = numpy.memmap(path, dtype=record, mode='r', offset=84, shape=(count,))
+	lo = numpy.full(3, numpy.inf)
+	hi = numpy.full(3, -numpy.inf)
+	volume = 0.0
+	for start in range(0, count, _STL_BLOCK):
+		v = triangles['vertices'][start:start + _STL_BLOCK].astype(numpy.float64)
+		lo = numpy.minimum(lo, v.min(axis=(0, 1)))
+		hi = numpy.maximum(hi, v.max(axis=(0, 1)))
+		# signed volume of the tetrahedron each face makes with the origin
+		volume += numpy.einsum('ij,ij->', v[:, 0], numpy.cross(v[:, 1], v[:, 2])) / 6.0
+	del triangles
+	return _stl_result(count, lo, hi, volume)
+
+def _inspect_binary_stl(path, count):
+	lo = [float('inf')] * 3
+	hi = [float('-inf')] * 3
+	volume = 0.0
+	with open(path, 'rb') as f:
+		f.seek(84)
+		remaining = count
+		while remaining:
+			n = min(remaining, _STL_BLOCK)
+			block = f.read(50 * n)
+			for offset in range(0, 50 * n, 50):
+				v = struct.unpack_from('<9f', block, offset + 12)
+				for axis in range(3):
+					lo[axis] = min(lo[axis], v[axis], v[axis + 3], v[axis + 6])
+					hi[axis] = max(hi[axis], v[axis], v[axis + 3], v[axis + 6])
+				volume += _signed_volume(v[0:3], v[3:6], v[6:9])
+			remaining -= n
+	return _stl_result(count, lo, hi, volume)
+
+def _inspect_ascii_stl(path):
+	lo = [float('inf')] * 3
+	hi = [float('-inf')] * 3
+	volume = 0.0
+	count = 0
+	face = []
+	with open(path, 'rb') as f:
+		for line in f:
+			words = line.split()
+			if not words or words[0] != b'vertex':
+				continue
+			v = (float(words[1]), float(words[2]), float(words[3]))
+			for axis in range(3):
+				lo[axis] = min(lo[axis], v[axis])
+				hi[axis] = max(hi[axis], v[axis])
+			face.append(v)
+			if len(face) == 3:
+				volume += _signed_volume(*face)
+				count += 1
+				face = []
+	return _stl_result(count, lo, hi, volume)
+
+def _signed_volume(a, b, c):
+	return (a[0] * (b[1] * c[2] - b[2] * c[1]) -
+		a[1] * (b[0] * c[2] - b[2] * c[0]) +
+		a[2] * (b[0] * c[1] - b[1] * c[0])) / 6.0
+
+# check an inspect_stl() result against an OctoPrint printer profile's
+# 'volume', with the model centered at pos (mm, bed coordinates) as the
+# slicer will place it. (0, 0) is what Polar Cloud sends when it leaves
+# placement to the slicer, which centers the model on the bed. Returns None
+# if it fits or a reason it doesn't.
+def stl_misfit(stats, volume, pos=(0, 0)):
+	size = [hi - lo for lo, hi in zip(stats['min'], stats['max'])]
+	width = float(volume.get('width', 0))
+	depth = float(volume.get('depth', 0))
+	height = float(volume.get('height', 0))
+	tolerance = 0.001
+	if height and size[2] > height + tolerance:
+		return "model is {:.1f}mm tall, the printer is {:.1f}mm".format(size[2], height)
+	half_x = size[0] / 2.0
+	half_y = size[1] / 2.0
+	if volume.get('formFactor') == 'circular':
+		radius = width / 2.0
+		# model center relative to the middle of the bed
+		x, y = 0.0, 0.0
+		if pos != (0, 0):
+			x, y = pos
+			if volume.get('origin') != 'center':
+				x, y = x - radius, y - radius
+		if radius and math.hypot(abs(x) + half_x, abs(y) + half_y) > radius + tolerance:
+			return "a {:.1f}x{:.1f}mm footprint at {} doesn't fit the {:.1f}mm bed".format(
+				size[0], size[1], repr(pos), width)
+		return None
+	if width and size[0] > width + tolerance or depth and size[1] > depth + tolerance:
+		return "model is {:.1f}x{:.1f}mm, the bed is {:.1f}x{:.1f}mm".format(size[0], size[1], width, depth)
+	if pos != (0, 0):
+		x, y = pos
+		if volume.get('origin') == 'center':
+			x, y = x + width / 2.0, y + depth / 2.0
+		if (x - half_x < -tolerance or x + half_x > width + tolerance or
+				y - half_y < -tolerance or y + half_y > depth + tolerance):
+			return "a {:.1f}x{:.1f}mm model centered at {} hangs off the bed".format(
+				size[0], size[1], repr(pos))
+	return None
+
+def _int_or_none(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
 # return true if each of the list of keys are in the dictionary, otherwise false
 def has_all(dictionary, *keys):
 	for key in keys:
@@ -226,12 +1033,55 @@ def filament_length_from_job_data(data):
 	return filament_length
 
 
-class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
-                       octoprint.plugin.AssetPlugin,
-                       octoprint.plugin.TemplatePlugin,
-                       octoprint.plugin.StartupPlugin,
-                       octoprint.plugin.SimpleApiPlugin,
-                       octoprint.plugin.EventHandlerPlugin):
+# An immutable snapshot of the cloud print bookkeeping and of what the status
+# tick shares with the other threads.  PolarStateMachine swaps in a whole new
+# frame on every change, so a reader that grabs state.frame once gets a job
+# id, state and info that belong together without taking a lock.  info is
+# the job's status fields (url, config, sliceDetails), copied so the caller
+# can't change it underneath the frame; treat it as read only.
+# print_seconds and filament_used are from the most recent status, for the
+# job message.
+class PolarJobFrame(object):
+	__slots__ = ('cloud_print', 'job_id', 'pstate', 'pstate_counter', 'info',
+			'job_pending', 'next_pending', 'update_interval', 'print_seconds',
+			'filament_used')
+
+	def __init__(self, cloud_print=False, job_id="123", pstate="0",
+			pstate_counter=0, info=None, job_pending=False, next_pending=False,
+			update_interval=60, print_seconds=None, filament_used=None):
+		set_field = object.__setattr__
+		set_field(self, 'cloud_print', cloud_print)
+		set_field(self, 'job_id', job_id)
+		set_field(self, 'pstate', pstate) # only applies if cloud_print
+		set_field(self, 'pstate_counter', pstate_counter)
+		set_field(self, 'info', dict(info) if info is not None else {})
+		set_field(self, 'job_pending', job_pending)
+		set_field(self, 'next_pending', next_pending)
+		set_field(self, 'update_interval', update_interval)
+		set_field(self, 'print_seconds', print_seconds)
+		set_field(self, 'filament_used', filament_used)
+
+	def __setattr__(self, name, value):
+		raise AttributeError("PolarJobFrame is immutable")
+
+	def replace(self, **changes):
+		fields = dict((name, getattr(self, name)) for name in self.__slots__ if name != 'info')
+		fields.update(changes)
+		frame = PolarJobFrame(**fields)
+		if not 'info' in changes:
+			# already a private copy, share it
+			object.__setattr__(frame, 'info', self.info)
+		return frame
+
+	def __repr__(self):
+		return "PolarJobFrame({})".format(", ".join("{}={!r}".format(name,
+			getattr(self, name)) for name in self.__slots__ if name != 'info'))
+
+
+# Tracks what we tell PolarCloud about a cloud print.  Writers (socket
+# handlers, the event bus, the status tick) go through the lock and replace
+# the frame; readers just use the current frame.
+class PolarStateMachine(object):
 	PSTATE_IDLE = "0"
 	PSTATE_SERIAL = "1"         # Printing a local print over serial
 	PSTATE_PREPARING = "2"      # Preparing a cloud print (slicing)
@@ -247,22 +1097,208 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	PSTATE_ERROR = "12"
 	PSTATE_OFFLINE = "13"
 
+	STATE_MAPPING = {
+		"OPEN_SERIAL": PSTATE_ERROR,
+		"DETECT_SERIAL": PSTATE_ERROR,
+		"DETECT_BAUDRATE": PSTATE_ERROR,
+		"CONNECTING": PSTATE_ERROR,
+		"OPERATIONAL": PSTATE_IDLE,
+		"PRINTING": PSTATE_SERIAL,
+		"PAUSED": PSTATE_PAUSED,
+		"CLOSED": PSTATE_ERROR,
+		"ERROR": PSTATE_ERROR,
+		"CLOSED_WITH_ERROR": PSTATE_ERROR,
+		"TRANSFERING_FILE": PSTATE_SERIAL,
+		"OFFLINE": PSTATE_OFFLINE,
+		"UNKNOWN": PSTATE_ERROR,
+		"NONE": PSTATE_ERROR,
+		"FINISHING": PSTATE_POSTPROCESSING
+	}
+
+	# on_next_print is called (outside the lock) once a completed cloud print
+	# has been reported, so the next queued print can be requested
+	def __init__(self, on_next_print):
+		self._lock = threading.Lock()
+		self._on_next_print = on_next_print
+		self.frame = PolarJobFrame()
+
+	def update(self, **changes):
+		with self._lock:
+			self.frame = self.frame.replace(**changes)
+
+	# repeat pstate for the next few status messages
+	def announce(self, pstate, counter=3):
+		self.update(pstate=pstate, pstate_counter=counter)
+
+	def start_job(self, job_id, info):
+		self.update(cloud_print=True, job_pending=True, job_id=job_id,
+				pstate=self.PSTATE_PREPARING, pstate_counter=0, info=info)
+
+	# change fields of job_id's info, if it's still the current job
+	def update_info(self, job_id, **fields):
+		with self._lock:
+			if self.frame.job_id == job_id:
+				self.frame = self.frame.replace(info=dict(self.frame.info, **fields))
+
+	# the job message for the current print has been sent
+	def job_reported(self):
+		self.update(job_pending=False)
+
+	# follow OctoPrint's print events
+	def handle_event(self, event):
+		with self._lock:
+			frame = self.frame
+			if event in (Events.PRINT_CANCELLED, Events.PRINT_FAILED):
+				changes = dict(pstate=self.PSTATE_CANCELLING)
+				if frame.cloud_print:
+					changes['pstate_counter'] = 3
+			elif event in (Events.PRINT_STARTED, Events.PRINT_RESUMED):
+				changes = dict(pstate=self.PSTATE_PRINTING)
+			elif event == Events.ERROR:
+				changes = dict(pstate=self.PSTATE_ERROR)
+			elif event == Events.PRINT_PAUSED:
+				changes = dict(pstate=self.PSTATE_PAUSED)
+			elif event == Events.PRINT_DONE:
+				if frame.cloud_print:
+					changes = dict(pstate=self.PSTATE_POSTPROCESSING,
+							pstate_counter=3, next_pending=True)
+				else:
+					changes = dict(pstate=self.PSTATE_COMPLETE)
+			elif event in (Events.SLICING_CANCELLED, Events.SLICING_FAILED):
+				changes = dict(pstate=self.PSTATE_CANCELLING, pstate_counter=3)
+			elif event in (Events.MOVIE_RENDERING, Events.POSTROLL_START):
+				if not frame.cloud_print:
+					return
+				changes = dict(pstate=self.PSTATE_POSTPROCESSING, pstate_counter=0)
+			elif event == Events.MOVIE_FAILED:
+				if frame.cloud_print:
+					changes = dict(pstate=self.PSTATE_COMPLETE, pstate_counter=3)
+				else:
+					changes = dict(pstate=self.PSTATE_IDLE)
+			else:
+				return
+			self.frame = frame.replace(**changes)
+
+	# The PolarCloud status for OctoPrint's state_id, advancing the countdown
+	# of repeated completion/cancel states by one status message.
+	#
+	# this is a bit complicated because the mapping isn't direct and while
+	# we try to keep track of current polar state, current octoprint state
+	# wins, so we let pstate show through if it "matches" current octoprint
+	def polar_status(self, state_id):
+		next_print = False
+		with self._lock:
+			frame = self.frame
+			pstate, changes = self._next_status(frame, state_id)
+			if changes:
+				if changes.pop('next_print', False):
+					next_print = True
+				self.frame = frame.replace(**changes)
+		if next_print:
+			self._on_next_print()
+		return pstate
+
+	def _next_status(self, frame, state_id):
+		if frame.cloud_print:
+			if frame.pstate_counter:
+				changes = {}
+				if frame.next_pending and frame.pstate == self.PSTATE_COMPLETE:
+					changes.update(next_pending=False, next_print=True)
+				# if we've got a counter, we're still repeating completion/cancel
+				# message, do that
+				changes['pstate_counter'] = frame.pstate_counter - 1
+				if not changes['pstate_counter']:
+					if frame.pstate == self.PSTATE_POSTPROCESSING:
+						changes.update(pstate=self.PSTATE_COMPLETE, pstate_counter=3)
+					else:
+						changes['cloud_print'] = False
+				return frame.pstate, changes
+			if frame.pstate == self.PSTATE_POSTPROCESSING:
+				return frame.pstate, None
+
+		state = self.STATE_MAPPING.get(state_id, self.PSTATE_ERROR)
+		changes = {}
+		if state == self.PSTATE_SERIAL and not frame.job_pending:
+			# if we were ever printing, we owe a "job" completion message
+			changes['job_pending'] = True
+		if frame.cloud_print:
+			if state == self.PSTATE_IDLE and frame.pstate == self.PSTATE_PREPARING:
+				# octoprint thinks were idle, but we must be slicing
+				return frame.pstate, changes
+			if state == self.PSTATE_SERIAL:
+				# octoprint thinks we're printing
+				return self.PSTATE_PRINTING, changes
+			if state != self.PSTATE_PAUSED and state != self.PSTATE_POSTPROCESSING:
+				# if we aren't preparing, printing, finished or paused and we're not
+				# counting down anymore, we must really be done
+				changes.update(cloud_print=False, job_id="123", info={})
+		return state, changes
+
+
+class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
+                       octoprint.plugin.AssetPlugin,
+                       octoprint.plugin.TemplatePlugin,
+                       octoprint.plugin.StartupPlugin,
+                       octoprint.plugin.SimpleApiPlugin,
+                       octoprint.plugin.EventHandlerPlugin):
+	PSTATE_IDLE = PolarStateMachine.PSTATE_IDLE
+	PSTATE_SERIAL = PolarStateMachine.PSTATE_SERIAL
+	PSTATE_PREPARING = PolarStateMachine.PSTATE_PREPARING
+	PSTATE_PRINTING = PolarStateMachine.PSTATE_PRINTING
+	PSTATE_PAUSED = PolarStateMachine.PSTATE_PAUSED
+	PSTATE_POSTPROCESSING = PolarStateMachine.PSTATE_POSTPROCESSING
+	PSTATE_CANCELLING = PolarStateMachine.PSTATE_CANCELLING
+	PSTATE_COMPLETE = PolarStateMachine.PSTATE_COMPLETE
+	PSTATE_UPDATING = PolarStateMachine.PSTATE_UPDATING
+	PSTATE_COLDPAUSED = PolarStateMachine.PSTATE_COLDPAUSED
+	PSTATE_CHANGINGFILAMENT = PolarStateMachine.PSTATE_CHANGINGFILAMENT
+	PSTATE_TCPIP = PolarStateMachine.PSTATE_TCPIP
+	PSTATE_ERROR = PolarStateMachine.PSTATE_ERROR
+	PSTATE_OFFLINE = PolarStateMachine.PSTATE_OFFLINE
+
+	# read only views of the current job frame, changes go through self._state
+	_cloud_print = property(lambda self: self._state.frame.cloud_print)
+	_cloud_print_info = property(lambda self: self._state.frame.info)
+	_job_pending = property(lambda self: self._state.frame.job_pending)
+	_job_id = property(lambda self: self._state.frame.job_id)
+	_pstate = property(lambda self: self._state.frame.pstate)
+	_update_interval = property(lambda self: self._state.frame.update_interval)
+
+	STATUS_DEFAULTS = {
+		"jobId": "0",
+		"protocol": "2",
+		"progress": "",
+		"progressDetail": "",
+		"estimatedTime": "0",
+		"filamentUsed": "0",
+		"startTime": "0",
+		"printSeconds": "0",
+		"bytesRead": "0",
+		"fileSize": "0",
+		"file": "",          # url for cloud stl
+		"config": "",        # url for cloud config.ini
+		"sliceDetails": "",  # Cura_SteamEngine output
+		"securityCode": ""   # three colors
+	}
+
+	# events after which a pending cloud job that isn't printing anymore is
+	# reported canceled
+	JOB_EVENTS = (Events.PRINT_STARTED, Events.PRINT_RESUMED, Events.PRINT_PAUSED,
+			Events.PRINT_DONE, Events.PRINT_CANCELLED, Events.PRINT_FAILED, Events.ERROR,
+			Events.SLICING_CANCELLED, Events.SLICING_FAILED, Events.MOVIE_DONE)
+	# other events that change what the next status says
+	STATUS_EVENTS = (Events.SETTINGS_UPDATED, Events.MOVIE_RENDERING, Events.POSTROLL_START,
+			Events.MOVIE_FAILED, getattr(Events, 'PRINTER_STATE_CHANGED', None))
+
 	def __init__(self):
 		self._serial = None
 		self._socket = None
 		self._connected = False
-		self._status_now = False
 		self._challenge = None
-		self._task_queue = queue.Queue()
+		self._scheduler = PolarHeartbeatScheduler()
+		self._state = PolarStateMachine(lambda: self._scheduler.put(self._send_next_print))
 		self._polar_status_worker = None
-		self._upload_location = {}
-		self._update_interval = 60
-		self._cloud_print = False
-		self._cloud_print_info = {}
-		self._job_pending = False
-		self._job_id = "123"
-		self._pstate = self.PSTATE_IDLE # only applies if _cloud_print
-		self._pstate_counter = 0
+		self._upload_locations = PolarUploadLocations(self._request_upload_url)
 		self._max_image_size = 150000
 		self._image_transpose = False
 		self._printer_type = None
@@ -272,9 +1308,18 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._port = 80
 		self._octoprint_client = None
 		self._capabilities = None
-		self._next_pending = False
 		self._print_preparer = None
-		self._status = None
+		self._preparation_lock = threading.Lock()
+		self._print_pipeline = None
+		self._upload_queue = None
+		self._upload_worker = None
+		self._slice_cache = None
+		self._download_cache = None
+		self._http = PolarHttpSessions()
+		self._snapshot_changes = PolarSnapshotChangeDetector()
+		self._status_encoder = PolarStatusEncoder()
+		self._temperatures = PolarTemperatureAggregator()
+		self._status_base = None
 		self._email = None
 		self._pin = None
 		# consider temp reads higher than this as having a target set for more
@@ -282,6 +1327,26 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._set_temp_threshold = 50
 		self._sent_command_list = None
 
+	def initialize(self):
+		self._ffmpeg_compressor = PolarFfmpegCompressor(_ffmpeg_path, self._logger) if _ffmpeg_path else None
+		self._jpeg_encoder = PolarJpegEncoder(self._logger) if _pillow_available else None
+		self._print_pipeline = PolarPrintPipeline([
+				("fetch", self._prepare_fetch),
+				("inspect", self._prepare_inspect),
+				("store", self._prepare_store),
+				("printer", self._prepare_printer),
+				("start", self._prepare_start),
+			], self._on_preparation_failed, self._logger,
+			callback_cancelled=self._on_preparation_cancelled)
+		self._upload_queue = PolarUploadQueue(
+				os.path.join(self.get_plugin_data_folder(), 'uploads'), self._logger)
+		self._upload_queue.load()
+		self._upload_worker = PolarUploadWorker(self._process_upload_queue, self._logger)
+		self._slice_cache = PolarSliceCache(
+				os.path.join(self.get_plugin_data_folder(), 'slice_cache'), self._logger)
+		self._download_cache = PolarDownloadCache(
+				os.path.join(self.get_plugin_data_folder(), 'download_cache'), self._logger)
+
 	##~~ SettingsPlugin mixin
 
 	def get_settings_defaults(self, *args, **kwargs):
@@ -295,7 +1360,24 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			pin="",
 			max_image_size = 150000,
 			verbose=False,
+			download_chunk_size=65536,
+			download_timeout=30,
+			http_pool_size=2,
+			http_retries=2,
+			http_backoff=0.5,
+			snapshot_change_threshold=4,
+			snapshot_max_staleness=600,
+			status_keepalive=60,
+			status_keyframe_interval=10,
+			status_temp_deadband=1.0,
+			status_temperature_stats=False,
 			upload_timelapse=True,
+			timelapse_threads=2,
+			timelapse_max_duration=0,
+			timelapse_streaming_upload=False,
+			upload_retries=10,
+			slice_cache_size=200,
+			download_cache_size=100,
 			enable_system_commands=True,
 			next_print=False
 		)
@@ -309,8 +1391,20 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				self._settings.global_get(["webcam", "flipV"]) or
 				self._settings.global_get(["webcam", "rotate90"]))
 		self._snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+		self._http.configure(self._settings.get_int(['http_pool_size']) or 1,
+				self._settings.get_int(['http_retries']) or 0,
+				self._settings.get_float(['http_backoff']) or 0)
+		self._snapshot_changes.configure(self._settings.get_int(['snapshot_change_threshold']) or 0,
+				self._settings.get_int(['snapshot_max_staleness']) or 0)
+		self._status_encoder.configure(self._settings.get_int(['status_keepalive']) or 0,
+				self._settings.get_int(['status_keyframe_interval']) or 0,
+				self._settings.get_float(['status_temp_deadband']) or 0)
+		if self._slice_cache:
+			self._slice_cache.configure((self._settings.get_int(['slice_cache_size']) or 0) * 1024 * 1024)
+		if self._download_cache:
+			self._download_cache.configure((self._settings.get_int(['download_cache_size']) or 0) * 1024 * 1024)
 		if self._socket and self._hello_sent:
-			self._task_queue.put(self._custom_command_list)
+			self._scheduler.put(self._custom_command_list)
 
 	##~~ AssetPlugin mixin
 
@@ -351,6 +1445,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._logger.debug("on_after_startup")
 		self._get_keys()
 		self._update_local_settings()
+		self._printer.register_callback(self._temperatures)
 		if self._serial:
 			self._start_polar_status()
 
@@ -362,6 +1457,28 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		else:
 			return '0'
 
+	# download url to a temporary file in the plugin data folder, returns the
+	# path of the file which the caller is responsible for removing
+	def _download(self, url, ext, cancel_event=None):
+		fd, download_path = tempfile.mkstemp(prefix="download-", suffix=ext,
+				dir=self.get_plugin_data_folder())
+		chunk_size = self._settings.get_int(['download_chunk_size']) or 65536
+		timeout = (10, self._settings.get_int(['download_timeout']) or 30)
+		try:
+			if self._download_cache and self._download_cache.enabled:
+				os.close(fd)
+				size = self._download_cache.fetch(url, download_path, self._http.for_url(url),
+						chunk_size=chunk_size, timeout=timeout, cancel_event=cancel_event)
+			else:
+				with os.fdopen(fd, 'wb') as f:
+					size = download_to_file(url, f, chunk_size=chunk_size, timeout=timeout,
+							cancel_event=cancel_event, session=self._http.for_url(url))
+			self._logger.debug("Downloaded {} bytes from {}".format(size, url))
+		except:
+			_remove_quietly(download_path)
+			raise
+		return download_path
+
 	def _valid_packet(self, data):
 		if not self._serial or self._serial != data.get("serialNumber", ""):
 			self._logger.debug("Serial number is '{}'".format(repr(self._serial)))
@@ -420,6 +1537,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	def _stop_polar_status(self):
 		if self._polar_status_worker:
 			self._shutdown = True
+			self._scheduler.wake()
 
 	def _system(self, command_line):
 		try:
@@ -483,106 +1601,56 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				self._public_key = f.read()
 
 	def _polar_status_from_state(self):
-		state_mapping = {
-			"OPEN_SERIAL": self.PSTATE_ERROR,
-			"DETECT_SERIAL": self.PSTATE_ERROR,
-			"DETECT_BAUDRATE": self.PSTATE_ERROR,
-			"CONNECTING": self.PSTATE_ERROR,
-			"OPERATIONAL": self.PSTATE_IDLE,
-			"PRINTING": self.PSTATE_SERIAL,
-			"PAUSED": self.PSTATE_PAUSED,
-			"CLOSED": self.PSTATE_ERROR,
-			"ERROR": self.PSTATE_ERROR,
-			"CLOSED_WITH_ERROR": self.PSTATE_ERROR,
-			"TRANSFERING_FILE": self.PSTATE_SERIAL,
-			"OFFLINE": self.PSTATE_OFFLINE,
-			"UNKNOWN": self.PSTATE_ERROR,
-			"NONE": self.PSTATE_ERROR,
-			"FINISHING": self.PSTATE_POSTPROCESSING
-		}
-		# this is a bit complicated because the mapping isn't direct and while
-		# we try to keep track of current polar state, current octoprint state
-		# wins, so we let _pstate show through if it "matches" current octoprint
-		if self._cloud_print:
-			if self._pstate_counter:
-				if self._next_pending and self._pstate == self.PSTATE_COMPLETE:
-					self._next_pending = False
-					self._task_queue.put(self._send_next_print)
-				# if we've got a counter, we're still repeating completion/cancel
-				# message, do that
-				self._pstate_counter -= 1
-				pstate = self._pstate
-				if not self._pstate_counter:
-					if self._pstate == self.PSTATE_POSTPROCESSING:
-						self._pstate = self.PSTATE_COMPLETE
-						self._pstate_counter = 3
-					else:
-						self._cloud_print = False
-				return pstate
-			if self._pstate == self.PSTATE_POSTPROCESSING:
-				return self._pstate
-
-		self._logger.debug("OctoPrint state: {}".format(self._printer.get_state_id()))
 		state_id = self._printer.get_state_id()
-		state = self.PSTATE_ERROR
-		try:
-			state = state_mapping[state_id]
-		except KeyError:
-			self._logger.exception("Unknown OctoPrint status, mapping to error state for PolarCloud: {}".format(state_id))
+		self._logger.debug("OctoPrint state: {}".format(state_id))
+		if not state_id in PolarStateMachine.STATE_MAPPING:
+			self._logger.warning("Unknown OctoPrint status, mapping to error state for PolarCloud: {}".format(state_id))
+		return self._state.polar_status(state_id)
 
-		if state == self.PSTATE_SERIAL:
-			# if we were ever printing, we owe a "job" completion message
-			self._job_pending = True
-		if self._cloud_print:
-			if state == self.PSTATE_IDLE and self._pstate == self.PSTATE_PREPARING:
-				# octoprint thinks were idle, but we must be slicing
-				return self._pstate
-			if state == self.PSTATE_SERIAL:
-				# octoprint thinks we're printing
-				return self.PSTATE_PRINTING
-			if state != self.PSTATE_PAUSED and state != self.PSTATE_POSTPROCESSING:
-				# if we aren't preparing, printing, finished or paused and we're not
-				# counting down anymore, we must really be done
-				self._cloud_print = False
-				self._job_id = "123"
-				self._cloud_print_info = {}
-		return state
+	def _set_update_interval(self, seconds):
+		if self._update_interval != seconds:
+			self._state.update(update_interval=seconds)
+			self._logger.debug("Update interval to {}".format(seconds))
 
 	def _current_status(self):
-		temps = self._printer.get_current_temperatures()
+		temps = self._temperatures.current()
+		if temps is None:
+			# nothing pushed lately, eg. not connected yet
+			temps = self._printer.get_current_temperatures()
 		self._logger.debug("temps: {}".format(repr(temps)))
-		status = {
-			"serialNumber": self._serial,
-			"status": self._polar_status_from_state(),
-			"jobId": self._get_job_id(),
-			"protocol": "2",
-			"progress": "",
-			"progressDetail": "",
-			"estimatedTime": "0",
-			"filamentUsed": "0",
-			"startTime": "0",
-			"printSeconds": "0",
-			"bytesRead": "0",
-			"fileSize": "0",
-			"file": "",          # url for cloud stl
-			"config": "",        # url for cloud config.ini
-			"sliceDetails": "",  # Cura_SteamEngine output
-			"securityCode": ""   # three colors
-		}
+		pstate = self._polar_status_from_state()
+		# one frame for the whole message so jobId and the cloud print info
+		# can't come from different jobs
+		frame = self._state.frame
+		# the fields that only change with the job or the settings are
+		# worked out once and copied on each tick
+		info = frame.info if frame.cloud_print else None
+		base = self._status_base
+		if base is None or base[0] is not info or base[1] != self._serial:
+			fields = dict(self.STATUS_DEFAULTS)
+			fields["serialNumber"] = self._serial
+			if info:
+				# cloud print url, config and sliceDetails
+				fields.update(info)
+			base = self._status_base = (info, self._serial, fields)
+		status = dict(base[2])
+		status["status"] = pstate
+		if self._printer.is_printing() or self._printer.is_paused():
+			status["jobId"] = frame.job_id
 		target_set = False
 		if 'tool0' in temps:
 			status['tool0'] = temps['tool0']['actual']
-			status['targetTool0'] = temps['tool0']['target']
+			status['targetTool0'] = temps['tool0']['target'] or 0
 			if status['targetTool0'] > 0 or status['tool0'] > self._set_temp_threshold:
 				target_set = True
-		if 'tool1' in temps and not (temps['tool1']['actual'] == -1 and temps['tool1']['target'] == 0):
+		if 'tool1' in temps and not (temps['tool1']['actual'] == -1 and not temps['tool1']['target']):
 			status['tool1'] = temps['tool1']['actual']
-			status['targetTool1'] = temps['tool1']['target']
+			status['targetTool1'] = temps['tool1']['target'] or 0
 			if status['targetTool1'] > 0 or status['tool1'] > self._set_temp_threshold:
 				target_set = True
-		if 'bed' in temps and not (temps['bed']['actual'] == -1 and temps['bed']['target'] == 0):
+		if 'bed' in temps and not (temps['bed']['actual'] == -1 and not temps['bed']['target']):
 			status['bed'] = temps['bed']['actual']
-			status['targetBed'] = temps['bed']['target']
+			status['targetBed'] = temps['bed']['target'] or 0
 			if status['targetBed'] > 0 or status['bed'] > self._set_temp_threshold:
 				target_set = True
 
@@ -601,31 +1669,34 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			status["bytesRead"] = str_safe_get(data, "progress", "filepos")
 			status["fileSize"] = str_safe_get(data, "job", "file", "size")
 
+		# not part of the Polar Cloud protocol, only for services that ask for it
+		if self._settings.get_boolean(['status_temperature_stats']):
+			temperature_stats = self._temperatures.stats()
+			if temperature_stats:
+				status["temperatureStats"] = temperature_stats
+
 		return status, target_set
 
 	# thread to update the polar cloud with current status periodically
 	def _polar_status_heartbeat(self):
 
 		def _wait_and_process(seconds, ignore_status_now=False):
+			return _wait_until(_monotonic() + seconds, ignore_status_now)
+
+		# run tasks as they're queued until the deadline, returns True if the
+		# deadline was reached or False if cut short by a status request,
+		# disconnect or shutdown
+		def _wait_until(deadline, ignore_status_now=False):
 			try:
-				for i in range(seconds):
-					if not self._task_queue.empty():
-						try:
-							task = self._task_queue.get_nowait()
-							task()
-						except queue.Empty:
-							pass
-					if not ignore_status_now and self._status_now:
-						self._status_now = False
-						self._logger.debug("_status_now break")
-						return False
-					self._socket.sleep(1)
-					if not self._connected:
-						self._socket = None
-						return False
-					if self._shutdown:
-						return False
-				return True
+				if self._scheduler.wait(deadline,
+						lambda: not self._connected or self._shutdown,
+						ignore_status_now):
+					return True
+				if not self._connected:
+					self._socket = None
+				elif not self._shutdown:
+					self._logger.debug("status request break")
+				return False
 			except:
 				if not self._shutdown:
 					if not self._connected:
@@ -663,19 +1734,37 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				if not self._hello_sent:
 					continue
 
-				self._status_now = False
+				self._scheduler.clear_status_request()
 				_wait_and_process(5, True)
 				if self._socket:
 					self._ensure_upload_url('idle')
 					self._custom_command_list()
 					self._send_capabilities()
+					self._upload_worker.kick()
 				skip_snapshot = False
+				# periodic ticks are scheduled from the previous tick rather than
+				# from when we got around to waiting, so they don't drift
+				tick = _monotonic()
+
+				self._status_encoder.reset()
+				force_status = True
 
 				while self._connected:
 					status, target_set = self._current_status()
-					self._status = status
-					self._logger.debug("emit status: {}".format(repr(status)))
-					self._socket.emit("status", status)
+					frame = self._state.frame
+					if (status['printSeconds'] != frame.print_seconds or
+							status['filamentUsed'] != frame.filament_used):
+						self._state.update(print_seconds=status['printSeconds'],
+								filament_used=status['filamentUsed'])
+					payload = self._status_encoder.encode(status,
+							deltas=self._has_capability('statusDelta'), force=force_status)
+					if payload is not None:
+						self._logger.debug("emit status: {}".format(repr(payload)))
+						self._socket.emit("status", payload,
+								callback=partial(self._status_encoder.acknowledge, payload))
+						self._temperatures.rollover()
+					else:
+						self._logger.debug("status unchanged, not sent")
 					status_sent += 1
 
 					if datetime.datetime.now() > next_check_versions:
@@ -685,18 +1774,26 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 					# reset update interval to slow if we're not printing anymore
 					# we do it here so we get one quick update when it changes
 					if target_set:
-						self._update_interval = 10
+						self._set_update_interval(10)
 					elif not self._cloud_print and not self._printer.is_printing():
-						self._update_interval = 60
-
-					if _wait_and_process(self._update_interval):
+						self._set_update_interval(60)
+
+					force_status = not _wait_until(tick + self._update_interval)
+					if not force_status:
+						tick += self._update_interval
+						if tick + self._update_interval < _monotonic():
+							# fell more than a whole interval behind, don't try to catch up
+							tick = _monotonic()
 						if self._printer.is_closed_or_error() and not self._printer.is_error():
-							if skip_snapshot:
-								continue
+							snapshot = not skip_snapshot
 							skip_snapshot = True
 						else:
+							snapshot = True
 							skip_snapshot = False
-						self._upload_snapshot()
+						if snapshot:
+							self._upload_snapshot()
+						self._upload_worker.kick()
+						self._refresh_upload_urls()
 					if self._shutdown:
 						return
 
@@ -714,6 +1811,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	def _on_disconnect(self):
 		self._logger.debug("[Disconnected]")
 		self._connected = False
+		self._scheduler.wake()
 		# If unregisterd shutdown worker
 		if self._disconnect_on_unregister:
 			self._stop_polar_status()
@@ -721,20 +1819,49 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 
 	#~~ time-lapse and snapshots to cloud
 
-	def _create_timelapse(self):
-		# TODO figure out how to timebox/sizebox the timelapse
-		'gst-launch-1.0 qtmux name=mux ! filesink location="$ARG2"  multifilesrc location="$ARG1" index=1 caps="image/jpeg,framerate=\(fraction\)12/1" ! jpegdec ! videoconvert ! videorate ! x264enc ! mux .'
-
-	def _ensure_upload_url(self, upload_type):
+	# returns a valid upload location for upload_type or None after asking
+	# for one. job_id defaults to the current job, a queued upload may be
+	# for an earlier one
+	def _ensure_upload_url(self, upload_type, job_id=None):
 		if not self._snapshot_url:
+			return None
+		if job_id is None and upload_type != 'idle':
+			job_id = self._job_id
+		return self._upload_locations.ensure(upload_type, job_id)
+
+	# PolarUploadLocations callback, a job_id of None is for an idle upload
+	def _request_upload_url(self, upload_type, job_id):
+		if not self._socket or not self._connected:
 			return False
-		if upload_type != 'idle' and upload_type in self._upload_location and self._upload_location[upload_type]['jobID'] != self._job_id:
-			self._logger.debug("Discarding old upload url: {} for {}".format(upload_type, self._upload_location[upload_type]['jobID']))
-			del self._upload_location[upload_type]
-		if not upload_type in self._upload_location or datetime.datetime.now() > self._upload_location[upload_type]['expires']:
-			self._get_url(upload_type, self._get_job_id() if upload_type == 'idle' else self._job_id)
+		try:
+			self._get_url(upload_type, self._get_job_id() if job_id is None else job_id)
+			return True
+		except Exception:
+			self._logger.exception("Unable to request {} upload url".format(upload_type))
 			return False
-		return True
+
+	# ask for upload urls that are about to expire ahead of time, called
+	# from each heartbeat which might not come around again for
+	# _update_interval
+	def _refresh_upload_urls(self):
+		wanted = {'idle': None}
+		if self._cloud_print and self._job_id != '123':
+			wanted['printing'] = self._job_id
+			wanted['timelapse'] = self._job_id
+		self._upload_locations.refresh(wanted, self._update_interval + 30)
+
+	# _refresh_upload_urls only keeps locations we already have fresh, so ask
+	# for a cloud job's as it starts and the first printing snapshot finds
+	# one waiting
+	def _prefetch_job_upload_urls(self):
+		if not self._cloud_print or self._job_id == '123':
+			return
+		upload_types = ['printing']
+		if self._settings.get_boolean(['upload_timelapse']):
+			upload_types.append('timelapse')
+		for upload_type in upload_types:
+			self._scheduler.put(partial(self._ensure_upload_url, upload_type),
+					PolarHeartbeatScheduler.PRIORITY_CONTROL)
 
 	def _upload_snapshot(self):
 		self._logger.debug("_upload_snapshot")
@@ -742,11 +1869,11 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		if self._cloud_print and self._job_id != '123' and (self._printer.is_printing() or self._printer.is_paused()):
 			upload_type = 'printing'
 		self._logger.debug("upload_type {}".format(upload_type))
-		if not self._ensure_upload_url(upload_type):
+		loc = self._ensure_upload_url(upload_type)
+		if not loc:
 			return
 		try:
-			loc = self._upload_location[upload_type]
-			r = requests.get(self._snapshot_url, timeout=5)
+			r = self._http.webcam().get(self._snapshot_url, timeout=5)
 			r.raise_for_status()
 		except Exception:
 			self._logger.exception("Could not capture image from {}".format(self._snapshot_url))
@@ -755,6 +1882,16 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		try:
 			image_bytes = r.content
 			image_size = len(image_bytes)
+			if image_size == 0:
+				self._logger.debug("Image content is length 0 from {}, not uploading to PolarCloud".format(self._snapshot_url))
+				return
+			fingerprint = self._snapshot_changes.fingerprint(image_bytes)
+			# a print grows a layer at a time, too slowly between snapshots for
+			# the hash to see, so only idle snapshots are skipped
+			if upload_type == 'idle' and not self._snapshot_changes.is_changed(upload_type, fingerprint):
+				self._snapshot_changes.skip()
+				self._logger.debug("Snapshot unchanged since last upload, skipping")
+				return
 			needs_transform = self._image_transpose
 			needs_resize = image_size > self._max_image_size
 
@@ -762,43 +1899,26 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				if _pillow_available:
 					# Use PIL for resize and transforms
 					self._logger.debug("Using PIL to process snapshot")
-					buf = BytesIO()
-					buf.write(image_bytes)
-					image = Image.open(buf)
-					image.thumbnail((640, 480))
+					transforms = []
 					if self._settings.global_get(["webcam", "flipH"]):
-						image = image.transpose(Image.FLIP_LEFT_RIGHT)
+						transforms.append(Image.FLIP_LEFT_RIGHT)
 					if self._settings.global_get(["webcam", "flipV"]):
-						image = image.transpose(Image.FLIP_TOP_BOTTOM)
+						transforms.append(Image.FLIP_TOP_BOTTOM)
 					if self._settings.global_get(["webcam", "rotate90"]):
-						image = image.transpose(Image.ROTATE_90)
-					# Try different quality levels to get under max_size
-					for quality in [85, 70, 55, 40, 25]:
-						output = BytesIO()
-						image.save(output, format="jpeg", quality=quality)
-						output.seek(0, 2)
-						new_image_size = output.tell()
-						if new_image_size <= self._max_image_size:
-							output.seek(0)
-							image_bytes = output
-							self._logger.debug("PIL compressed image from {} to {} bytes (quality {})".format(
-								image_size, new_image_size, quality))
-							image_size = new_image_size
-							break
-					else:
-						# Even lowest quality didn't work, use it anyway
-						output.seek(0)
-						image_bytes = output
-						self._logger.debug("PIL compressed image from {} to {} bytes (min quality)".format(
-							image_size, new_image_size))
-						image_size = new_image_size
+						transforms.append(Image.ROTATE_90)
+					compressed = self._jpeg_encoder.compress(image_bytes,
+							self._max_image_size, upload_type, transforms)
+					self._logger.debug("PIL compressed image from {} to {} bytes".format(
+						image_size, len(compressed)))
+					image_bytes = compressed
+					image_size = len(compressed)
 				elif _ffmpeg_path:
 					# Fall back to ffmpeg for compression (no transforms)
 					if needs_transform:
 						self._logger.warning("PIL not available, ffmpeg cannot apply image transforms (flip/rotate)")
 					if needs_resize:
 						self._logger.debug("Using ffmpeg to compress snapshot")
-						compressed = _resize_image_ffmpeg(image_bytes, self._max_image_size, self._logger)
+						compressed = self._ffmpeg_compressor.compress(image_bytes, self._max_image_size, upload_type)
 						if compressed != image_bytes:
 							image_bytes = compressed
 							image_size = len(image_bytes)
@@ -813,31 +1933,118 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			if image_size == 0:
 				self._logger.debug("Image content is length 0 from {}, not uploading to PolarCloud".format(self._snapshot_url))
 				return
-			p = requests.post(loc['url'], data=loc['fields'], files={'file': ('image.jpg', image_bytes)})
+		except Exception:
+			self._logger.exception("Could not process snapshot from {}".format(self._snapshot_url))
+			return
+
+		try:
+			p = self._http.for_url(loc['url']).post(loc['url'], data=loc['fields'], files={'file': ('image.jpg', image_bytes)})
 			p.raise_for_status()
 			self._logger.debug("{}: {}".format(p.status_code, p.content))
+			self._snapshot_changes.mark_sent(upload_type, fingerprint)
+			# a queued snapshot of this type is older than this one
+			self._upload_queue.discard(upload_type)
 
 			self._logger.debug("Image captured from {}".format(self._snapshot_url))
 		except Exception:
-			self._logger.exception("Could not post snapshot to PolarCloud")
+			self._logger.exception("Could not post snapshot to PolarCloud, queueing it")
+			self._queue_snapshot(upload_type, image_bytes)
+
+	# keep the latest snapshot that failed to upload for another try
+	def _queue_snapshot(self, upload_type, image_bytes):
+		path = os.path.join(self._upload_queue.folder, '{}.jpg'.format(upload_type))
+		try:
+			if not os.path.isdir(self._upload_queue.folder):
+				os.makedirs(self._upload_queue.folder)
+			with open(path, 'wb') as f:
+				f.write(image_bytes)
+		except (IOError, OSError):
+			self._logger.exception("Unable to save snapshot for upload later")
+			return
+		job_id = self._get_job_id() if upload_type == 'idle' else self._job_id
+		self._upload_queue.add(job_id, upload_type, path, coalesce=True, owned=True, max_attempts=3)
 
 	def _upload_timelapse(self, path):
 		self._logger.debug("_upload_timelapse")
-		self._pstate = self.PSTATE_COMPLETE
-		self._pstate_counter = 3
+		self._state.announce(self.PSTATE_COMPLETE)
 		if not path:
 			return
-		if not self._ensure_upload_url('timelapse'):
-			self._logger.error("Unable to retrieve valid destination to upload timelapse {}".format(path))
+		self._upload_queue.add(self._job_id, 'timelapse', path,
+				max_attempts=self._settings.get_int(['upload_retries']) or 1)
+		self._upload_worker.kick()
+
+	# try the uploads in the queue that are due, run on the upload worker
+	def _process_upload_queue(self):
+		if not self._connected or not self._upload_queue:
 			return
+		# entries for the same type and job share an upload location, wait
+		# for it at most once per pass
+		missing = set()
+		for entry in self._upload_queue.due():
+			if not self._connected:
+				return
+			upload_type = entry['upload_type']
+			path = entry['path']
+			if not os.path.exists(path):
+				self._logger.warning("Queued upload {} no longer exists".format(path))
+				self._upload_queue.done(entry)
+				continue
+			key = (upload_type, entry['job_id'])
+			loc = None
+			if not key in missing:
+				loc = (self._ensure_upload_url(upload_type, entry['job_id']) or
+						self._upload_locations.wait(upload_type, entry['job_id'], 10))
+			if not loc:
+				# counts as an attempt, so an upload Polar Cloud won't give a
+				# url for backs off and is eventually given up on
+				self._logger.warning("No {} upload url for job {}, will retry".format(upload_type, entry['job_id']))
+				missing.add(key)
+				self._upload_queue.failed(entry)
+				continue
+			max_size = _int_or_none(loc.get('maxSize'))
+			if max_size and os.path.getsize(path) > max_size:
+				self._logger.error("{} is {} bytes, over the {} byte limit for upload".format(
+					path, os.path.getsize(path), max_size))
+				self._upload_queue.done(entry)
+				continue
+			filename = 'timelapse.mp4' if upload_type == 'timelapse' else 'image.jpg'
+			try:
+				self._logger.debug("Uploading {} {} (attempt {})".format(upload_type, path, entry['attempts'] + 1))
+				with open(path, 'rb') as f:
+					p = self._http.for_url(loc['url']).post(loc['url'], data=loc['fields'], files={'file': (filename, f)})
+				p.raise_for_status()
+				self._logger.debug("{} upload result {}: {}".format(upload_type, p.status_code, p.content))
+				self._upload_queue.done(entry)
+			except Exception:
+				self._logger.exception("Could not upload {} to PolarCloud, will retry".format(path))
+				# the url may be why, eg. an expired policy, so get a fresh one
+				self._upload_locations.discard(upload_type, entry['job_id'])
+				self._upload_queue.failed(entry)
+
+	# upload a timelapse as it's being encoded, chunks is an iterable of bytes
+	# that's streamed into a multipart body, returns True if it was uploaded
+	def _stream_timelapse(self, chunks):
+		loc = self._ensure_upload_url('timelapse')
+		if not loc:
+			return False
+		boundary = uuid.uuid4().hex
 		try:
-			self._logger.debug("Uploading timelapse {}".format(path))
-			loc = self._upload_location['timelapse']
-			p = requests.post(loc['url'], data=loc['fields'], files={'file': ('timelapse.mp4', open(path, 'rb'))})
+			self._logger.debug("Streaming timelapse upload")
+			p = self._http.for_url(loc['url']).post(loc['url'],
+					data=multipart_stream(loc['fields'], 'file', 'timelapse.mp4', 'video/mp4', chunks, boundary),
+					headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
 			p.raise_for_status()
 			self._logger.debug("timelapse upload result {}: {}".format(p.status_code, p.content))
+			return True
 		except Exception:
-			self._logger.exception("Could not upload timelapse {} to PolarCloud".format(path))
+			self._logger.exception("Could not stream timelapse to PolarCloud")
+			return False
+
+	# wait a little while for a getUrl response for upload_type to arrive,
+	# returns its maxSize or None if there isn't one
+	def _upload_max_size(self, upload_type, timeout=10):
+		loc = self._upload_locations.wait(upload_type, self._job_id, timeout)
+		return _int_or_none(loc.get('maxSize')) if loc else None
 
 	#~~ getUrl -> polar: getUrlResponse
 
@@ -854,13 +2061,18 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			return
 		if not has_all(response, 'type', 'expires', 'url', 'maxSize', 'fields'):
 			self._logger.warn('getUrlResponse lacks a required property')
-		response["expires"] = (datetime.datetime.now() + datetime.timedelta(seconds=int(response.get("expires", 0))))
+		expires_in = int(response.get("expires", 0))
+		response["expires"] = (datetime.datetime.now() + datetime.timedelta(seconds=expires_in))
 		if not has_all(response, 'jobID'):
-			response["jobID"] = self._job_id
-		self._upload_location[response.get('type', 'idle')] = response
+			# file it under the job we asked for
+			response["jobID"] = (self._upload_locations.requested_job_id(response.get('type', 'idle')) or
+					self._job_id)
+		self._upload_locations.set(response, expires_in, response["jobID"])
 		self._logger.debug('response_type = {}'.format(response.get('type', '')))
 		if response.get('type', '') == 'idle':
-			self._task_queue.put(self._upload_snapshot)
+			self._scheduler.put(self._upload_snapshot, PolarHeartbeatScheduler.PRIORITY_UPLOAD)
+		if self._upload_queue:
+			self._upload_worker.kick()
 
 	# get upload url from the cloud
 	# url_type - 'idle' | 'printing' | 'timelapse'
@@ -883,13 +2095,13 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			self._challenge = welcome['challenge']
 			if not isinstance(self._challenge, bytes):
 				self._challenge = self._challenge.encode('utf-8')
-			self._task_queue.put(self._hello)
+			self._scheduler.put(self._hello, PolarHeartbeatScheduler.PRIORITY_HANDSHAKE)
 
 	def _hello(self):
 		self._logger.debug('hello')
 		if self._serial and self._challenge:
 			self._hello_sent = True
-			self._status_now = True
+			self._scheduler.request_status()
 			self._logger.debug('emit hello')
 			self._machine_type = self._settings.get(["machine_type"])
 			self._printer_type = self._settings.get(["printer_type"])
@@ -929,6 +2141,15 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		if 'capabilities' in response:
 			self._capabilities = response['capabilities']
 
+	# capabilities from Polar Cloud can be a list of names or a dict of flags
+	def _has_capability(self, name):
+		capabilities = self._capabilities
+		if isinstance(capabilities, dict):
+			return bool(capabilities.get(name))
+		if isinstance(capabilities, (list, tuple)):
+			return name in capabilities
+		return False
+
 	def _send_capabilities(self):
 		self._socket.emit('capabilities', {
 			'serialNumber': self._serial,
@@ -951,7 +2172,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			self._settings.set(['email'], self._email)
 			self._settings.set(['pin'], self._pin)
 			self._settings.save()
-			self._status_now = True
+			self._scheduler.request_status()
 			self._plugin_manager.send_plugin_message(self._identifier, {
 				'command': 'registration_success',
 				'serial': self._serial,
@@ -1022,7 +2243,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			self._settings.set(['email'], '')
 			self._settings.set(['pin'], '')
 			self._settings.save()
-			self._status_now = True
+			self._scheduler.request_status()
 			self._serial = None
 			self._plugin_manager.send_plugin_message(self._identifier, {
 				'command': 'unregistration_success',
@@ -1055,8 +2276,25 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	def _on_cancel(self, data, *args, **kwargs):
 		if not self._valid_packet(data):
 			return
+		if self._cancel_preparation():
+			self._logger.info("PolarCloud cancelled job {} while it was being prepared".format(self._job_id))
+			self._state.announce(self.PSTATE_CANCELLING)
+			if self._job_pending:
+				self._job(self._job_id, "canceled")
 		self._printer.cancel_print()
-		self._status_now = True
+		self._scheduler.request_status()
+
+	# stop any download, slicing etc. for cloud prints that haven't started
+	# printing yet, returns True if there was anything to stop
+	def _cancel_preparation(self):
+		with self._preparation_lock:
+			cancelled = self._print_pipeline.cancel()
+			preparer = self._print_preparer
+			self._print_preparer = None
+		if preparer and preparer.is_alive():
+			preparer.cancel()
+			cancelled = True
+		return cancelled
 
 	#~~ command
 
@@ -1064,7 +2302,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		if not self._valid_packet(data):
 			return
 		self._printer.commands(data.get("command", ""))
-		self._status_now = True
+		self._scheduler.request_status()
 		# TODO commandResponse?
 
 	#~~ pause
@@ -1074,7 +2312,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			return
 		# TODO data['type'] = filament, cold, pause
 		self._printer.pause_print()
-		self._status_now = True
+		self._scheduler.request_status()
 
 	#~~ print
 	def _get_slicer_name(self):
@@ -1092,15 +2330,17 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._logger.debug("on_print {0}".format(repr(data)))
 		if not self._valid_packet(data):
 			return
-		if self._print_preparer and self._print_preparer.is_alive():
-			self._logger.warn("PolarCloud sent a print command, but the plugin thinks we're still slicing.")
-			return
-
 		if self._printer.is_printing() or self._printer.is_paused():
 			self._logger.warn("PolarCloud sent print command, but OctoPrint is already printing.")
 			return
 
-		self._job_id = "123"
+		# a new print supersedes one that's still being prepared
+		if self._cancel_preparation():
+			self._logger.info("PolarCloud sent a print command while preparing job {}, cancelling that".format(self._job_id))
+			if self._job_pending:
+				self._job(self._job_id, "canceled")
+
+		self._state.update(job_id="123")
 
 		# if the service doesn't tell us which type to print, we'll assume that
 		# we're supposed to download and print the gcode, unless they didn't give
@@ -1112,7 +2352,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		elif 'gcodeFile' in data:
 			print_type = 'gcodeFile'
 		if not print_type in data:
-			self._logger.warn("PolarCloud sent print command, but data didn't contain a {} url.", print_type)
+			self._logger.warn("PolarCloud sent print command, but data didn't contain a {} url.".format(print_type))
 			return
 		print_file = data[print_type]
 
@@ -1123,102 +2363,220 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			'stlFile' : '.stl'
 			}
 		if not print_type in mapTypeToExt:
-			self._logger.warn("PolarCloud asked us to print the {}, but this plugin doesn't know how to handle that type.", print_type)
+			self._logger.warn("PolarCloud asked us to print the {}, but this plugin doesn't know how to handle that type.".format(print_type))
+			return
 		ext = mapTypeToExt[print_type]
 
+		if print_type == 'stlFile' and not 'configFile' in data:
+			# need to slice then, so make sure we're set up to do that
+			self._logger.warn("PolarCloud sent print command without slicing profile.")
+			return
+
+		job_id = data['jobId'] if 'jobId' in data else "123"
+		self._logger.debug("print jobId is {}".format(job_id))
 		self._logger.debug("PolarCloud requested to print {}. Downloading to a file with ext: {}.".format(print_file, ext))
 
-		info = {}
-		pos = (0, 0)
-		slicer = 'curalegacy'
-		if print_type == 'stlFile':
-			self._logger.debug("Checking slicer configuration.")
-			# need to slice then, so make sure we're set up to do that
-			if not 'configFile' in data:
-				self._logger.warn("PolarCloud sent print command without slicing profile.")
-				return
-			info['config'] = data['configFile']
-			try:
-				req_ini = requests.get(data['configFile'], timeout=5)
-				req_ini.raise_for_status()
-			except Exception:
-				self._logger.exception("Could not retrieve slicer config file from PolarCloud: {}".format(data['configFile']))
-				return
-			slicer = self._get_slicer_name()
-			slicing_profile = None
+		job = PolarPrintJob(job_id, print_type, print_file, ext, data.get('configFile'))
+
+		self._state.start_job(job_id, job.info)
+		self._scheduler.request_status()
+
+		if not self._print_pipeline.submit(job):
+			self._logger.warn("PolarCloud sent a print command, but the plugin is still preparing the last one.")
+			self._on_preparation_failed(job)
+
+	#~~ print preparation stages, run on the print pipeline's worker thread
+
+	def _prepare_fetch(self, job):
+		if job.print_type != 'stlFile':
+			self._fetch_print_file(job, job.cancel_event)
+			return
+		# the slicing profile and the model don't depend on each other, so
+		# fetch (and translate) them at the same time
+		run_concurrently([
+				lambda cancel_event: self._fetch_slicing_profile(job, cancel_event),
+				lambda cancel_event: self._fetch_print_file(job, cancel_event),
+			], job.cancel_event)
+
+	def _fetch_slicing_profile(self, job, cancel_event=None):
+		self._logger.debug("Checking slicer configuration.")
+		try:
+			ini_path = self._download(job.config_file, '.ini', cancel_event)
 			try:
-				(slicing_profile, pos) = self._create_slicing_profile(slicer, req_ini.content)
-			except (UnknownSlicer, SlicerNotConfigured):
-				#TODO tell PolarCloud that we don't have a slicer so it can tell the user
-				pass
-			if slicing_profile is None:
-				self._logger.warn("Unable to create slicing profile. Aborting slice and print.")
-				return
+				with open(ini_path, 'rb') as f:
+					config_file_bytes = f.read()
+			finally:
+				_remove_quietly(ini_path)
+		except PolarDownloadCancelled:
+			raise
+		except Exception:
+			self._logger.exception("Could not retrieve slicer config file from PolarCloud: {}".format(job.config_file))
+			raise PolarPrintError("Unable to download slicing profile.")
+		if cancel_event and cancel_event.is_set():
+			return
+		job.slicer = self._get_slicer_name()
+		slicing_profile = None
+		try:
+			(slicing_profile, job.pos) = self._create_slicing_profile(job.slicer, config_file_bytes)
+		except (UnknownSlicer, SlicerNotConfigured):
+			#TODO tell PolarCloud that we don't have a slicer so it can tell the user
+			pass
+		if slicing_profile is None:
+			raise PolarPrintError("Unable to create slicing profile. Aborting slice and print.")
+		job.slicing_profile = slicing_profile
 
+	def _fetch_print_file(self, job, cancel_event=None):
 		# get the print_file from the cloud
-		# TODO: use tornado async I/O to get the print file?
 		try:
-			info['file'] = print_file
-			req_stl = requests.get(print_file, timeout=5)
-			req_stl.raise_for_status()
+			job.download_path = self._download(job.print_file, job.ext, cancel_event)
+		except PolarDownloadCancelled:
+			self._logger.debug("Download of {} cancelled".format(job.print_file))
+			raise
 		except Exception:
-			self._logger.exception("Could not retrieve print file from PolarCloud: {}".format(print_file))
-			return
+			self._logger.exception("Could not retrieve print file from PolarCloud: {}".format(job.print_file))
+			raise PolarPrintError("Unable to download print file.")
 
+	def _prepare_inspect(self, job):
+		if job.print_type != 'stlFile':
+			return
+		try:
+			stats = inspect_stl(job.download_path)
+		except Exception:
+			# leave it to the slicer to complain about
+			self._logger.exception("Unable to inspect {}".format(job.print_file))
+			return
+		self._logger.debug("Model {}: {}".format(job.print_file, repr(stats)))
+		size = [hi - lo for lo, hi in zip(stats['min'], stats['max'])]
+		details = "{} triangles, {:.1f} x {:.1f} x {:.1f} mm, {:.2f} cm3".format(
+			stats['triangles'], size[0], size[1], size[2], stats['volume'] / 1000.0)
+		misfit = stl_misfit(stats, self._printer_profile_manager.get_current_or_default().get('volume', {}), job.pos)
+		if misfit:
+			details += ", won't fit: " + misfit
+		job.info['sliceDetails'] = details
+		self._state.update_info(job.job_id, sliceDetails=details)
+		if misfit:
+			raise PolarPrintError("Model doesn't fit the printer, " + misfit)
+
+	def _prepare_store(self, job):
 		path = self._file_manager.add_folder(FileDestinations.LOCAL, "polarcloud")
 		path = self._file_manager.join_path(FileDestinations.LOCAL, path, "current-print")
-		pathGcode = path + ".gcode"
-		path = path + ext
-		self._logger.debug("Adding PolarCloud download as {}".format(path))
-		self._file_manager.add_file(FileDestinations.LOCAL, path, StreamWrapper(path, BytesIO(req_stl.content)), allow_overwrite=True)
-		job_id = data['jobId'] if 'jobId' in data else "123"
-		self._logger.debug("print jobId is {}".format(job_id))
-		self._logger.debug("print data is {}".format(repr(data)))
+		job.path_gcode = path + ".gcode"
+		job.path = path + job.ext
+		self._logger.debug("Adding PolarCloud download as {}".format(job.path))
+		if job.print_type == 'stlFile' and self._slice_cache.enabled:
+			job.slice_key = PolarSliceCache.key(job.download_path, job.slicer,
+					job.slicing_profile, list(job.pos),
+					self._printer_profile_manager.get_current_or_default())
+		try:
+			self._file_manager.add_file(FileDestinations.LOCAL, job.path, DiskFileWrapper(job.path, job.download_path), allow_overwrite=True)
+		finally:
+			_remove_quietly(job.download_path)
+			job.download_path = None
 
+	def _prepare_printer(self, job):
 		if self._printer.is_closed_or_error():
 			self._printer.disconnect()
 			self._printer.connect()
 
-		self._cloud_print = True
-		self._job_pending = True
-		self._job_id = job_id
-		self._pstate_counter = 0
-		self._pstate = self.PSTATE_PREPARING
-		self._cloud_print_info = info
-		self._status_now = True
-
+	def _prepare_start(self, job):
 		def _on_upload_success(filename, full_path, destination):
+			if job.cancel_event.is_set():
+				return
 			self._printer.select_file(full_path, destination == FileDestinations.SDCARD, printAfterSelect=True)
 
-		if print_type == 'threemfFile':
+		# a cancel since the last stage mustn't start the print
+		if job.cancel_event.is_set():
+			raise PolarPrintCancelled(job.job_id)
+		if job.print_type == 'threemfFile':
 			# upload the 3mf file to the printer's SD card
 			self._printer.add_sd_file("polar-cloud.gcode.3mf",
-					self._file_manager.path_on_disk(FileDestinations.LOCAL, path), 
+					self._file_manager.path_on_disk(FileDestinations.LOCAL, job.path),
 					on_success=_on_upload_success)
-		elif print_type == 'stlFile':
-			# prepare the gcode file by slicing
-			self._print_preparer = PolarPrintPreparer(slicer,
-					self._file_manager, path, pathGcode, pos,
-					self._on_slicing_complete, self._on_slicing_failed,
-					self._logger)
-			self._print_preparer.prepare()
+		elif job.print_type == 'stlFile':
+			cached = self._slice_cache.get(job.slice_key) if job.slice_key else None
+			if cached:
+				self._logger.debug("Sliced {} before, using {}".format(job.print_file, cached))
+				self._file_manager.add_file(FileDestinations.LOCAL, job.path_gcode,
+						DiskFileWrapper(job.path_gcode, cached, move=False), allow_overwrite=True)
+				if job.cancel_event.is_set():
+					raise PolarPrintCancelled(job.job_id)
+				self._on_slicing_complete(self._file_manager.path_on_disk(FileDestinations.LOCAL, job.path_gcode))
+				return
+			# slice into a file of our own rather than through the file manager,
+			# so the slice can be cancelled and nothing half sliced is kept
+			fd, job.sliced_path = tempfile.mkstemp(prefix="slicing-", suffix=".gcode",
+					dir=self.get_plugin_data_folder())
+			os.close(fd)
+			with self._preparation_lock:
+				if job.cancel_event.is_set():
+					raise PolarPrintCancelled(job.job_id)
+				preparer = self._print_preparer = PolarPrintPreparer(job.slicer, self._slicing_manager,
+						self._file_manager.path_on_disk(FileDestinations.LOCAL, job.path),
+						job.sliced_path, job.pos, job.cancel_event,
+						partial(self._on_job_sliced, job), partial(self._on_job_slicing_failed, job),
+						self._logger)
+			# not under the lock, the slicing manager calls back right away for
+			# some failures and the callbacks take it
+			preparer.prepare()
 		else:
-			self._on_slicing_complete(self._file_manager.path_on_disk(FileDestinations.LOCAL, path))
+			self._on_slicing_complete(self._file_manager.path_on_disk(FileDestinations.LOCAL, job.path))
 
-	def _on_slicing_failed(self, e):
-		self._logger.exception("Unable to slice.")
-		self._pstate = self.PSTATE_ERROR
-		self._pstate_counter = 3
-		self._print_preparer = None
+	def _on_preparation_failed(self, job):
+		self._discard_preparation(job)
+		if job.job_id != self._job_id:
+			return
+		self._state.announce(self.PSTATE_ERROR)
+		self._scheduler.request_status()
+
+	# state was already updated by whoever cancelled it
+	def _on_preparation_cancelled(self, job):
+		self._logger.debug("Print job {} cancelled in stage {}".format(job.job_id, job.stage))
+		self._discard_preparation(job)
+
+	def _discard_preparation(self, job):
+		for attr in ('download_path', 'sliced_path'):
+			if getattr(job, attr):
+				_remove_quietly(getattr(job, attr))
+				setattr(job, attr, None)
+
+	def _on_job_slicing_failed(self, job, error=None):
+		with self._preparation_lock:
+			if self._print_preparer and self._print_preparer.cancel_event is job.cancel_event:
+				self._print_preparer = None
+		self._discard_preparation(job)
+		if job.cancel_event.is_set():
+			self._logger.debug("Slicing print job {} cancelled".format(job.job_id))
+			return
+		self._logger.error("Unable to slice: {}".format(error))
+		if job.job_id != self._job_id:
+			return
+		self._state.announce(self.PSTATE_ERROR)
+		self._scheduler.request_status()
+
+	def _on_job_sliced(self, job, path):
+		if job.cancel_event.is_set():
+			self._discard_preparation(job)
+			return
+		try:
+			if job.slice_key:
+				self._slice_cache.put(job.slice_key, path)
+			self._file_manager.add_file(FileDestinations.LOCAL, job.path_gcode,
+					DiskFileWrapper(job.path_gcode, path), allow_overwrite=True)
+			job.sliced_path = None
+		except Exception as e:
+			self._logger.exception("Unable to add sliced {}".format(job.path_gcode))
+			self._on_job_slicing_failed(job, e)
+			return
+		self._on_slicing_complete(self._file_manager.path_on_disk(FileDestinations.LOCAL, job.path_gcode))
 
 	def _on_slicing_complete(self, path, *args, **kwargs):
-		# TODO store self._cloud_print_info[sliceDetails]
 		self._logger.debug("_on_slicing_complete")
-		self._pstate = self.PSTATE_PRINTING
+		self._state.update(pstate=self.PSTATE_PRINTING)
 		self._printer.select_file(path, False, printAfterSelect=True)
-		self._update_interval = 10
-		self._status_now = True
-		self._print_preparer = None
+		self._set_update_interval(10)
+		self._scheduler.request_status()
+		with self._preparation_lock:
+			self._print_preparer = None
 
 	#~~ resume
 
@@ -1226,7 +2584,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		if not self._valid_packet(data):
 			return
 		self._printer.resume_print()
-		self._status_now = True
+		self._scheduler.request_status()
 
 	#~~ temperature
 
@@ -1237,7 +2595,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			if re.match("(?:bed)|(?:tool[0-9]+)", key):
 				self._logger.debug("set_temperature {} to {}", key, data[key])
 				self._printer.set_temperature(key, data[key])
-		self._status_now = True
+		self._scheduler.request_status()
 
 	#~~ update
 
@@ -1372,20 +2730,21 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 
 	def _job(self, job_id, state):
 		self._logger.debug('job')
-		self._job_pending = False
+		self._state.job_reported()
 		if self._serial:
 			payload = {
 				'serialNumber': self._serial,
 				'jobId': job_id,
 				'state': state,
 			}
-			if self._status:
+			frame = self._state.frame
+			if frame.print_seconds is not None:
 				# send along the stats from the most recent status
-				payload['filamentUsed'] = self._status['filamentUsed']
-				payload['printSeconds'] = self._status['printSeconds']
+				payload['filamentUsed'] = frame.filament_used
+				payload['printSeconds'] = frame.print_seconds
 			self._logger.debug("job payload: {}".format(payload))
 			self._socket.emit('job', payload)
-		self._status_now = True
+		self._scheduler.request_status()
 
 	#~~ connectPrinter
 
@@ -1398,78 +2757,62 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				self._printer.connect()
 			except:
 				self._logger.exception("Unable to reconnect to the printer")
-		self._status_now = True
+		self._scheduler.request_status()
 
 	#~~ EventHandlerPlugin mixin
 
 	def on_event(self, event, payload):
 		self._logger.debug("on_event: {}".format(repr(event)))
-		if event == Events.PRINT_CANCELLED or event == Events.PRINT_FAILED:
-			self._pstate = self.PSTATE_CANCELLING
-			if self._cloud_print:
-				self._pstate_counter = 3
-		elif event == Events.PRINT_STARTED or event == Events.PRINT_RESUMED:
-			self._pstate = self.PSTATE_PRINTING
-			self._update_interval = 10
-			self._logger.debug("Update interval to {}".format(self._update_interval))
-		elif event == Events.ERROR:
-			self._pstate = self.PSTATE_ERROR
-		elif event == Events.PRINT_PAUSED:
-			self._pstate = self.PSTATE_PAUSED
+		if event == Events.SHUTDOWN:
+			self._shutdown = True
+			self._scheduler.wake()
+			self._upload_worker.stop()
+			self._http.close()
+			self._printer.unregister_callback(self._temperatures)
+			return
+		if not event in self.JOB_EVENTS and not event in self.STATUS_EVENTS:
+			return
+
+		# the state machine follows the print events, what's left here are
+		# the side effects
+		self._state.handle_event(event)
+		if event == Events.PRINT_STARTED or event == Events.PRINT_RESUMED:
+			self._set_update_interval(10)
+			if event == Events.PRINT_STARTED:
+				self._prefetch_job_upload_urls()
 		elif event == Events.PRINT_DONE:
-			self._pstate = self.PSTATE_COMPLETE
-			if self._cloud_print:
-				self._pstate = self.PSTATE_POSTPROCESSING
-				self._pstate_counter = 3
-				self._next_pending = True
-			if self._status and "time" in payload:
-				self._status["printSeconds"] = payload["time"]
+			if self._state.frame.print_seconds is not None and "time" in payload:
+				self._state.update(print_seconds=payload["time"])
 			self._job(self._job_id, "completed")
 		elif event == Events.SLICING_CANCELLED or event == Events.SLICING_FAILED:
-			self._pstate = self.PSTATE_CANCELLING
-			self._pstate_counter = 3
-			if self._status and "time" in payload:
-				self._status["printSeconds"] = payload["time"]
+			if self._state.frame.print_seconds is not None and "time" in payload:
+				self._state.update(print_seconds=payload["time"])
 		elif event == Events.SETTINGS_UPDATED:
 			self._update_local_settings()
 			if (self._printer_type != self._settings.get(['printer_type'])):
-				self._task_queue.put(self._hello)
-			self._status_now = True
-			return
-		elif event == Events.MOVIE_RENDERING or event == Events.POSTROLL_START:
-			if self._cloud_print:
-				self._pstate = self.PSTATE_POSTPROCESSING
-				self._pstate_counter = 0
-			self._status_now = True
-			return
-		elif event == Events.MOVIE_FAILED:
-			self._pstate = self.PSTATE_IDLE
-			if self._cloud_print:
-				self._pstate = self.PSTATE_COMPLETE
-				self._pstate_counter = 3
-			self._status_now = True
-			return
+				self._scheduler.put(self._hello, PolarHeartbeatScheduler.PRIORITY_HANDSHAKE)
+		elif event == Events.MOVIE_RENDERING:
+			if self._cloud_print and self._settings.get_boolean(['upload_timelapse']):
+				# have the url ready by the time the movie is
+				self._scheduler.put(partial(self._ensure_upload_url, 'timelapse'),
+						PolarHeartbeatScheduler.PRIORITY_CONTROL)
 		elif event == Events.MOVIE_DONE:
 			if self._cloud_print and self._settings.get_boolean(['upload_timelapse']):
 				self._ensure_upload_url('timelapse')
 				translate = PolarTimelapseTranscoder(payload["movie"],
-						self._upload_timelapse, self._logger)
-				self._pstate = self.PSTATE_POSTPROCESSING
+						self._upload_timelapse, self._logger,
+						threads=self._settings.get_int(['timelapse_threads']) or 1,
+						max_size=lambda: self._upload_max_size('timelapse'),
+						max_duration=self._settings.get_int(['timelapse_max_duration']) or 0,
+						upload_stream=self._stream_timelapse if self._settings.get_boolean(['timelapse_streaming_upload']) else None)
+				self._state.update(pstate=self.PSTATE_POSTPROCESSING)
 				translate.translate_timelapse()
 			else:
-				self._pstate = self.PSTATE_COMPLETE
-				self._pstate_counter = 3
-		elif event == Events.SHUTDOWN:
-			self._shutdown = True
-			return
-		elif hasattr(Events, 'PRINTER_STATE_CHANGED') and event == Events.PRINTER_STATE_CHANGED:
-			self._status_now = True
-			return
-		else:
-			return
+				self._state.announce(self.PSTATE_COMPLETE)
 
-		self._status_now = True
-		if self._job_pending and not self._printer.is_printing() and not self._printer.is_paused() and self._pstate != self.PSTATE_PREPARING:
+		self._scheduler.request_status()
+		if (event in self.JOB_EVENTS and self._job_pending and not self._printer.is_printing() and
+				not self._printer.is_paused() and self._pstate != self.PSTATE_PREPARING):
 			self._logger.debug("emitting job due to event: {}".format(event))
 			self._job(self._job_id, "canceled")
 
@@ -1513,277 +2856,667 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		return flask.jsonify({'status': status, 'message': message})
 
 	def on_api_get(self, request):
-		return flask.jsonify({'capabilities': self._capabilities})
+		return flask.jsonify({
+			'capabilities': self._capabilities,
+			'snapshots': self._snapshot_changes.stats(),
+			'slice_cache': self._slice_cache.stats() if self._slice_cache else None,
+			'download_cache': self._download_cache.stats() if self._download_cache else None,
+		})
 
 	#~~ Slicing profile
 	def _create_slicing_profile(self, slicer, config_file_bytes):
-
-		class ConfigFileReader(StringIO, object):
-			def __init__(self, *args, **kwargs):
-				self._dummy_section = True
-				self._indent = False
-				return super(ConfigFileReader, self).__init__(*args, **kwargs)
-
-			def readline(self):
-				if self._dummy_section:
-					self._dummy_section = False
-					return "[x]"
-				line = super(ConfigFileReader, self).readline()
-				if self._indent:
-					line = "    " + line
-				if '"""' in line:
-					self._indent = not self._indent
-				return line
-
-		# create an in memory "file" of the profile and prepend a dummy section
-		# header so ConfigParser won't give up so easily
-		# DEBUG
-		with open("/home/pi/foo.ini", "w") as ini_file:
-			ini_file.write(config_file_bytes.decode('utf-8'))
-		config_file = ConfigFileReader(config_file_bytes.decode('utf-8'))
-
-		try:
-			import configparser
-		except ImportError:
-			import ConfigParser as configparser
-		config = configparser.ConfigParser(interpolation=None)
 		try:
-			config.readfp(config_file)
-		except:
+			printer_profile = self._printer_profile_manager.get_current_or_default()
+			profile, pos = _slicing_profile_translator.translate(config_file_bytes.decode('utf-8'),
+					printer_profile["extruder"]["nozzleDiameter"], self._logger)
+		except Exception:
 			self._logger.exception("Error while reading PolarCloud slicing configuration.")
-			return None
-
-		printer_profile = self._printer_profile_manager.get_current_or_default()
-
-		# get a few ahead of time since other translations are dependent
-
-		# extrusion_width
-		extrusion_width = printer_profile["extruder"]["nozzleDiameter"]
-		if "extrusionWidth" in config.options("x"):
-			extrusion_width = config.getfloat("x", "extrusionWidth") / 1000.0
-		elif "extrusion_width" in config.options("x"):
-			layer_height = config.getfloat("x", "extrusion_width")
-
-		# layer_height
-		layer_height = 0.2
-		if "layerThickness" in config.options("x"):
-			layer_height = config.getfloat("x", "layerThickness") / 1000
-		elif "layer_height" in config.options("x"):
-			layer_height = config.getfloat("x", "layer_height")
-
-		# first layer height
-		init_layer_height = layer_height
-		if "initialLayerThickness" in config.options("x"):
-			init_layer_height = config.getfloat("x", "initialLayerThickness") / 1000
-		elif "first_layer_height" in config.options("x"):
-			init_layer_height = config.getfloat("x", "first_layer_height")
-
-		# support
-		support = "None"
-		if "support_material" in config.options("x"):
-			value = config.getint("x", "support_material")
-			if value != 0:
-				support = "Touching Buildplate"
-
-		posx = 0
-		posy = 0
-		mm_from_um = lambda x: x / 1000.0
-		no_translation = lambda x: x
-		width_from_line_count = lambda x: x * extrusion_width
-		height_from_layer_count = lambda x: x * layer_height
-		bool_from_int = lambda x: not not x
-		self._logger.debug("layer_height={}; height_from_layer_count(3)={}".format(layer_height, height_from_layer_count(3)))
-
-		profile_from_engine_config = {
-			"layerthickness":       ("layer_height",       mm_from_um),
-			"layer_height":         ("layer_height",       no_translation),
-			"printspeed":           ("print_speed",        no_translation),
-			"print_speed":          ("print_speed",        no_translation),
-			"perimeter_speed":      ("print_speed",        no_translation),
-			"supporttype":          ("support_type",       lambda x: "lines" if x == 0 else "grid"),
-			"support_material":     ("support",            lambda x: "None" if x == 0 else "Touching Buildplate"),
-			"fill_pattern":         (None, None),          # octoprint and legacy cura only support lines and grid
-			"infillspeed":          ("infill_speed",       no_translation),
-			"infill_speed":         ("infill_speed",       no_translation),
-			"solid_infill_speed":   (None, None),          # not sure where to send this one
-			"solidtopinfillspeed":  (None, None),          # not sure where to send this one
-			"infilloverlap":        ("fill_overlap",       no_translation),
-			"infill_overlap":       ("fill_overlap",       no_translation),
-			"filamentdiameter":     ("filament_diameter",  lambda x: [mm_from_um(x) for i in range(4)]),
-			"filament_diameter":    ("filament_diameter",  lambda x: [x for i in range(4)]),
-			"filamentflow":         ("filament_flow",      no_translation),
-			"extrusion_multiplyer": ("filament_flow",      no_translation),
-			"retractionamountextruderswitch": ("retraction_dual_amount", mm_from_um),
-			"retract_length_toolchange": ("retraction_dual_amount", no_translation),
-			"retractionamount":     ("retraction_amount",  mm_from_um),
-			"retract_length":       ("retraction_amount",  no_translation),
-			"retractionspeed":      ("retraction_speed",   no_translation),
-			"retract_speed":        ("retraction_speed",   no_translation),
-			"initiallayerthickness":("bottom_thickness",   mm_from_um),
-			"first_layer_height":   ("bottom_thickness",   no_translation),
-			"extrusionwidth":       ("edge_width",         mm_from_um),
-			"extrusion_width":      ("edge_width",         no_translation),
-			"perimeters":           ("wall_thickness",     width_from_line_count),
-			"downskincount":        ("solid_layer_thickness", height_from_layer_count),
-			"bottom_solid_layers":  ("solid_layer_thickness", height_from_layer_count),
-			"upskincount":          ("solid_layer_thickness", height_from_layer_count),
-			"top_solid_layers":     ("solid_layer_thickness", height_from_layer_count),
-			"initialspeeduplayers": (None, None),          # octoprint always uses 4
-			"initiallayerspeed":    ("bottom_layer_speed", no_translation),
-			"first_layer_speed":    ("bottom_layer_speed", no_translation),
-			"inset0speed":          ("outer_shell_speed",  no_translation),
-			"insetxspeed":          ("inner_shell_speed",  no_translation),
-			"movespeed":            ("travel_speed",       no_translation),
-			"travel_speed":         ("travel_speed",       no_translation),
-			"minimallayertime":     ("cool_min_layer_time",no_translation),
-			"infillpattern":        (None, None),          # octoprint doesn't set
-			"layer0extrusionwidth": ("first_layer_width_factor", lambda x: mm_from_um(x) * 100.0 / extrusion_width),
-			"first_layer_extrusion_width": ("first_layer_width_factor", lambda x: x * 100.0 / extrusion_width),
-			"spiralizemode":        ("spiralize",          bool_from_int),
-			"spiral_vase":          ("spiralize",          bool_from_int),
-			"sparseinfilllinedistance": ("fill_density",   lambda x: 100.0 * extrusion_width / mm_from_um(x)),
-			"fill_density":         ("fill_density",       no_translation),
-			"multivolumeoverlap":   ("overlap_dual",       mm_from_um),
-			"enableoozeshield":     ("ooze_shield",        bool_from_int),
-			"ooze_prevention":      ("ooze_shield",        bool_from_int),
-			"fanfullonlayernr":     ("fan_full_height",    lambda x: (x - 1) * layer_height + init_layer_height),
-			"full_fan_speed_layer": ("fan_full_height",    lambda x: (x - 1) * layer_height + init_layer_height),
-			"gcodeflavor":          ("gcode_flavor",       lambda x: "reprap"),
-			"gcode_flavor":         ("gcode_flavor",       lambda x: "reprap"),
-			"autocenter":           (None, None),          # octoprint doesn't set
-			"objectsink":           ("object_sink",        mm_from_um),
-			"nozzle_diameter":      (None, None),          # octoprint always overrides with printer profile
-			"bed_shape":            (None, None),          # octoprint always overrides with printer profile
-			"rect_origin":          (None, None),          # octoprint always overrides with printer profile
-			"extruderoffset[0].x":  (None, None),          # octoprint always overrides with printer profile
-			"extruderoffset[0].y":  (None, None),          # octoprint always overrides with printer profile
-			"retractionminimaldistance": ("retraction_min_travel", mm_from_um),
-			"retract_before_travel": ("retraction_min_travel", no_translation),
-			"retractionzhop":       ("retraction_hop",     mm_from_um),
-			"retract_lift":         ("retraction_hop",     no_translation),
-			"minimalextrusionbeforeretraction": ("retraction_minimal_extrusion", mm_from_um),
-			"enablecombing":        ("retraction_combing", lambda x: "all" if x == 1 else ("no skin" if x == 2 else "off")),
-			"minimalfeedrate":      ("cool_min_feedrate",  no_translation),
-			"min_print_speed":      ("cool_min_feedrate",  no_translation),
-			"coolheadlift":         ("cool_head_lift",     bool_from_int),
-			"fanspeedmin":          ("fan_speed",          no_translation),
-			"min_fan_speed":        ("fan_speed",          no_translation),
-			"fanspeedmax":          ("fan_speed_max",      no_translation),
-			"max_fan_speed":        ("fan_speed_max",      no_translation),
-			"skirtdistance":        ("skirt_gap",          mm_from_um),
-			"skirt_distance":       ("skirt_gap",          no_translation),
-			"skirtminlength":       ("skirt_minimal_length", mm_from_um),
-			"min_skirt_length":     ("skirt_minimal_length", no_translation),
-			"skirtlinecount":       ("skirt_line_count",   no_translation),
-			"skirts":               ("skirt_line_count",   no_translation),
-			"supportangle":         ("support_angle",      no_translation),
-			"support_material_threshold": ("support_angle",no_translation),
-			"supportxydistance":    ("support_xy_distance", mm_from_um),
-			"support_material_spacing": ("support_xy_distance", no_translation),
-			"support_material_xy_spacing": ("support_xy_distance", no_translation),
-			"supportzdistance":     ("support_z_distance", mm_from_um),
-			"supportlinedistance":  ("support_fill_rate",  lambda x: 100.0 * extrusion_width / mm_from_um(x)),
-			"support_material_buildplate_only": ("support", lambda x: "Touching Buildplate" if support != "None" else "None"),
-			"startcode":            ("start_gcode",        lambda x: ["(@ignore {print_temperature})\n(@ignore {print_bed_temperature})\n" + x[3:-3]]),
-			"start_gcode":          ("start_gcode",        lambda x: ["(@ignore {print_temperature})\n(@ignore {print_bed_temperature})\n" + x.replace("\\n", "\n")]),
-			"endcode":              ("end_gcode",          lambda x: [x[3:-3]]),
-			"end_gcode":            ("end_gcode",          lambda x: [x.replace("\\n", "\n")]),
-			"raft_layers":          ("raft_thickness",     height_from_layer_count),
-			"raftmargin":           ("raft_margin",        mm_from_um),
-			"raftlinespacing":      ("raft_line_spacing",  mm_from_um),
-			"raftbasethickness":    ("raft_base_thickness",mm_from_um),
-			"raftbaselinewidth":    ("raft_base_linewidth",mm_from_um),
-			"raftinterfacethickness": ("raft_thickness",   mm_from_um),
-			"raftinterfacelinewidth": ("raft_margin",      mm_from_um),
-			"raftinterfacelinespacing": (None, None),      # octoprint computes from linewidth
-			"raftbasespeed":        (None, None),          # octoprint always uses bottom_layer_speed
-			"raftfanspeed":         (None, None),          # octoprint forces this to 0
-			"raftsurfacethickness": ("raft_surface_thickness", mm_from_um),
-			"raftsurfacelinewidth": ("raft_surface_linewidth", mm_from_um),
-			"raftsurfacelinespacing": (None, None),        # octoprint computes from linewidth
-			"raftsurfacelayers":    ("raft_surface_layers",no_translation),
-			"raftsurfacespeed":     (None, None),          # octoprint always uses bottom_layer_speed
-			"raftairgap":           ("raft_airgap_all",    mm_from_um),
-			"raftairgaplayer0":     (None, None),          # octoprint doesn't support a different airgap for layer0)
-			"filament_cost":        (None, None),          # octoprint doesn't use these filament infos
-			"filament_density":     (None, None),          # octoprint doesn't use these filament infos
-		}
-
-		profile = dict()
-		profile["support"] = "none"
-		posx = 0
-		posy = 0
-		for option in config.options("x"):
-			# try to fetch the value in the correct type
-			try:
-				value = config.getint("x", option)
-			except:
-				# no int, try float
-				try:
-					value = config.getfloat("x", option)
-				except:
-					# no float, use str
-					value = config.get("x", option)
-					if value.endswith("%"):
-						value = value[:len(value)-1]
-						try:
-							value = float(value)
-						except ValueError:
-							# leave it as a string
-							pass
-
-			if option in profile_from_engine_config:
-				key, translate = profile_from_engine_config[option]
-				if key:
-					self._logger.debug("key={}; value={}, {}".format(key, value, type(value)))
-					profile[key] = translate(value)
-					if "raft" in key:
-						profile["platform_adhesion"] = "raft"
-					elif "support" in key:
-						if profile["support"] != "everywhere":
-							profile["support"] = "buildplate"
-				else:
-					self._logger.debug("Eating PolarCloud setting {}={}".format(option, value))
-			elif option == "supporteverywhere":
-				if value:
-					profile["support"] = "everywhere"
-			elif option == "fixhorrible":
-				profile["fix_horrible_union_all_type_a"] = not not (value & 0x01)
-				profile["fix_horrible_union_all_type_b"] = not not (value & 0x02)
-				profile["fix_horrible_extensive_stitching"] = not not (value & 0x04)
-				profile["fix_horrible_use_open_bits"] = not not (value & 0x10)
-			elif option == "posx":
-				posx = mm_from_um(value)
-			elif option == "posy":
-				posy = mm_from_um(value)
-			else:
-				self._logger.warn("PolarCloud slicing profile contains unrecognized setting {}={}".format(option, value))
-
-		self._logger.debug("Profile looks like this: {}".format(repr(profile)))
-		profile["fan_enabled"] = "fan_speed_max" in profile and profile["fan_speed_max"] > 0
+			return (None, (0, 0))
+
+		# saving rewrites the profile and OctoPrint's cache of it, which is
+		# wasted when Polar Cloud sends the same profile print after print.
+		# The digest file holds the hash of the profile as sent and of the
+		# file it was saved to, so a profile edited locally since is saved over
+		digest = hashlib.sha256(json.dumps(profile, sort_keys=True).encode('utf-8')).hexdigest()
+		digest_path = os.path.join(self.get_plugin_data_folder(), 'slicing_profile.sha256')
+		profile_path = None
+		try:
+			profile_path = self._slicing_manager.get_profile_path(slicer, "polarcloud")
+			with open(digest_path, 'r') as f:
+				if f.read().split() == [digest, _file_sha256(profile_path)]:
+					self._logger.debug("Slicing profile unchanged, not saving it")
+					return (profile, pos)
+		except Exception:
+			pass
 
 		try:
-			profile = self._slicing_manager.save_profile(slicer, "polarcloud", profile,
+			self._slicing_manager.save_profile(slicer, "polarcloud", profile,
 					allow_overwrite=True, display_name="PolarCloud",
 					description="Polar Cloud sends this slicing profile down with each cloud print (overwritten each time)")
-		except:
+		except Exception:
 			self._logger.exception("save_profile failed")
-			profile = None
-		return (profile, (posx, posy))
+			return (None, pos)
+		saved_digest = _file_sha256(profile_path) if profile_path else None
+		try:
+			if saved_digest:
+				with open(digest_path, 'w') as f:
+					f.write("{}\n{}\n".format(digest, saved_digest))
+			else:
+				_remove_quietly(digest_path)
+		except (IOError, OSError):
+			self._logger.exception("Unable to record the slicing profile hash")
+		return (profile, pos)
 
 	def strip_ignore(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
 		if cmd and cmd.startswith("(@ignore"):
 			return None,
 
+	#~~ Heartbeat
+
+class PolarHeartbeatScheduler(object):
+	"""
+	Lets the heartbeat thread sleep until its next deadline while still waking
+	it immediately when a task is queued, a status update is requested or the
+	connection state changes. Queued tasks run in priority order, a task
+	that's already waiting isn't queued twice, and each wake up drains as many
+	tasks as fit in drain_budget seconds before looking at anything else.
+	"""
+	PRIORITY_HANDSHAKE = 0
+	PRIORITY_CONTROL = 1
+	PRIORITY_UPLOAD = 2
+
+	def __init__(self, drain_budget=2.0):
+		self._cond = threading.Condition()
+		self._tasks = []
+		self._seq = 0
+		self._status_requested = False
+		self._drain_budget = drain_budget
+
+	def put(self, task, priority=PRIORITY_CONTROL):
+		with self._cond:
+			for queued in self._tasks:
+				if queued[2] == task:
+					if priority < queued[0]:
+						self._tasks.remove(queued)
+						heapq.heapify(self._tasks)
+						break
+					return
+			self._seq += 1
+			heapq.heappush(self._tasks, (priority, self._seq, task))
+			self._cond.notify_all()
+
+	def request_status(self):
+		with self._cond:
+			self._status_requested = True
+			self._cond.notify_all()
+
+	def clear_status_request(self):
+		with self._cond:
+			self._status_requested = False
+
+	# call after changing anything should_stop looks at
+	def wake(self):
+		with self._cond:
+			self._cond.notify_all()
+
+	def wait(self, deadline, should_stop, ignore_status_request=False):
+		"""
+		Run queued tasks as they arrive until the monotonic deadline. Returns
+		True if the deadline was reached, False if cut short by a status
+		request or should_stop() returning true.
+		"""
+		while True:
+			with self._cond:
+				while not self._tasks:
+					if should_stop():
+						return False
+					if self._status_requested and not ignore_status_request:
+						self._status_requested = False
+						return False
+					remaining = deadline - _monotonic()
+					if remaining <= 0:
+						return True
+					self._cond.wait(remaining)
+			self._drain(should_stop)
+			with self._cond:
+				if should_stop():
+					return False
+				if self._status_requested and not ignore_status_request:
+					self._status_requested = False
+					return False
+			if _monotonic() >= deadline:
+				return True
+
+	def _drain(self, should_stop):
+		budget_end = _monotonic() + self._drain_budget
+		while not should_stop():
+			with self._cond:
+				if not self._tasks:
+					return
+				priority, seq, task = heapq.heappop(self._tasks)
+			task()
+			if _monotonic() >= budget_end:
+				return
+
+class PolarStatusEncoder(object):
+	"""
+	Decides what, if anything, to emit for each heartbeat status. A status
+	that hasn't changed meaningfully since the last one sent is held back for
+	up to keepalive seconds. If Polar Cloud has advertised 'statusDelta' in
+	its capabilities, statuses between full keyframes only carry the fields
+	that changed since the last status the server acknowledged. What the
+	server knows is built up from the payloads it acknowledged, not from the
+	statuses they were encoded from, so a change held back by the deadband
+	keeps counting until it's sent; a field that disappears from the status
+	forces a keyframe, as a delta has no way to remove it.
+	"""
+	# sent in every status, full or delta
+	ALWAYS_SENT = ('serialNumber', 'status', 'jobId', 'protocol', 'temperatureStats')
+	# always differ, but that alone isn't worth an update
+	IGNORED_CHANGES = ('temperatureStats',)
+	# changes smaller than the deadband on these aren't worth an update
+	TEMPERATURES = ('tool0', 'tool1', 'bed')
+
+	def __init__(self, keepalive=60, keyframe_interval=10, temp_deadband=1.0):
+		self.configure(keepalive, keyframe_interval, temp_deadband)
+		self.reset()
+
+	# keepalive - longest time in seconds between statuses, 0 sends every one
+	# keyframe_interval - number of deltas between full statuses
+	# temp_deadband - temperature change in degrees that counts as a change
+	def configure(self, keepalive, keyframe_interval, temp_deadband):
+		self._keepalive = keepalive
+		self._keyframe_interval = keyframe_interval
+		self._temp_deadband = temp_deadband
+
+	# forget everything about the server's state, eg. after reconnecting
+	def reset(self):
+		self._sent = None
+		self._sent_time = None
+		self._acknowledged = None
+		self._deltas_sent = 0
+
+	# socket.io ack callback for payload, as returned by encode, any
+	# arguments from the server are ignored
+	def acknowledge(self, payload, *args, **kwargs):
+		self._acknowledged = self._apply(self._acknowledged, payload)
+
+	# the status the server has after receiving payload on top of known
+	def _apply(self, known, payload):
+		if payload.get('delta') and known is not None:
+			status = dict(known)
+			status.update(payload)
+		else:
+			status = dict(payload)
+		status.pop('delta', None)
+		return status
+
+	def encode(self, status, deltas=False, force=False):
+		"""Returns the payload to emit for status, or None to skip it."""
+		now = _monotonic()
+		# allow a second of slack so a keepalive equal to the update interval
+		# isn't missed by a tick that comes back a hair early
+		if (not force and self._sent is not None and self._keepalive and
+				now - self._sent_time < self._keepalive - 1 and
+				not self._changed_keys(self._sent, status)):
+			return None
+
+		changed = None
+		if deltas and self._acknowledged is not None and self._deltas_sent < self._keyframe_interval:
+			changed = self._changed_keys(self._acknowledged, status)
+			if any(key not in status for key in changed):
+				changed = None
+		if changed is not None:
+			payload = dict((key, status[key]) for key in self.ALWAYS_SENT if key in status)
+			for key in changed:
+				payload[key] = status[key]
+			payload['delta'] = True
+			self._deltas_sent += 1
+		else:
+			payload = status
+			if deltas:
+				payload = dict(status)
+				payload['delta'] = False
+			self._deltas_sent = 0
+		self._sent = self._apply(self._sent, payload)
+		self._sent_time = now
+		return payload
+
+	def _changed_keys(self, previous, status):
+		changed = []
+		for key, value in status.items():
+			if key in self.IGNORED_CHANGES:
+				continue
+			if not key in previous:
+				changed.append(key)
+			elif key in self.TEMPERATURES:
+				try:
+					if abs(float(value) - float(previous[key])) > self._temp_deadband:
+						changed.append(key)
+				except (TypeError, ValueError):
+					if value != previous[key]:
+						changed.append(key)
+			elif value != previous[key]:
+				changed.append(key)
+		for key in previous:
+			if not key in status and not key in self.IGNORED_CHANGES:
+				changed.append(key)
+		return changed
+
+class PolarTemperatureAggregator(PrinterCallback):
+	"""
+	Collects the temperatures OctoPrint pushes to its printer callbacks so
+	the heartbeat can read the latest values, and the min/max/mean of each
+	heater since the last status went out, without calling into the
+	printer. Only running totals are kept, so reading is constant time and
+	memory doesn't grow however long a status interval is.
+	"""
+	HEATERS = ('tool0', 'tool1', 'bed')
+
+	class _Heater(object):
+		__slots__ = ('actual', 'target', 'count', 'total', 'low', 'high')
+
+		def __init__(self):
+			self.actual = None
+			self.target = None
+			self.rollover()
+
+		def add(self, actual, target):
+			self.actual = actual
+			self.target = target
+			self.count += 1
+			self.total += actual
+			if self.low is None or actual < self.low:
+				self.low = actual
+			if self.high is None or actual > self.high:
+				self.high = actual
+
+		def rollover(self):
+			self.count = 0
+			self.total = 0.0
+			self.low = None
+			self.high = None
+
+	# max_age - seconds without a push before current() gives up
+	def __init__(self, max_age=30):
+		self._lock = threading.Lock()
+		self._max_age = max_age
+		self._heaters = {}
+		self._updated = None
+
+	def on_printer_add_temperature(self, data):
+		with self._lock:
+			for name in self.HEATERS:
+				sample = data.get(name)
+				if not isinstance(sample, dict) or sample.get('actual') is None:
+					continue
+				heater = self._heaters.get(name)
+				if heater is None:
+					heater = self._heaters[name] = self._Heater()
+				heater.add(sample['actual'], sample.get('target'))
+			self._updated = _monotonic()
+
+	# the latest temperatures shaped like get_current_temperatures(), or
+	# None if nothing has been pushed in the last max_age seconds
+	def current(self):
+		with self._lock:
+			if self._updated is None or _monotonic() - self._updated > self._max_age:
+				return None
+			return dict((name, {'actual': heater.actual, 'target': heater.target})
+				for name, heater in self._heaters.items())
+
+	# min/max/mean of each heater since the last rollover()
+	def stats(self):
+		with self._lock:
+			return dict((name, {'min': heater.low, 'max': heater.high,
+					'mean': round(heater.total / heater.count, 2)})
+				for name, heater in self._heaters.items() if heater.count)
+
+	# start a new aggregation window, called once a status is sent
+	def rollover(self):
+		with self._lock:
+			for heater in self._heaters.values():
+				heater.rollover()
+
+class PolarUploadQueue(object):
+	"""
+	Uploads waiting for another try, kept in queue.json under folder so they
+	survive a restart of OctoPrint. Each entry records the job_id,
+	upload_type and path of the file to upload along with how many attempts
+	have failed and the wall clock time of the next one. A coalesced entry
+	(a snapshot) replaces any earlier entry with the same upload_type, since
+	only the latest frame is worth sending.
+	"""
+	def __init__(self, folder, logger, backoff=30, max_backoff=3600):
+		self._folder = folder
+		self._path = os.path.join(folder, 'queue.json')
+		self._logger = logger
+		self._backoff = backoff
+		self._max_backoff = max_backoff
+		self._lock = threading.Lock()
+		self._entries = []
+
+	@property
+	def folder(self):
+		return self._folder
+
+	def load(self):
+		try:
+			with open(self._path, 'r') as f:
+				entries = json.load(f).get('entries', [])
+		except (IOError, OSError):
+			entries = []
+		except ValueError:
+			self._logger.warning("Discarding unreadable upload queue {}".format(self._path))
+			entries = []
+		with self._lock:
+			self._entries = [entry for entry in entries if os.path.exists(entry.get('path', ''))]
+		if self._entries:
+			self._logger.info("{} upload(s) waiting from a previous session".format(len(self._entries)))
+
+	def __len__(self):
+		return len(self._entries)
+
+	def add(self, job_id, upload_type, path, coalesce=False, owned=False, max_attempts=10):
+		with self._lock:
+			if coalesce:
+				for entry in [e for e in self._entries if e['upload_type'] == upload_type]:
+					self._entries.remove(entry)
+					if entry['owned'] and entry['path'] != path:
+						_remove_quietly(entry['path'])
+			self._entries.append(dict(job_id=job_id, upload_type=upload_type, path=path,
+				owned=owned, attempts=0, max_attempts=max_attempts, next_attempt=0))
+			self._save()
+
+	def due(self, now=None):
+		now = time.time() if now is None else now
+		with self._lock:
+			return [dict(entry) for entry in self._entries if entry['next_attempt'] <= now]
+
+	def done(self, entry):
+		with self._lock:
+			self._remove(entry)
+			self._save()
+
+	# drop coalesced entries for upload_type, eg. when a newer snapshot went
+	# out on its own
+	def discard(self, upload_type):
+		with self._lock:
+			entries = [e for e in self._entries if e['upload_type'] == upload_type]
+			for entry in entries:
+				self._remove(entry)
+			if entries:
+				self._save()
+
+	def failed(self, entry):
+		with self._lock:
+			for queued in self._entries:
+				if queued['path'] == entry['path'] and queued['upload_type'] == entry['upload_type']:
+					queued['attempts'] += 1
+					if queued['attempts'] >= queued['max_attempts']:
+						self._logger.error("Giving up on uploading {} after {} attempts".format(
+							queued['path'], queued['attempts']))
+						self._remove(queued)
+					else:
+						delay = min(self._backoff * 2 ** (queued['attempts'] - 1), self._max_backoff)
+						queued['next_attempt'] = time.time() + random.uniform(0.8, 1.2) * delay
+					break
+			self._save()
+
+	def _remove(self, entry):
+		for queued in self._entries:
+			if queued['path'] == entry['path'] and queued['upload_type'] == entry['upload_type']:
+				self._entries.remove(queued)
+				if queued['owned']:
+					_remove_quietly(queued['path'])
+				return
+
+	def _save(self):
+		try:
+			if not os.path.isdir(self._folder):
+				os.makedirs(self._folder)
+			temp_path = self._path + '.tmp'
+			with open(temp_path, 'w') as f:
+				json.dump({'entries': self._entries}, f)
+			# os.replace is atomic on Windows as well, but python 2 lacks it
+			getattr(os, 'replace', os.rename)(temp_path, self._path)
+		except (IOError, OSError):
+			self._logger.exception("Unable to save upload queue {}".format(self._path))
+
+class PolarUploadWorker(object):
+	"""
+	Runs the upload queue on a thread of its own, so a timelapse going out
+	over a slow uplink doesn't hold up status messages and commands on the
+	heartbeat. kick() asks for a pass; a kick during a pass gets another one
+	after it, passes never overlap.
+	"""
+	def __init__(self, process, logger):
+		self._process = process
+		self._logger = logger
+		self._kicked = threading.Event()
+		self._lock = threading.Lock()
+		self._thread = None
+		self._stopped = False
+
+	def kick(self):
+		with self._lock:
+			if self._stopped:
+				return
+			self._kicked.set()
+			if not self._thread or not self._thread.is_alive():
+				self._thread = threading.Thread(target=self._run)
+				self._thread.daemon = True
+				self._thread.start()
+
+	def stop(self):
+		with self._lock:
+			self._stopped = True
+			self._kicked.set()
+
+	def _run(self):
+		while True:
+			self._kicked.wait()
+			self._kicked.clear()
+			if self._stopped:
+				return
+			try:
+				self._process()
+			except Exception:
+				self._logger.exception("Upload queue pass failed")
+
+class PolarUploadLocations(object):
+	"""
+	The upload locations (getUrlResponse) Polar Cloud has handed out, one per
+	upload type ('idle', 'printing' or 'timelapse') and job, so an upload
+	still queued for an earlier job and one for the current job don't take
+	each other's place. request_url(upload_type, job_id) is called to ask
+	for a new one and returns True if the request went out; one that did
+	isn't repeated for request_timeout seconds for the same type and job.
+	refresh() asks again ahead of expiry so uploads find a valid location
+	waiting for them, and wait() lets another thread block until one
+	arrives. A job_id of None matches a location for any job.
+	"""
+	def __init__(self, request_url, request_timeout=30):
+		self._request_url = request_url
+		self._request_timeout = request_timeout
+		self._condition = threading.Condition()
+		# (upload_type, job_id) -> location, deadline and lifetime
+		self._locations = {}
+		self._deadlines = {}
+		self._lifetimes = {}
+		self._requested = {}
+
+	# store a getUrlResponse for job_id that's good for expires_in seconds
+	def set(self, location, expires_in, job_id):
+		upload_type = location.get('type', 'idle')
+		now = _monotonic()
+		with self._condition:
+			for key in [key for key, deadline in self._deadlines.items() if deadline <= now]:
+				self._forget(key)
+			key = (upload_type, job_id)
+			self._locations[key] = location
+			self._deadlines[key] = now + expires_in
+			self._lifetimes[key] = expires_in
+			self._requested.pop(key, None)
+			self._requested.pop((upload_type, None), None)
+			self._condition.notify_all()
+
+	# the job the oldest unanswered request for upload_type was for, to file
+	# a response that doesn't say under
+	def requested_job_id(self, upload_type):
+		with self._condition:
+			pending = sorted((requested, job_id) for (requested_type, job_id), requested
+					in self._requested.items() if requested_type == upload_type and job_id is not None)
+		return pending[0][1] if pending else None
+
+	def get(self, upload_type, job_id=None):
+		with self._condition:
+			return self._valid(upload_type, job_id)
+
+	# returns the location, or None after asking for a new one
+	def ensure(self, upload_type, job_id=None):
+		location = self.get(upload_type, job_id)
+		if location is None:
+			self._request(upload_type, job_id)
+		return location
+
+	# block for up to timeout seconds for a valid location
+	def wait(self, upload_type, job_id=None, timeout=10):
+		deadline = _monotonic() + timeout
+		with self._condition:
+			while True:
+				location = self._valid(upload_type, job_id)
+				remaining = deadline - _monotonic()
+				if location is not None or remaining <= 0:
+					return location
+				self._condition.wait(remaining)
+
+	# forget the location for upload_type and job_id (any job if None), eg.
+	# after an upload to it was refused
+	def discard(self, upload_type, job_id=None):
+		with self._condition:
+			for key in self._keys(upload_type, job_id):
+				self._forget(key)
+
+	# wanted maps the upload types to keep fresh to their job_id. Locations
+	# for them that expire within margin seconds (or half their lifetime, if
+	# that's shorter) are asked for again, types never used aren't.
+	def refresh(self, wanted, margin):
+		for upload_type, job_id in wanted.items():
+			with self._condition:
+				keys = self._keys(upload_type, job_id)
+				if not keys:
+					continue
+				lead = min(margin, max(self._lifetimes[key] for key in keys) / 2.0)
+				stale = self._valid(upload_type, job_id, lead) is None
+			if stale:
+				self._request(upload_type, job_id)
+
+	def _keys(self, upload_type, job_id):
+		if job_id is not None:
+			return [(upload_type, job_id)] if (upload_type, job_id) in self._locations else []
+		return [key for key in self._locations if key[0] == upload_type]
+
+	def _forget(self, key):
+		self._locations.pop(key, None)
+		self._deadlines.pop(key, None)
+		self._lifetimes.pop(key, None)
+
+	# the valid location for upload_type and job_id that lasts longest
+	def _valid(self, upload_type, job_id, margin=0):
+		keys = [key for key in self._keys(upload_type, job_id)
+				if _monotonic() + margin < self._deadlines[key]]
+		if not keys:
+			return None
+		return self._locations[max(keys, key=lambda key: self._deadlines[key])]
+
+	def _request(self, upload_type, job_id):
+		now = _monotonic()
+		with self._condition:
+			requested = self._requested.get((upload_type, job_id))
+			if requested is not None and now - requested < self._request_timeout:
+				return
+			self._requested[(upload_type, job_id)] = now
+		if not self._request_url(upload_type, job_id):
+			# eg. not connected, ask again as soon as we can
+			with self._condition:
+				if self._requested.get((upload_type, job_id)) == now:
+					del self._requested[(upload_type, job_id)]
+
 	#~~ Timelapse
 
+# pick output settings for a timelapse so a single encode pass fits in
+# max_size bytes and lasts no longer than max_duration seconds. info is from
+# PolarTimelapseTranscoder.probe(), returns a dict with 'speedup' (frames are
+# dropped to play that many times faster), 'fps', 'width', 'height' and
+# 'bitrate' in kbit/s ('bitrate' is None if there's no size limit). A movie
+# whose duration couldn't be probed is sized as if it lasted
+# UNKNOWN_TIMELAPSE_DURATION seconds.
+UNKNOWN_TIMELAPSE_DURATION = 300.0
+
+def plan_timelapse_budget(info, max_size=None, max_duration=None):
+	duration = info.get('duration') or 0.0
+	fps = min(info.get('fps') or 25.0, 30.0)
+	# yuv420p needs even dimensions
+	width = (info.get('width') or 640) // 2 * 2
+	height = (info.get('height') or 480) // 2 * 2
+
+	speedup = 1.0
+	if max_duration and duration > max_duration:
+		speedup = duration / max_duration
+	if duration:
+		out_duration = max(duration / speedup, 1.0)
+	else:
+		out_duration = UNKNOWN_TIMELAPSE_DURATION
+
+	plan = {'speedup': speedup, 'fps': fps, 'width': width, 'height': height, 'bitrate': None}
+	if not max_size:
+		return plan
+
+	# leave room for the container and for x264 overshooting in one pass
+	bitrate = max_size * 8 * 0.9 / out_duration
+	plan['bitrate'] = max(int(bitrate / 1000), 16)
+
+	# step down the resolution, then the frame rate, until there are enough
+	# bits per pixel for a watchable picture
+	min_bits_per_pixel = 0.04
+	for candidate in [width, 1280, 960, 640, 480, 320]:
+		if candidate > width:
+			continue
+		plan['width'] = candidate
+		plan['height'] = int(round(height * candidate / float(width) / 2)) * 2
+		if bitrate / (plan['width'] * plan['height'] * fps) >= min_bits_per_pixel:
+			return plan
+	while fps > 10 and bitrate / (plan['width'] * plan['height'] * fps) < min_bits_per_pixel:
+		fps = max(fps / 2, 10.0)
+	plan['fps'] = fps
+	return plan
+
 class PolarTimelapseTranscoder(object):
-	def __init__(self, octoprint_movie, callback, logger):
+	"""
+	Turn an OctoPrint timelapse into an H.264 MP4 for Polar Cloud. The input
+	is probed first: an H.264 MP4 that's within the upload limits is passed
+	through untouched, other H.264 input is remuxed without re-encoding, and
+	only anything else is encoded with a fast, thread limited x264 preset,
+	sized to fit the upload's maxSize and max_duration. GStreamer is used
+	when it's installed with ffmpeg as the fallback.
+	"""
+	def __init__(self, octoprint_movie, callback, logger, threads=2, max_size=None, max_duration=None,
+			upload_stream=None):
 		self._octoprint_movie = octoprint_movie
 		movie_basename, ext = os.path.splitext(octoprint_movie)
 		self._polar_movie = movie_basename + ".mp4"
+		if self._polar_movie == octoprint_movie:
+			self._polar_movie = movie_basename + "-polar.mp4"
 		self._callback = callback
 		self._logger = logger
+		self._threads = threads
+		# callable, since the upload location may still be on its way
+		self._max_size = max_size or (lambda: None)
+		self._max_duration = max_duration
+		# optional callable taking an iterable of chunks of the movie and
+		# returning whether it uploaded them, see _stream_encode
+		self._upload_stream = upload_stream
 
 	def translate_timelapse(self):
 		self._thread = threading.Thread(target=self._translate_timelapse_worker,
@@ -1791,19 +3524,188 @@ class PolarTimelapseTranscoder(object):
 		self._thread.daemon = True
 		self._thread.start()
 
+	def probe(self):
+		"""
+		Returns a dict with whichever of the first video stream's 'codec',
+		'width', 'height', 'fps' and the 'duration' could be found.
+		"""
+		info = {}
+		if _ffprobe_path:
+			output = self._run([_ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+					'-show_entries', 'stream=codec_name,width,height,avg_frame_rate:format=duration',
+					'-of', 'json', self._octoprint_movie])
+			try:
+				probed = json.loads(output or "{}")
+				stream = (probed.get('streams') or [{}])[0]
+				if 'codec_name' in stream:
+					info['codec'] = stream['codec_name'].lower()
+				if stream.get('width') and stream.get('height'):
+					info['width'] = int(stream['width'])
+					info['height'] = int(stream['height'])
+				num, _, den = stream.get('avg_frame_rate', '').partition('/')
+				if num and den and float(den):
+					info['fps'] = float(num) / float(den)
+				if probed.get('format', {}).get('duration'):
+					info['duration'] = float(probed['format']['duration'])
+			except ValueError:
+				self._logger.exception("Unable to parse ffprobe output")
+		elif _ffmpeg_path:
+			# ffmpeg without an output exits with an error, but describes the input first
+			output = self._run([_ffmpeg_path, '-hide_banner', '-i', self._octoprint_movie],
+					check=False) or ""
+			match = re.search(r"Stream #\S+.*?: Video: (\w+)(.*)", output)
+			if match:
+				info['codec'] = match.group(1).lower()
+				size = re.search(r", (\d+)x(\d+)", match.group(2))
+				if size:
+					info['width'] = int(size.group(1))
+					info['height'] = int(size.group(2))
+				fps = re.search(r", ([\d.]+) fps", match.group(2))
+				if fps:
+					info['fps'] = float(fps.group(1))
+			duration = re.search(r"Duration: (\d+):(\d+):([\d.]+)", output)
+			if duration:
+				info['duration'] = (int(duration.group(1)) * 3600 +
+						int(duration.group(2)) * 60 + float(duration.group(3)))
+		self._logger.debug("timelapse probe {}: {}".format(self._octoprint_movie, repr(info)))
+		return info
+
+	def _remux_commands(self):
+		commands = []
+		if _gst_launch_path:
+			commands.append([_gst_launch_path, '-e',
+					'filesrc', 'location=' + self._octoprint_movie, '!', 'parsebin', '!',
+					'h264parse', '!', 'mp4mux', '!', 'filesink', 'location=' + self._polar_movie])
+		if _ffmpeg_path:
+			commands.append([_ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y',
+					'-i', self._octoprint_movie, '-map', '0:v:0', '-c', 'copy',
+					'-movflags', '+faststart', self._polar_movie])
+		return commands
+
+	def _ffmpeg_encode_command(self, plan, output):
+		filters = []
+		if plan['speedup'] > 1.0:
+			filters.append('setpts=PTS/{:.4f}'.format(plan['speedup']))
+		filters.append('fps={:.3f}'.format(plan['fps']))
+		filters.append('scale={}:{}'.format(plan['width'], plan['height']))
+		command = [_ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y',
+				'-i', self._octoprint_movie, '-map', '0:v:0', '-vf', ','.join(filters),
+				'-c:v', 'libx264', '-preset', 'veryfast', '-threads', str(self._threads)]
+		if plan['bitrate']:
+			command += ['-b:v', '{}k'.format(plan['bitrate']),
+					'-maxrate', '{}k'.format(plan['bitrate']),
+					'-bufsize', '{}k'.format(plan['bitrate'] * 2)]
+		command += ['-pix_fmt', 'yuv420p']
+		if output == 'pipe:1':
+			# a regular MP4 needs to seek back to write its index, a
+			# fragmented one can be written front to back into a pipe
+			command += ['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4']
+		else:
+			command += ['-movflags', '+faststart']
+		return command + [output]
+
+	def _encode_commands(self, plan):
+		commands = []
+		ffmpeg_command = None
+		if _ffmpeg_path:
+			ffmpeg_command = self._ffmpeg_encode_command(plan, self._polar_movie)
+			# gst-launch can't drop frames to speed the movie up, so prefer
+			# ffmpeg when that's needed
+			if plan['speedup'] > 1.0:
+				commands.append(ffmpeg_command)
+		if _gst_launch_path:
+			x264enc = ['x264enc', 'speed-preset=veryfast', 'threads={}'.format(self._threads)]
+			if plan['bitrate']:
+				# keeping every frame, the movie plays speedup times longer than
+				# the plan's bitrate was sized for
+				bitrate = max(int(plan['bitrate'] / plan['speedup']), 16)
+				x264enc += ['bitrate={}'.format(bitrate), 'pass=cbr']
+			commands.append([_gst_launch_path, '-e',
+					'filesrc', 'location=' + self._octoprint_movie, '!', 'decodebin', '!',
+					'videoconvert', '!', 'videorate', '!', 'videoscale', '!',
+					'video/x-raw,width={},height={},framerate={}/1000'.format(
+						plan['width'], plan['height'], int(plan['fps'] * 1000)), '!'] +
+					x264enc + ['!', 'h264parse', '!', 'mp4mux', '!',
+					'filesink', 'location=' + self._polar_movie])
+		if ffmpeg_command and not ffmpeg_command in commands:
+			commands.append(ffmpeg_command)
+		return commands
+
+	# encode with ffmpeg straight into upload_stream without touching the
+	# disk, returns True if the upload succeeded
+	def _stream_encode(self, plan):
+		command = self._ffmpeg_encode_command(plan, 'pipe:1')
+		self._logger.debug("timelapse command: {}".format(" ".join(command)))
+		try:
+			process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError:
+			self._logger.exception("Unable to run {}".format(command[0]))
+			return False
+
+		def _chunks():
+			for chunk in iter(lambda: process.stdout.read(65536), b''):
+				yield chunk
+			if process.wait() != 0:
+				# raising here aborts the request before the closing boundary,
+				# so the server won't keep a truncated movie
+				raise IOError("ffmpeg returned {}: {}".format(process.returncode,
+						process.stderr.read().decode('utf-8', 'replace')))
+
+		try:
+			return self._upload_stream(_chunks())
+		finally:
+			if process.poll() is None:
+				process.kill()
+				process.wait()
+			process.stdout.close()
+			process.stderr.close()
+
+	# run command, returns its stdout or None if it failed
+	def _run(self, command, check=True):
+		self._logger.debug("timelapse command: {}".format(" ".join(command)))
+		try:
+			result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError:
+			self._logger.exception("Unable to run {}".format(command[0]))
+			return None
+		if check and result.returncode != 0:
+			self._logger.warn("Could not render movie, got return code {returncode}: {stderr_text}".format(
+				returncode=result.returncode, stderr_text=result.stderr.decode('utf-8', 'replace')))
+			return None
+		return (result.stdout or result.stderr).decode('utf-8', 'replace')
+
 	# working thread for converting from OctoPrint's timelapse format to PolarCloud's
 	def _translate_timelapse_worker(self):
-		command = 'gst-launch-1.0 -e filesrc location="{infile}" ! decodebin name=decode ! x264enc ! queue ! qtmux name=mux ! filesink location={outfile} decode. ! mux.'.format(
-				infile=self._octoprint_movie, outfile=self._polar_movie)
-		self._logger.debug("timelapse command: {}".format(command))
-
 		try:
-			p = sarge.run(command, stdout=sarge.Capture(), stderr=sarge.Capture())
-			if p.returncode != 0:
-				self._logger.warn("Could not render movie, got return code {returncode}: {stderr_text}".format(returncode=p.returncode, stderr_text=p.stderr.text))
-			else:
-				self._logger.debug("gstreamer succeded: {}".format(p.stdout.text))
-				self._callback(self._polar_movie)
+			info = self.probe()
+			codec = info.get('codec')
+			max_size = self._max_size()
+			within_budget = ((not max_size or os.path.getsize(self._octoprint_movie) <= max_size) and
+					(not self._max_duration or info.get('duration', 0) <= self._max_duration))
+			if codec == 'h264' and within_budget and self._octoprint_movie.lower().endswith('.mp4'):
+				self._logger.debug("timelapse is already H.264 MP4")
+				self._callback(self._octoprint_movie)
+				return
+
+			commands = self._remux_commands() if codec == 'h264' and within_budget else []
+			plan = plan_timelapse_budget(info, max_size, self._max_duration)
+			self._logger.debug("timelapse budget for max size {}: {}".format(max_size, repr(plan)))
+			if not commands and self._upload_stream and _ffmpeg_path:
+				if self._stream_encode(plan):
+					self._logger.debug("timelapse streamed to Polar Cloud")
+					# already uploaded, the callback only needs to update state
+					self._callback(None)
+					return
+				self._logger.info("Streaming timelapse upload failed, encoding to disk instead")
+			commands += self._encode_commands(plan)
+			if not commands:
+				self._logger.warn("Could not render movie, neither gstreamer nor ffmpeg is installed")
+			for command in commands:
+				if self._run(command) is not None:
+					self._logger.debug("{} succeeded".format(os.path.basename(command[0])))
+					self._callback(self._polar_movie)
+					return
+			self._callback(None)
 
 		except:
 			self._logger.exception("Could not render movie due to unknown error")
@@ -1811,38 +3713,248 @@ class PolarTimelapseTranscoder(object):
 
 	#~~ Slicing
 
+class PolarPrintCancelled(Exception):
+	pass
+
+class PolarPrintError(Exception):
+	pass
+
+# a cloud print request on its way from the 'print' message to the printer
+class PolarPrintJob(object):
+	def __init__(self, job_id, print_type, print_file, ext, config_file=None):
+		self.job_id = job_id
+		self.print_type = print_type
+		self.print_file = print_file
+		self.ext = ext
+		self.config_file = config_file
+		self.info = {'file': print_file}
+		if config_file:
+			self.info['config'] = config_file
+		self.stage = None
+		self.slicer = 'curalegacy'
+		self.pos = (0, 0)
+		self.download_path = None
+		self.path = None
+		self.path_gcode = None
+		self.slicing_profile = None
+		self.slice_key = None
+		self.sliced_path = None
+		self.cancel_event = threading.Event()
+
+class PolarSliceCache(object):
+	"""
+	Gcode sliced for earlier cloud prints, kept under folder as <key>.gcode
+	where the key hashes everything that went into slicing it (see key()).
+	A file's mtime is bumped on each hit and the least recently used files
+	are evicted to keep the total under max_bytes, 0 disables the cache.
+	"""
+	def __init__(self, folder, logger, max_bytes=0):
+		self._folder = folder
+		self._logger = logger
+		self._max_bytes = max_bytes
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def configure(self, max_bytes):
+		self._max_bytes = max_bytes
+		with self._lock:
+			self._evict()
+
+	@property
+	def enabled(self):
+		return self._max_bytes > 0
+
+	# hash the model file and any other json serializable inputs to slicing
+	@staticmethod
+	def key(model_path, *inputs):
+		digest = hashlib.sha256()
+		with open(model_path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1024 * 1024), b''):
+				digest.update(chunk)
+		for value in inputs:
+			digest.update(json.dumps(value, sort_keys=True, default=repr).encode('utf-8'))
+		return digest.hexdigest()
+
+	# returns the path of the cached gcode for key or None
+	def get(self, key):
+		path = os.path.join(self._folder, key + '.gcode')
+		with self._lock:
+			if self.enabled and os.path.exists(path):
+				os.utime(path, None)
+				self.hits += 1
+				return path
+			self.misses += 1
+			return None
+
+	def put(self, key, gcode_path):
+		if not self.enabled or os.path.getsize(gcode_path) > self._max_bytes:
+			return
+		path = os.path.join(self._folder, key + '.gcode')
+		with self._lock:
+			try:
+				if not os.path.isdir(self._folder):
+					os.makedirs(self._folder)
+				shutil.copyfile(gcode_path, path + '.tmp')
+				getattr(os, 'replace', os.rename)(path + '.tmp', path)
+			except (IOError, OSError):
+				self._logger.exception("Unable to add {} to the slice cache".format(gcode_path))
+				_remove_quietly(path + '.tmp')
+				return
+			self._evict()
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses}
+
+	def _evict(self):
+		try:
+			names = [name for name in os.listdir(self._folder) if name.endswith('.gcode')]
+		except OSError:
+			return
+		entries = []
+		for name in names:
+			try:
+				st = os.stat(os.path.join(self._folder, name))
+			except OSError:
+				continue
+			entries.append((st.st_mtime, st.st_size, name))
+		total = sum(entry[1] for entry in entries)
+		for mtime, size, name in sorted(entries):
+			if total <= self._max_bytes:
+				break
+			self._logger.debug("Evicting {} from the slice cache".format(name))
+			_remove_quietly(os.path.join(self._folder, name))
+			total -= size
+
+# runs print jobs through a list of named stages on a single worker thread so
+# the socket.io event thread never blocks on downloads or the file manager
+class PolarPrintPipeline(object):
+	def __init__(self, stages, callback_failed, logger, max_pending=1, callback_cancelled=None):
+		self._stages = stages
+		self._callback_failed = callback_failed
+		self._callback_cancelled = callback_cancelled or callback_failed
+		self._logger = logger
+		self._queue = queue.Queue(max_pending)
+		self._thread = None
+		self._current = None
+		self._mutex = threading.Lock()
+
+	def submit(self, job):
+		with self._mutex:
+			if not self._thread or not self._thread.is_alive():
+				self._thread = threading.Thread(target=self._pipeline_worker,
+						name="PolarCloudPrintPipeline")
+				self._thread.daemon = True
+				self._thread.start()
+		try:
+			self._queue.put_nowait(job)
+		except queue.Full:
+			return False
+		return True
+
+	# cancel the job in progress and any waiting, the one in progress stops at
+	# the next stage or sooner if its stage watches job.cancel_event. Returns
+	# True if there were any.
+	def cancel(self):
+		cancelled = False
+		with self._mutex:
+			if self._current:
+				self._current.cancel_event.set()
+				cancelled = True
+		while True:
+			try:
+				job = self._queue.get_nowait()
+			except queue.Empty:
+				break
+			job.cancel_event.set()
+			self._callback_cancelled(job)
+			self._queue.task_done()
+			cancelled = True
+		return cancelled
+
+	# working thread for preparing cloud prints
+	def _pipeline_worker(self):
+		while True:
+			job = self._queue.get()
+			with self._mutex:
+				self._current = job
+			try:
+				for job.stage, stage in self._stages:
+					if job.cancel_event.is_set():
+						raise PolarPrintCancelled(job.job_id)
+					self._logger.debug("Print job {} stage {}".format(job.job_id, job.stage))
+					stage(job)
+			except (PolarPrintCancelled, PolarDownloadCancelled):
+				self._callback_cancelled(job)
+			except PolarPrintError as e:
+				self._logger.warn("Print job {} failed in stage {}: {}".format(job.job_id, job.stage, e))
+				self._callback_failed(job)
+			except:
+				self._logger.exception("Print job {} failed in stage {}".format(job.job_id, job.stage))
+				self._callback_failed(job)
+			finally:
+				with self._mutex:
+					self._current = None
+				self._queue.task_done()
+
 class PolarPrintPreparer(object):
-	def __init__(self, slicer, file_manager, path, pathGcode, pos, callback, callback_failed, logger):
+	"""
+	Slices a cloud print's model with the slicing manager into dest_path,
+	which is ours rather than the file manager's so that cancel() can stop
+	the slicer through cancel_slicing and whatever it left behind is thrown
+	away. Setting cancel_event (the job's) marks the job as cancelled for
+	everyone else.
+	"""
+	def __init__(self, slicer, slicing_manager, source_path, dest_path, pos, cancel_event, callback, callback_failed, logger):
 		self._slicer = slicer
-		self._file_manager = file_manager
-		self._path = path
-		self._pathGcode = pathGcode
+		self._slicing_manager = slicing_manager
+		self._source_path = source_path
+		self._dest_path = dest_path
 		self._pos = pos
+		self.cancel_event = cancel_event
 		self._callback = callback
 		self._callback_failed = callback_failed
 		self._logger = logger
-		self._thread = None
+		self._done = threading.Event()
 
 	def prepare(self):
-		self._thread = threading.Thread(target=self._preparation_worker)
-		self._thread.daemon = True
-		self._thread.start()
+		if self.cancel_event.is_set():
+			self._on_sliced(_cancelled=True)
+			return
+		try:
+			self._slicing_manager.slice(self._slicer, self._source_path, self._dest_path,
+					"polarcloud", self._on_sliced, position=self._pos)
+		except Exception as e:
+			# the slicing manager calls back with the error before raising
+			# for some problems, not for others
+			if not self._done.is_set():
+				self._logger.exception("_slicing_manager.slice failed")
+				self._on_sliced(_error=e)
 
 	def is_alive(self):
-		return not self._thread or self._thread.is_alive()
+		return not self._done.is_set()
 
-	# working thread for slicing
-	def _preparation_worker(self):
+	def cancel(self):
+		self.cancel_event.set()
+		if self._done.is_set():
+			return
 		try:
-			self._file_manager.slice(self._slicer,
-					FileDestinations.LOCAL, self._path,
-					FileDestinations.LOCAL, self._pathGcode,
-					position=self._pos, profile="polarcloud",
-					callback=self._callback,
-					callback_args=(self._file_manager.path_on_disk(FileDestinations.LOCAL, self._pathGcode),))
-		except:
-			self._logger.exception("_file_manager.slice failed")
+			self._slicing_manager.cancel_slicing(self._slicer, self._source_path, self._dest_path)
+		except Exception:
+			self._logger.exception("Unable to cancel slicing {}".format(self._source_path))
+
+	# slicing manager callback, called on its worker thread
+	def _on_sliced(self, *args, **kwargs):
+		if self._done.is_set():
+			return
+		self._done.set()
+		if kwargs.get('_cancelled') or self.cancel_event.is_set():
+			self.cancel_event.set()
 			self._callback_failed()
+		elif kwargs.get('_error'):
+			self._callback_failed(kwargs['_error'])
+		else:
+			self._callback(self._dest_path)
 
 __plugin_name__ = "PolarCloud"
 __plugin_pythoncompat__ = ">=2.7,<4"
@@ -0,0 +1,62 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import octoprint_polarcloud
+from devtools.fakes import make_plugin
+
+
+# fails the way OctoPrint's SlicingManager does for an unknown or
+# unconfigured slicer: the callback first, then the exception
+class FailingSlicingManager(object):
+	def slice(self, slicer, source_path, dest_path, profile, callback, **kwargs):
+		callback(_error="Slicer not configured")
+		raise RuntimeError("Slicer not configured")
+
+	def cancel_slicing(self, *args, **kwargs):
+		pass
+
+
+class PrintPreparationTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.plugin = make_plugin(self.folder, overrides={"enable_system_commands": False})
+		self.plugin._slicing_manager = FailingSlicingManager()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder, ignore_errors=True)
+
+	def _run(self, func, *args):
+		thread = threading.Thread(target=func, args=args)
+		thread.daemon = True
+		thread.start()
+		thread.join(5)
+		return not thread.is_alive()
+
+	def test_synchronous_slicing_failure(self):
+		job = octoprint_polarcloud.PolarPrintJob("J1", "stlFile", "http://example.com/model.stl", ".stl")
+		job.path = "polarcloud/model.stl"
+		self.plugin._state.update(cloud_print=True, job_id="J1")
+
+		self.assertTrue(self._run(self.plugin._prepare_start, job), "_prepare_start deadlocked")
+		self.assertTrue(self._run(self.plugin._cancel_preparation), "_cancel_preparation deadlocked")
+		self.assertEqual(self.plugin._pstate, octoprint_polarcloud.PolarStateMachine.PSTATE_ERROR)
+		self.assertIsNone(self.plugin._print_preparer)
+		self.assertIsNone(job.sliced_path)
+
+	def test_cancelled_gcode_job_isnt_started(self):
+		job = octoprint_polarcloud.PolarPrintJob("J2", "gcodeFile", "http://example.com/part.gcode", ".gcode")
+		job.path = "polarcloud/part.gcode"
+		job.cancel_event.set()
+
+		with self.assertRaises(octoprint_polarcloud.PolarPrintCancelled):
+			self.plugin._prepare_start(job)
+		self.assertIsNone(getattr(self.plugin._printer, "selected", None))
+
+
+if __name__ == "__main__":
+	unittest.main()